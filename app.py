@@ -1,19 +1,136 @@
-from flask import Flask, render_template, request, flash, redirect, url_for, session,send_file,make_response,abort,jsonify
+from flask import Flask, Blueprint, render_template, request, flash, redirect, url_for, session,send_file,make_response,abort,jsonify,Response,stream_with_context,g,has_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, TextAreaField, SubmitField, SelectField,SelectMultipleField
 from wtforms.validators import DataRequired
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import inspect
-from sqlalchemy.orm import backref,aliased
+from werkzeug.exceptions import HTTPException
+from itsdangerous import Signer
+from sqlalchemy import inspect, text, select, bindparam, tuple_, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session,backref,aliased,make_transient_to_detached,selectinload,load_only
+import atexit
 import io
+import gzip
+import os
+import sqlite3
+import hashlib
+import tempfile
+import re
+import json
+import base64
+import csv
+import itertools
+import random
+import statistics
+import time
+import uuid
+import queue
+import subprocess
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import Counter, OrderedDict
+from functools import lru_cache, wraps
+from markupsafe import Markup
+import click
+from datetime import date, datetime, timedelta, timezone
+import mp3info
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///music_app.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.secret_key = 'your_secret_key'
-db = SQLAlchemy(app)
+app.config['MP3_CHUNK_SIZE'] = 64 * 1024
+app.config['MP3_STORE_PATH'] = os.path.join(app.root_path, 'mp3_store')
+app.config['MAX_MP3_SIZE'] = 50 * 1024 * 1024
+app.config['JOB_WORKERS'] = 4
+app.config['JOBS_EAGER'] = False
+app.config['JOB_STALE_SECONDS'] = 120
+app.config['JOB_HEARTBEAT_SECONDS'] = 30
+app.config['WAVEFORM_POINTS'] = 256
+app.config['SEARCH_FTS'] = True
+app.config['SEARCH_PAGE_SIZE'] = 20
+app.config['SEARCH_CANDIDATES'] = 500
+app.config['PAGE_SIZE'] = 50
+app.config['RANKING_CACHE_TTL'] = 60
+app.config['RANKING_MAX_LIMIT'] = 100
+app.config['USER_CACHE_TTL'] = 0
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt:32768:8:1'
+app.config['HASH_WORKERS'] = 2
+app.config['HASH_QUEUE_TIMEOUT'] = 5
+app.config['LOGIN_USER_BURST'] = 10
+app.config['LOGIN_USER_PER_MINUTE'] = 5
+app.config['LOGIN_IP_BURST'] = 50
+app.config['LOGIN_IP_PER_MINUTE'] = 60
+app.config['LOGIN_BUCKETS_MAX'] = 100000
+app.config['PAGE_CACHE_ENABLED'] = True
+app.config['PAGE_CACHE_URL'] = None
+app.config['PAGE_CACHE_MAX_BYTES'] = 32 * 1024 * 1024
+app.config['PAGE_CACHE_TTL'] = 30
+app.config['PAGE_CACHE_MAX_AGE'] = 0
+app.config['API_MAX_LIMIT'] = 200
+app.config['API_COMPRESS_MIN_BYTES'] = 512
+app.config['RATING_BATCH_MAX'] = 10000
+app.config['PLAYLIST_BATCH_MAX'] = 10000
+app.config['RATING_WRITE_BEHIND_MS'] = 0
+app.config['RECOMMENDATIONS_SHOWN'] = 10
+app.config['MODERATION_BATCH_SIZE'] = 200
+app.config['MODERATION_BATCH_PAUSE_MS'] = 20
+app.config['ANALYTICS_FLUSH_MS'] = 2000
+app.config['ANALYTICS_QUEUE_MAX'] = 100000
+app.config['ANALYTICS_DAYS'] = 30
+app.config['STREAM_URL_TTL'] = 3600
+app.config['QUEUE_MAX_SONGS'] = 1000
+app.config['QUEUE_PREFETCH_SECONDS'] = 10
+app.config['RENDITION_ENCODER'] = 'ffmpeg'
+app.config['RENDITION_BITRATES'] = {'low': 48, 'medium': 96}
+app.config['RENDITION_CACHE_PATH'] = os.path.join(app.root_path, 'rendition_cache')
+app.config['RENDITION_CACHE_MAX_BYTES'] = 2 * 1024 * 1024 * 1024
+app.config['RENDITION_WORKERS'] = 2
+app.config['RENDITION_WAIT_SECONDS'] = 15
+app.config['RENDITION_TIMEOUT'] = 300
+app.config['SQL_PROFILING'] = os.environ.get('SQL_PROFILING') == '1'
+app.config['SQL_QUERY_BUDGET'] = None
+app.config['SQL_QUERY_BUDGET_RAISE'] = False
+app.config['SQL_N_PLUS_ONE_THRESHOLD'] = 5
+app.config['SQLITE_WAL'] = True
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 15000
+app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024
+app.config['DB_POOL_SIZE'] = 5
+app.config['DB_MAX_OVERFLOW'] = 10
+# Any setting above can be overridden from the environment, e.g. MUSIC_APP_DB_POOL_SIZE=10.
+app.config.from_prefixed_env('MUSIC_APP')
+# The engine is created by create_app(), so settings passed to it still reach the pool and the pragmas below.
+db = SQLAlchemy()
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers keep going while a rating or upload is being written.
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    if app.config['SQLITE_WAL']:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+    cursor.execute(f"PRAGMA mmap_size={int(app.config['SQLITE_MMAP_SIZE'])}")
+    cursor.close()
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -24,13 +141,15 @@ class User(db.Model):
     isban = db.Column(db.Integer, default=0, nullable=False, server_default='0')
     playlists = db.relationship('Playlist', backref='creator', lazy=True)
 
+    __table_args__ = (db.Index('ix_user_isadmin_isban', 'isadmin', 'isban', 'id'),)
+
     @property
     def password(self):
         raise AttributeError('Password is not a readable attribute.')
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, app.config['PASSWORD_HASH_METHOD'])
 
     def verify_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -43,14 +162,26 @@ class Song(db.Model):
     title = db.Column(db.String(100), nullable=False)
     artist = db.Column(db.String(100), nullable=False)
     lyrics = db.Column(db.Text, nullable=False)
-    mp3_binary = db.Column(db.LargeBinary, nullable=True)  # Updated field
+    mp3_binary = db.deferred(db.Column(db.LargeBinary, nullable=True))  # Updated field
+    mp3_hash = db.Column(db.String(64), nullable=True, index=True)
+    mp3_size = db.Column(db.Integer, nullable=True)
+    uploaded_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=True)
+    duration = db.Column(db.Float, nullable=True)
+    bitrate = db.Column(db.Integer, nullable=True)
+    waveform = db.deferred(db.Column(db.LargeBinary, nullable=True))
     album_id = db.Column(db.Integer, db.ForeignKey('album.id'), nullable=True)
+    rating_count = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    rating_sum = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    rating_avg = db.Column(db.Float, default=0, nullable=False, server_default='0')
+
+    __table_args__ = (
+        db.Index('ix_song_rating_avg', 'rating_avg', 'id'),
+        db.Index('ix_song_artist', 'artist', 'id'),
+    )
 
     @property
     def average_rating(self):
-        ratings = Rating.query.filter_by(song_id=self.id).all()
-        total_ratings = sum(rating.rating for rating in ratings)
-        return total_ratings / len(ratings) if len(ratings) > 0 else 0
+        return self.rating_sum / self.rating_count if self.rating_count else 0
 
 class Album(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -58,9 +189,12 @@ class Album(db.Model):
     artist = db.Column(db.String(100), nullable=False,default=lambda: session.get('username'))
     songs = db.relationship('Song', secondary='album_song_association', backref='albums', lazy=True)
 
+    __table_args__ = (db.Index('ix_album_artist', 'artist', 'id'),)
+
 album_song_association = db.Table('album_song_association',
-    db.Column('album_id', db.Integer, db.ForeignKey('album.id')),
-    db.Column('song_id', db.Integer, db.ForeignKey('song.id'))
+    db.Column('album_id', db.Integer, db.ForeignKey('album.id'), primary_key=True),
+    db.Column('song_id', db.Integer, db.ForeignKey('song.id'), primary_key=True),
+    db.Index('ix_album_song_association_song_id', 'song_id')
 )
 
 class Rating(db.Model):
@@ -70,7 +204,10 @@ class Rating(db.Model):
     song_id = db.Column(db.Integer, db.ForeignKey('song.id'), nullable=False)
     rating = db.Column(db.Integer, nullable=False)
 
-    db.UniqueConstraint('user_id', 'song_id', name='unique_user_song_rating')
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'song_id', name='unique_user_song_rating'),
+        db.Index('ix_ratings_song_id', 'song_id'),
+    )
 
     user = db.relationship('User', backref='ratings')
     song = db.relationship('Song', backref='ratings')
@@ -79,14 +216,112 @@ class Playlist(db.Model):
     __tablename__ = 'playlist'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    songs = db.relationship('Song', secondary='playlist_song_association', backref='playlists', lazy=True)
+    creator_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # Read-only and ordered; rows are written through the playlist helpers so each change touches one row.
+    songs = db.relationship('Song', secondary='playlist_song_association', order_by='playlist_song_association.c.position',
+                            backref=backref('playlists', viewonly=True), viewonly=True, lazy=True)
+
+# Positions are spaced PLAYLIST_POSITION_GAP apart so a song can be inserted or moved between two others
+# by updating only its own row.
+PLAYLIST_POSITION_GAP = 1 << 20
 
 playlist_song_association = db.Table('playlist_song_association',
-    db.Column('playlist_id', db.Integer, db.ForeignKey('playlist.id')),
-    db.Column('song_id', db.Integer, db.ForeignKey('song.id'))
+    db.Column('playlist_id', db.Integer, db.ForeignKey('playlist.id'), primary_key=True),
+    db.Column('song_id', db.Integer, db.ForeignKey('song.id'), primary_key=True),
+    db.Column('position', db.Integer, nullable=False, server_default='0'),
+    db.Index('ix_playlist_song_association_song_id', 'song_id'),
+    db.Index('ix_playlist_song_association_position', 'playlist_id', 'position', 'song_id')
 )
 
+class BackgroundJob(db.Model):
+    __tablename__ = 'background_job'
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    kind = db.Column(db.String(30), nullable=False)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=True)
+    description = db.Column(db.String(200), nullable=True)
+    args = db.Column(db.Text, nullable=True)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    worker_id = db.Column(db.String(32), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    heartbeat_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'description': self.description,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+        }
+
+class ImportCheckpoint(db.Model):
+    __tablename__ = 'import_checkpoint'
+    manifest = db.Column(db.String(500), primary_key=True)
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
+class SongNeighbor(db.Model):
+    # Top-K most similar songs per song, written by `flask build-recommendations`.
+    __tablename__ = 'song_neighbor'
+    song_id = db.Column(db.Integer, db.ForeignKey('song.id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    neighbor_id = db.Column(db.Integer, db.ForeignKey('song.id'), nullable=False, index=True)
+    score = db.Column(db.Float, nullable=False)
+
+class UserRecommendation(db.Model):
+    __tablename__ = 'user_recommendation'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    song_id = db.Column(db.Integer, db.ForeignKey('song.id'), nullable=False, index=True)
+    score = db.Column(db.Float, nullable=False)
+
+class RecommendationQueue(db.Model):
+    # Users whose ratings or playlists changed since their recommendations were last built.
+    __tablename__ = 'recommendation_queue'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    queued_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class DailyStat(db.Model):
+    # Materialised per-day counters, maintained incrementally by the analytics event writer.
+    __tablename__ = 'daily_stat'
+    day = db.Column(db.Date, primary_key=True)
+    plays = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    uploads = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    ratings = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    active_users = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class DailyActiveUser(db.Model):
+    __tablename__ = 'daily_active_user'
+    day = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+
+class CreatorStat(db.Model):
+    __tablename__ = 'creator_stat'
+    artist = db.Column(db.String(100), primary_key=True)
+    plays = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
+    uploads = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    ratings = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class PlayQueue(db.Model):
+    # One row per user. Album and playlist queues only store a cursor (the key of the current track) into
+    # the source, so they stay a few bytes however long the playlist is. Search results are snapshotted
+    # into song_ids as packed 32-bit ids.
+    __tablename__ = 'play_queue'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    source = db.Column(db.String(10), nullable=False)
+    source_id = db.Column(db.Integer)
+    song_ids = db.Column(db.LargeBinary)
+    cursor = db.Column(db.String(100), nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
+
 class CreateAlbumForm(FlaskForm):
     name = StringField('Album Name', validators=[DataRequired()])
     songs = SelectMultipleField('Select Songs', coerce=int)
@@ -112,16 +347,1074 @@ class AddSongsToPlaylistForm(FlaskForm):
     songs = SelectMultipleField('Select Songs', coerce=int, validators=[DataRequired()])
     submit = SubmitField('Add Songs')
 
+def mp3_store_path(digest, store=None):
+    return os.path.join(store or app.config['MP3_STORE_PATH'], digest[:2], f'{digest}.mp3')
+
+def store_mp3(chunks, store=None):
+    # Files are named by their sha256, so identical uploads share one file on disk.
+    store = store or app.config['MP3_STORE_PATH']
+    os.makedirs(store, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=store, suffix='.part')
+
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in chunks:
+                digest.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+
+        path = mp3_store_path(digest.hexdigest(), store)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return digest.hexdigest(), size
+
+def store_mp3_file(path):
+    # Like store_mp3, but the spooled file is renamed into the store instead of copied.
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in read_file_chunks(f):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+    size = os.path.getsize(path)
+
+    target = mp3_store_path(digest)
+    if os.path.exists(target):
+        os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    return digest, size
+
+def read_file_chunks(file, chunk_size=None):
+    chunk_size = chunk_size or app.config['MP3_CHUNK_SIZE']
+    return iter(lambda: file.read(chunk_size), b'')
+
+class UploadRejected(Exception):
+    pass
+
+def spool_upload(stream):
+    # Copy the upload to disk chunk by chunk, checking the MP3 signature and size limit as it arrives.
+    incoming = os.path.join(app.config['MP3_STORE_PATH'], 'incoming')
+    os.makedirs(incoming, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=incoming, suffix='.upload')
+    size = 0
+
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in read_file_chunks(stream):
+                if size == 0 and not mp3info.looks_like_mp3(chunk):
+                    raise UploadRejected("That file doesn't look like an MP3.")
+                size += len(chunk)
+                if size > app.config['MAX_MP3_SIZE']:
+                    raise UploadRejected("The MP3 file is too large.")
+                tmp.write(chunk)
+
+        if size == 0:
+            raise UploadRejected("The uploaded file is empty.")
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    return tmp_path
+
+job_executor = None
+job_executor_lock = threading.Lock()
+job_heartbeat = None
+# Identifies this process in background_job.worker_id; a forked child is a different worker.
+job_worker_id = uuid.uuid4().hex
+
+def reset_job_worker():
+    global job_executor, job_heartbeat, job_worker_id
+    job_executor = job_heartbeat = None
+    job_worker_id = uuid.uuid4().hex
+
+os.register_at_fork(after_in_child=reset_job_worker)
+
+def update_job(job_id, **values):
+    values['updated_at'] = values['heartbeat_at'] = datetime.utcnow()
+    BackgroundJob.query.filter_by(id=job_id).update(values)
+    db.session.commit()
+
+def run_job(job_id, task, args):
+    with app.app_context():
+        # Only the worker that holds the job runs it, so a job another worker has taken over is not run twice.
+        claimed = BackgroundJob.query.filter_by(id=job_id, worker_id=job_worker_id, status='pending').update(
+            {'status': 'running', 'updated_at': datetime.utcnow(), 'heartbeat_at': datetime.utcnow()})
+        db.session.commit()
+        if not claimed:
+            return
+        try:
+            result = task(job_id, *args)
+            update_job(job_id, status='done', result=json.dumps(result))
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception("Job %s failed", job_id)
+            update_job(job_id, status='failed', error=str(e))
+            clean_up_job(db.session.query(BackgroundJob.kind).filter_by(id=job_id).scalar(), args)
+
+def clean_up_job(kind, args):
+    # Releases what a job that will never finish was handed, e.g. an upload's spooled file.
+    if kind in JOB_CLEANUP:
+        try:
+            JOB_CLEANUP[kind](*args)
+        except OSError:
+            app.logger.exception("Could not clean up after a %s job", kind)
+
+def submit_job(kind, task, *args, owner_id=None, description=None):
+    job = BackgroundJob(kind=kind, owner_id=owner_id, description=description, worker_id=job_worker_id,
+                        args=json.dumps(args) if kind in RESUMABLE_JOBS or kind in JOB_CLEANUP else None)
+    db.session.add(job)
+    db.session.commit()
+    start_job(job.id, task, args)
+    return job.id
+
+def start_job(job_id, task, args):
+    if app.config['JOBS_EAGER']:
+        run_job(job_id, task, args)
+        return
+
+    global job_executor, job_heartbeat
+    with job_executor_lock:
+        if job_executor is None:
+            job_executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='job')
+            job_heartbeat = threading.Thread(target=beat_jobs_forever, name='job-heartbeat', daemon=True)
+            job_heartbeat.start()
+    job_executor.submit(run_job, job_id, task, args)
+
+def beat_jobs():
+    # Queued jobs do not update their own row, so the heartbeat marks every unfinished job this worker holds as alive.
+    with app.app_context():
+        try:
+            BackgroundJob.query.filter(BackgroundJob.worker_id == job_worker_id, BackgroundJob.status.in_(('pending', 'running'))) \
+                .update({'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+        except OperationalError as e:
+            db.session.rollback()
+            app.logger.warning("Job heartbeat skipped: %s", e)
+
+def beat_jobs_forever():
+    while True:
+        time.sleep(app.config['JOB_HEARTBEAT_SECONDS'])
+        beat_jobs()
+
+def recover_stale_jobs():
+    # Jobs run on a thread pool inside a web worker, so a worker that is recycled or crashes leaves its jobs
+    # 'pending' or 'running' for good. Each worker refreshes heartbeat_at on the jobs it holds every
+    # JOB_HEARTBEAT_SECONDS, so a job held by another worker whose heartbeat is JOB_STALE_SECONDS old has lost its
+    # worker: resumable jobs are taken over and restarted, anything else is marked failed. Jobs this worker holds
+    # are never recovered, however long they have been queued. Claiming a job is a conditional UPDATE, so two
+    # workers noticing the same job do not both restart it.
+    cutoff = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+    stale = db.session.query(BackgroundJob.id, BackgroundJob.kind, BackgroundJob.args, BackgroundJob.heartbeat_at).filter(
+        BackgroundJob.status.in_(('pending', 'running')), BackgroundJob.heartbeat_at < cutoff,
+        (BackgroundJob.worker_id != job_worker_id) | BackgroundJob.worker_id.is_(None)).all()
+
+    restarted, abandoned = [], []
+    for job in stale:
+        resumable = job.kind in RESUMABLE_JOBS and job.args is not None
+        values = {'status': 'pending', 'progress': 0} if resumable else {'status': 'failed', 'error': "The worker running this job stopped."}
+        values['worker_id'] = job_worker_id
+        values['updated_at'] = values['heartbeat_at'] = datetime.utcnow()
+        claimed = BackgroundJob.query.filter_by(id=job.id, heartbeat_at=job.heartbeat_at).update(values, synchronize_session=False)
+        db.session.commit()
+        if claimed and resumable:
+            restarted.append(job)
+        elif claimed and job.args is not None:
+            abandoned.append(job)
+
+    for job in abandoned:
+        clean_up_job(job.kind, json.loads(job.args))
+    for job in restarted:
+        app.logger.warning("Restarting interrupted %s job %s", job.kind, job.id)
+        start_job(job.id, RESUMABLE_JOBS[job.kind], json.loads(job.args))
+    return len(stale)
+
+def process_upload(job_id, tmp_path, title, artist, lyrics):
+    try:
+        info = mp3info.analyze(tmp_path, app.config['WAVEFORM_POINTS'])
+        if info is None:
+            raise UploadRejected("No MPEG audio frames found in the upload.")
+        mp3_hash, mp3_size = store_mp3_file(tmp_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    new_song = Song(
+        title=title,
+        artist=artist,
+        lyrics=lyrics,
+        mp3_hash=mp3_hash,
+        mp3_size=mp3_size,
+        duration=info['duration'],
+        bitrate=info['bitrate'],
+        waveform=info['waveform']
+    )
+    db.session.add(new_song)
+    db.session.flush()
+    index_songs([new_song.id])
+    db.session.commit()
+    invalidate_rankings()
+    invalidate_pages('songs')
+    record_event('upload', new_song.id, db.session.query(BackgroundJob.owner_id).filter_by(id=job_id).scalar())
+
+    return {'song_id': new_song.id}
+
+def discard_upload(tmp_path, *details):
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+def delete_songs_cascade(song_ids):
+    # Deletes the songs and every row that refers to them. The caller commits.
+    song_ids = list(song_ids)
+    album_ids = album_ids_for_songs(song_ids)
+    affected_users = {row.user_id for row in db.session.query(Rating.user_id).filter(Rating.song_id.in_(song_ids)).distinct()}
+    affected_users.update(row.creator_id for row in db.session.query(Playlist.creator_id).join(
+        playlist_song_association, playlist_song_association.c.playlist_id == Playlist.id).filter(playlist_song_association.c.song_id.in_(song_ids)).distinct())
+
+    db.session.query(Rating).filter(Rating.song_id.in_(song_ids)).delete(synchronize_session=False)
+    db.session.execute(album_song_association.delete().where(album_song_association.c.song_id.in_(song_ids)))
+    db.session.execute(playlist_song_association.delete().where(playlist_song_association.c.song_id.in_(song_ids)))
+    db.session.query(SongNeighbor).filter(SongNeighbor.song_id.in_(song_ids) | SongNeighbor.neighbor_id.in_(song_ids)).delete(synchronize_session=False)
+    db.session.query(UserRecommendation).filter(UserRecommendation.song_id.in_(song_ids)).delete(synchronize_session=False)
+    db.session.query(Song).filter(Song.id.in_(song_ids)).delete(synchronize_session=False)
+
+    unindex_songs(song_ids)
+    index_albums(album_ids)
+    queue_recommendations(affected_users)
+    return ['songs'] + [f'song:{song_id}' for song_id in song_ids]
+
+def delete_albums_cascade(album_ids):
+    album_ids = list(album_ids)
+    db.session.execute(album_song_association.delete().where(album_song_association.c.album_id.in_(album_ids)))
+    db.session.query(Album).filter(Album.id.in_(album_ids)).delete(synchronize_session=False)
+    unindex_albums(album_ids)
+    return ['albums'] + [f'album:{album_id}' for album_id in album_ids]
+
+def delete_in_batches(job_id, batches, delete, done=0):
+    # Each batch is its own short write transaction, with a pause after it so other writers get the lock in between.
+    for ids in batches:
+        stale_pages = delete(ids)
+        db.session.commit()
+        done += len(ids)
+        update_job(job_id, progress=done)
+        invalidate_rankings()
+        invalidate_pages(*stale_pages)
+        time.sleep(app.config['MODERATION_BATCH_PAUSE_MS'] / 1000)
+    return done
+
+def chunked(ids, size):
+    ids = list(ids)
+    return [ids[start:start + size] for start in range(0, len(ids), size)]
+
+def delete_songs_task(job_id, song_ids):
+    update_job(job_id, total=len(song_ids))
+    return {'songs': delete_in_batches(job_id, chunked(song_ids, app.config['MODERATION_BATCH_SIZE']), delete_songs_cascade)}
+
+def delete_albums_task(job_id, album_ids):
+    update_job(job_id, total=len(album_ids))
+    return {'albums': delete_in_batches(job_id, chunked(album_ids, app.config['MODERATION_BATCH_SIZE']), delete_albums_cascade)}
+
+def remove_creator_content(job_id, username):
+    size = app.config['MODERATION_BATCH_SIZE']
+    songs = db.session.query(Song.id).filter_by(artist=username)
+    albums = db.session.query(Album.id).filter_by(artist=username)
+    update_job(job_id, total=songs.count() + albums.count())
+
+    # Re-query each time: every batch deletes what the previous query returned.
+    song_batches = iter(lambda: [row.id for row in songs.limit(size)], [])
+    album_batches = iter(lambda: [row.id for row in albums.limit(size)], [])
+    deleted_songs = delete_in_batches(job_id, song_batches, delete_songs_cascade)
+    deleted_albums = delete_in_batches(job_id, album_batches, delete_albums_cascade, done=deleted_songs) - deleted_songs
+    return {'songs': deleted_songs, 'albums': deleted_albums}
+
+MODERATION_JOBS = ('ban', 'delete_songs', 'delete_albums')
+
+# Jobs that are safe to run again from the start after an interruption, by kind.
+RESUMABLE_JOBS = {'ban': remove_creator_content, 'delete_songs': delete_songs_task, 'delete_albums': delete_albums_task}
+# Called with the job's arguments when it fails or its worker stops, by kind.
+JOB_CLEANUP = {'upload': discard_upload}
+
+def submit_moderation_job(kind, task, ids_or_username, description):
+    user = current_user()
+    return submit_job(kind, task, ids_or_username, owner_id=user.id if user else None, description=description)
+
+def begin_write():
+    # pysqlite only opens a transaction at the first INSERT/UPDATE, so a SELECT before it is unlocked and another writer
+    # can change the rows it read. Take the write lock up front, unless this transaction already holds it.
+    connection = db.session.connection()
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+def upsert_ratings(ratings):
+    # ratings: (user_id, song_id, value) tuples, later ones winning. The ratings being replaced are read under the
+    # write lock, so one INSERT ... ON CONFLICT writes the batch and a relative UPDATE per song applies only the
+    # sum and count differences instead of recounting the song's ratings. Returns the affected song ids.
+    latest = {}
+    for user_id, song_id, value in ratings:
+        latest[(user_id, song_id)] = value
+    if not latest:
+        return []
+
+    begin_write()
+    keys = list(latest)
+    previous = {}
+    for start in range(0, len(keys), 400):
+        rows = db.session.query(Rating.user_id, Rating.song_id, Rating.rating).filter(
+            tuple_(Rating.user_id, Rating.song_id).in_(keys[start:start + 400]))
+        previous.update(((row.user_id, row.song_id), row.rating) for row in rows)
+
+    statement = sqlite_insert(Rating.__table__)
+    statement = statement.on_conflict_do_update(index_elements=['user_id', 'song_id'], set_={'rating': statement.excluded.rating})
+    db.session.execute(statement, [{'user_id': user_id, 'song_id': song_id, 'rating': value} for (user_id, song_id), value in latest.items()])
+
+    deltas = {}
+    for key, value in latest.items():
+        sum_delta, count_delta = deltas.get(key[1], (0, 0))
+        if key in previous:
+            deltas[key[1]] = (sum_delta + value - previous[key], count_delta)
+        else:
+            deltas[key[1]] = (sum_delta + value, count_delta + 1)
+
+    song = Song.__table__
+    changed = [{'song': song_id, 'sum_delta': sum_delta, 'count_delta': count_delta}
+               for song_id, (sum_delta, count_delta) in deltas.items() if sum_delta or count_delta]
+    if changed:
+        db.session.execute(song.update().where(song.c.id == bindparam('song')).values(
+            rating_sum=song.c.rating_sum + bindparam('sum_delta'),
+            rating_count=song.c.rating_count + bindparam('count_delta'),
+            rating_avg=db.cast(song.c.rating_sum + bindparam('sum_delta'), db.Float) / (song.c.rating_count + bindparam('count_delta')),
+        ), changed)
+
+    queue_recommendations(user_id for user_id, song_id in latest)
+    for user_id, song_id in latest:
+        record_event_on_commit('rate', song_id, user_id)
+    return sorted(deltas)
+
+def queue_recommendations(user_ids):
+    now = datetime.utcnow()
+    rows = [{'user_id': user_id, 'queued_at': now} for user_id in set(user_ids)]
+    if rows:
+        statement = sqlite_insert(RecommendationQueue.__table__)
+        db.session.execute(statement.on_conflict_do_update(index_elements=['user_id'], set_={'queued_at': statement.excluded.queued_at}), rows)
+
+def similar_songs(song_id, limit=None):
+    return db.session.query(Song.id, Song.title, Song.artist, SongNeighbor.score).join(SongNeighbor, SongNeighbor.neighbor_id == Song.id) \
+        .filter(SongNeighbor.song_id == song_id).order_by(SongNeighbor.rank).limit(limit or app.config['RECOMMENDATIONS_SHOWN']).all()
+
+def recommended_songs(user_id, limit=None):
+    return db.session.query(Song.id, Song.title, Song.artist, UserRecommendation.score).join(UserRecommendation, UserRecommendation.song_id == Song.id) \
+        .filter(UserRecommendation.user_id == user_id).order_by(UserRecommendation.rank).limit(limit or app.config['RECOMMENDATIONS_SHOWN']).all()
+
+def record_rating(user_id, song_id, value):
+    upsert_ratings([(user_id, song_id, value)])
+
+def existing_song_ids(song_ids):
+    song_ids = sorted(set(song_ids))
+    found = set()
+    for start in range(0, len(song_ids), 500):
+        found.update(row.id for row in db.session.query(Song.id).filter(Song.id.in_(song_ids[start:start + 500])))
+    return found
+
+rating_queue = queue.Queue()
+rating_flusher = None
+rating_flusher_lock = threading.Lock()
+
+def queue_rating(user_id, song_id, value):
+    # Write-behind for form submissions: a background thread upserts whatever has queued up every RATING_WRITE_BEHIND_MS.
+    global rating_flusher
+    with rating_flusher_lock:
+        if rating_flusher is None:
+            rating_flusher = threading.Thread(target=flush_ratings_forever, name='rating-write-behind', daemon=True)
+            rating_flusher.start()
+    rating_queue.put((user_id, song_id, value))
+
+def flush_queued_ratings():
+    ratings = []
+    while True:
+        try:
+            ratings.append(rating_queue.get_nowait())
+        except queue.Empty:
+            break
+    if not ratings:
+        return 0
+
+    with app.app_context():
+        try:
+            song_ids = upsert_ratings(ratings)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error: dropped {len(ratings)} queued ratings: {e}")
+            return 0
+
+        invalidate_rankings()
+        invalidate_pages(*(f'song:{song_id}' for song_id in song_ids))
+    return len(ratings)
+
+def flush_ratings_forever():
+    while True:
+        time.sleep(app.config['RATING_WRITE_BEHIND_MS'] / 1000)
+        flush_queued_ratings()
+
+atexit.register(flush_queued_ratings)
+
+analytics_queue = queue.Queue()
+analytics_writer = None
+analytics_writer_lock = threading.Lock()
+analytics_dropped = 0
+
+def record_event(kind, song_id, user_id=None):
+    # Never blocks the request: events are buffered and folded into the statistics tables by a background thread.
+    global analytics_writer, analytics_dropped
+    with analytics_writer_lock:
+        if analytics_writer is None:
+            analytics_writer = threading.Thread(target=flush_events_forever, name='analytics-writer', daemon=True)
+            analytics_writer.start()
+    if analytics_queue.qsize() >= app.config['ANALYTICS_QUEUE_MAX']:
+        analytics_dropped += 1
+        return
+    # Days are UTC, like the uploaded_at dates rebuild-stats groups by.
+    analytics_queue.put((kind, datetime.utcnow().date(), song_id, user_id))
+
+def record_event_on_commit(kind, song_id, user_id=None):
+    # For events that describe a database write: held on the session and recorded only once it commits.
+    db.session.info.setdefault('pending_events', []).append((kind, song_id, user_id))
+
+@event.listens_for(Session, 'after_commit')
+def record_pending_events(session):
+    for kind, song_id, user_id in session.info.pop('pending_events', ()):
+        record_event(kind, song_id, user_id)
+
+@event.listens_for(Session, 'after_rollback')
+def discard_pending_events(session):
+    session.info.pop('pending_events', None)
+
+def flush_events():
+    events = []
+    while True:
+        try:
+            events.append(analytics_queue.get_nowait())
+        except queue.Empty:
+            break
+    if not events:
+        return 0
+
+    counters = {'play': 'plays', 'upload': 'uploads', 'rate': 'ratings'}
+    daily, creators, active = {}, {}, {}
+    with app.app_context():
+        artists = {}
+        song_ids = sorted({song_id for kind, day, song_id, user_id in events})
+        for start in range(0, len(song_ids), 500):
+            artists.update(db.session.query(Song.id, Song.artist).filter(Song.id.in_(song_ids[start:start + 500])).all())
+
+        for kind, day, song_id, user_id in events:
+            column = counters[kind]
+            daily.setdefault(day, Counter())[column] += 1
+            if song_id in artists:
+                creators.setdefault(artists[song_id], Counter())[column] += 1
+            if user_id is not None:
+                active.setdefault(day, set()).add(user_id)
+
+        try:
+            for day, users in active.items():
+                statement = sqlite_insert(DailyActiveUser.__table__).on_conflict_do_nothing()
+                result = db.session.execute(statement, [{'day': day, 'user_id': user_id} for user_id in users])
+                daily.setdefault(day, Counter())['active_users'] += result.rowcount
+
+            upsert_counters(DailyStat, 'day', daily)
+            upsert_counters(CreatorStat, 'artist', creators)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error: dropped {len(events)} analytics events: {e}")
+            return 0
+    return len(events)
+
+def upsert_counters(model, key, rows):
+    # Adds each row's counts to the stored ones, creating rows that do not exist yet.
+    if not rows:
+        return
+    columns = [column.name for column in model.__table__.columns if column.name != key]
+    statement = sqlite_insert(model.__table__)
+    statement = statement.on_conflict_do_update(index_elements=[key], set_={
+        column: model.__table__.c[column] + statement.excluded[column] for column in columns})
+    db.session.execute(statement, [dict({column: counts[column] for column in columns}, **{key: value}) for value, counts in rows.items()])
+
+def flush_events_forever():
+    while True:
+        time.sleep(app.config['ANALYTICS_FLUSH_MS'] / 1000)
+        flush_events()
+
+atexit.register(flush_events)
+
+def is_new_play(status_code, start, headers):
+    # Players fetch audio in ranges; only the response starting at byte 0 counts as a play.
+    # Prefetches of the next queued track say so in a Purpose header and are not counted.
+    if status_code not in (200, 206) or start != 0:
+        return False
+    return 'prefetch' not in headers.get('Sec-Purpose', headers.get('Purpose', ''))
+
+def refresh_rating_aggregates(song_ids=None):
+    rating_count = select(db.func.count(Rating.id)).where(Rating.song_id == Song.id).scalar_subquery()
+    rating_sum = select(db.func.coalesce(db.func.sum(Rating.rating), 0)).where(Rating.song_id == Song.id).scalar_subquery()
+    rating_avg = select(db.func.coalesce(db.func.avg(Rating.rating), 0)).where(Rating.song_id == Song.id).scalar_subquery()
+
+    query = Song.query
+    if song_ids is not None:
+        query = query.filter(Song.id.in_(song_ids))
+
+    return query.update({Song.rating_count: rating_count, Song.rating_sum: rating_sum, Song.rating_avg: rating_avg}, synchronize_session=False)
+
+def create_search_index():
+    # FTS5 tables keyed by rowid = song.id / album.id. Falls back to LIKE search when SQLite lacks FTS5.
+    try:
+        inspector = inspect(db.engine)
+        missing = not inspector.has_table('song_search') or not inspector.has_table('album_search')
+        db.session.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS song_search USING fts5(title, artist, lyrics, tokenize='unicode61 remove_diacritics 2', prefix='2 3 4')"))
+        db.session.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS album_search USING fts5(name, artist, song_titles, tokenize='unicode61 remove_diacritics 2', prefix='2 3 4')"))
+        db.session.commit()
+    except OperationalError as e:
+        db.session.rollback()
+        app.config['SEARCH_FTS'] = False
+        print(f"Full-text search unavailable, using LIKE search: {e}")
+        return
+
+    if missing:
+        rebuild_search_index()
+        db.session.commit()
+
+def rebuild_search_index():
+    db.session.execute(text('DELETE FROM song_search'))
+    db.session.execute(text('DELETE FROM album_search'))
+    db.session.execute(text('INSERT INTO song_search(rowid, title, artist, lyrics) SELECT id, title, artist, lyrics FROM song'))
+    db.session.execute(text(ALBUM_SEARCH_INSERT + ' FROM album'))
+
+ALBUM_SEARCH_INSERT = '''INSERT INTO album_search(rowid, name, artist, song_titles)
+    SELECT album.id, album.name, album.artist,
+        coalesce((SELECT group_concat(song.title, ' ') FROM album_song_association
+                  JOIN song ON song.id = album_song_association.song_id
+                  WHERE album_song_association.album_id = album.id), '')'''
+
+def index_songs(song_ids):
+    if not app.config['SEARCH_FTS'] or not song_ids:
+        return
+    db.session.flush()
+    unindex_songs(song_ids)
+    db.session.execute(text('INSERT INTO song_search(rowid, title, artist, lyrics) SELECT id, title, artist, lyrics FROM song WHERE id IN :ids')
+                       .bindparams(bindparam('ids', expanding=True)), {'ids': list(song_ids)})
+
+def unindex_songs(song_ids):
+    if not app.config['SEARCH_FTS'] or not song_ids:
+        return
+    db.session.execute(text('DELETE FROM song_search WHERE rowid IN :ids').bindparams(bindparam('ids', expanding=True)), {'ids': list(song_ids)})
+
+def index_albums(album_ids):
+    if not app.config['SEARCH_FTS'] or not album_ids:
+        return
+    db.session.flush()
+    unindex_albums(album_ids)
+    db.session.execute(text(ALBUM_SEARCH_INSERT + ' FROM album WHERE album.id IN :ids')
+                       .bindparams(bindparam('ids', expanding=True)), {'ids': list(album_ids)})
+
+def unindex_albums(album_ids):
+    if not app.config['SEARCH_FTS'] or not album_ids:
+        return
+    db.session.execute(text('DELETE FROM album_search WHERE rowid IN :ids').bindparams(bindparam('ids', expanding=True)), {'ids': list(album_ids)})
+
+def album_ids_for_songs(song_ids):
+    rows = db.session.query(album_song_association.c.album_id).filter(album_song_association.c.song_id.in_(song_ids)).distinct()
+    return [row.album_id for row in rows]
+
+def fts_match_query(search_query):
+    # Quote each word and make it a prefix term, so "hel wor" matches "Hello World".
+    terms = re.findall(r'\w+', search_query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, types):
+    # types holds the expected Python type of each value; a cursor that does not match them is a 400
+    # rather than a list or object reaching the keyset comparison.
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        abort(400)
+    if not isinstance(values, list) or len(values) != len(types):
+        abort(400)
+    for value, expected in zip(values, types):
+        if isinstance(value, bool) or not isinstance(value, expected):
+            abort(400)
+    return values
+
+def cursor_type(column):
+    # JSON turns 2.0 into 2, so float keys also accept ints.
+    python_type = column.type.python_type
+    return (int, float) if python_type is float else python_type
+
+def page_from_rows(rows, columns, limit):
+    # Rows were fetched with limit + 1; the extra row only tells us there is another page.
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor([getattr(rows[-1], column.key) for column in columns])
+
+def keyset_page(query, columns, cursor=None, descending=False, limit=None):
+    limit = limit or app.config['PAGE_SIZE']
+    values = decode_cursor(cursor, [cursor_type(column) for column in columns])
+
+    if values is not None:
+        key = tuple_(*columns) if len(columns) > 1 else columns[0]
+        bound = tuple(values) if len(columns) > 1 else values[0]
+        query = query.filter(key < bound if descending else key > bound)
+
+    query = query.order_by(*[column.desc() if descending else column for column in columns])
+    return page_from_rows(query.limit(limit + 1).all(), columns, limit)
+
+def wants_json():
+    return request.args.get('format') == 'json'
+
+def rows_to_dicts(rows):
+    return [row._asdict() for row in rows]
+
+ranking_cache = {}
+ranking_cache_lock = threading.Lock()
+ranking_generation = 0
+
+def cached_ranking(key, compute):
+    now = time.monotonic()
+    with ranking_cache_lock:
+        entry = ranking_cache.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
+        generation = ranking_generation
+
+    value = compute()
+
+    with ranking_cache_lock:
+        # Don't store a result that was computed from data invalidated while we were querying.
+        if generation == ranking_generation:
+            ranking_cache[key] = (now + app.config['RANKING_CACHE_TTL'], value)
+    return value
+
+def invalidate_rankings():
+    global ranking_generation
+    with ranking_cache_lock:
+        ranking_generation += 1
+        ranking_cache.clear()
+
+def top_songs(limit):
+    return cached_ranking(('songs', limit), lambda: db.session.query(Song.id, Song.title, Song.artist, Song.rating_avg)
+                          .order_by(Song.rating_avg.desc(), Song.id.desc()).limit(limit).all())
+
+def top_albums(limit):
+    rating_count = db.func.sum(Song.rating_count)
+    rating_avg = db.func.coalesce(db.cast(db.func.sum(Song.rating_sum), db.Float) / db.func.nullif(rating_count, 0), 0)
+
+    return cached_ranking(('albums', limit), lambda: db.session.query(Album.id, Album.name, Album.artist, rating_avg.label('rating_avg'), rating_count.label('rating_count'))
+                          .join(album_song_association, album_song_association.c.album_id == Album.id)
+                          .join(Song, Song.id == album_song_association.c.song_id)
+                          .group_by(Album.id).order_by(rating_avg.desc(), Album.id.desc()).limit(limit).all())
+
+class LocalPageCache:
+    # LRU bounded by the total size of the cached bodies. Entry versions live in this process only, so with
+    # several workers PAGE_CACHE_TTL bounds how long another worker can serve a page after a write.
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.entity_versions = {}
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return entry[1]
+            if entry:
+                self.discard(key)
+            self.counters['misses'] += 1
+            return None
+
+    def set(self, key, value):
+        size = len(value['body'])
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.size += size
+            self.counters['stores'] += 1
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self.discard(oldest)
+                self.counters['evictions'] += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= len(entry[1]['body'])
+
+    def versions(self, entities):
+        with self.lock:
+            return [self.entity_versions.get(entity, 0) for entity in entities]
+
+    def bump(self, entities):
+        # Old entries are never looked up again once a version they were keyed on moves, and age out of the LRU.
+        with self.lock:
+            for entity in entities:
+                self.entity_versions[entity] = self.entity_versions.get(entity, 0) + 1
+            self.counters['invalidations'] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, backend='local', entries=len(self.entries), bytes=self.size, max_bytes=self.max_bytes)
+
+class RedisPageCache:
+    # Any server speaking the Redis protocol. Versions are shared by every worker, and eviction is left to the
+    # server's maxmemory policy.
+    def __init__(self, url, ttl):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get(self, key):
+        value = self.client.hgetall(f'page:{key}')
+        self.count('hits' if value else 'misses')
+        return {name.decode(): value if name == b'body' else value.decode() for name, value in value.items()} or None
+
+    def set(self, key, value):
+        pipe = self.client.pipeline()
+        pipe.hset(f'page:{key}', mapping={name: value for name, value in value.items() if value is not None})
+        pipe.expire(f'page:{key}', self.ttl)
+        pipe.execute()
+        self.count('stores')
+
+    def versions(self, entities):
+        return [int(version or 0) for version in self.client.mget([f'version:{entity}' for entity in entities])]
+
+    def bump(self, entities):
+        pipe = self.client.pipeline()
+        for entity in entities:
+            pipe.incr(f'version:{entity}')
+        pipe.execute()
+        self.count('invalidations')
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        info = self.client.info('stats')
+        return dict(counters, backend='redis', evictions=info.get('evicted_keys', 0), server_hits=info.get('keyspace_hits', 0),
+                    server_misses=info.get('keyspace_misses', 0))
+
+page_cache = None
+page_cache_lock = threading.Lock()
+
+def get_page_cache():
+    # Built on first use so create_app() and MUSIC_APP_* settings can still choose the backend.
+    global page_cache
+    with page_cache_lock:
+        if page_cache is None:
+            if app.config['PAGE_CACHE_URL']:
+                page_cache = RedisPageCache(app.config['PAGE_CACHE_URL'], app.config['PAGE_CACHE_TTL'])
+            else:
+                page_cache = LocalPageCache(app.config['PAGE_CACHE_MAX_BYTES'], app.config['PAGE_CACHE_TTL'])
+        return page_cache
+
+def invalidate_pages(*entities):
+    # Entities are 'songs' and 'albums' for the catalogue lists, 'song:<id>' and 'album:<id>' for single pages.
+    if app.config['PAGE_CACHE_ENABLED']:
+        get_page_cache().bump(entities)
+
+def page_cache_key(name, entities):
+    cache = get_page_cache()
+    return cache, f"{name}|{'.'.join(map(str, cache.versions(entities)))}"
+
+def cached_page(*entities):
+    # For pages that look the same to every visitor. Entities may use the view's arguments, e.g. 'album:{album_id}'.
+    # Admins also see moderation controls, so their copy is always rendered fresh and never stored.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            if request.method != 'GET' or not app.config['PAGE_CACHE_ENABLED'] or is_admin():
+                return view(**kwargs)
+
+            cache, key = page_cache_key(request.full_path, [entity.format(**kwargs) for entity in entities])
+            entry = cache.get(key)
+
+            if entry is None:
+                response = make_response(view(**kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                entry = {'body': body, 'mimetype': response.mimetype, 'etag': hashlib.md5(body).hexdigest()}
+                cache.set(key, entry)
+
+            response = Response(entry['body'], mimetype=entry['mimetype'])
+            response.set_etag(entry['etag'])
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config['PAGE_CACHE_MAX_AGE']
+            response.cache_control.must_revalidate = True
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+def cached_fragment(name, entities, render):
+    # Caches part of a page whose remainder is per user.
+    if not app.config['PAGE_CACHE_ENABLED']:
+        return Markup(render())
+
+    cache, key = page_cache_key(f'fragment:{name}', entities)
+    entry = cache.get(key)
+    if entry is None:
+        entry = {'body': render().encode()}
+        cache.set(key, entry)
+    return Markup(entry['body'].decode())
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+sql_profile_stats = {}
+sql_profile_lock = threading.Lock()
+
+def query_budget(limit):
+    # Per-route override of SQL_QUERY_BUDGET, checked when SQL profiling is on.
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+def sql_fingerprint(statement):
+    # Expanding IN lists render a different number of placeholders; collapse them so they group together.
+    return re.sub(r'\(\?(?:,\s*\?)*\)', '(?)', ' '.join(statement.split()))
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_profile' in g:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_profile' in g and conn.info.get('query_start'):
+        profile = g.sql_profile
+        profile['statements'] += 1
+        profile['db_time'] += time.perf_counter() - conn.info['query_start'].pop()
+        profile['fingerprints'][sql_fingerprint(statement)] += 1
+
+def start_sql_profile():
+    g.sql_profile = {'statements': 0, 'db_time': 0.0, 'fingerprints': Counter()}
+
+def finish_sql_profile(response):
+    profile = g.pop('sql_profile', None)
+    if profile is None:
+        return response
+
+    statements = profile['statements']
+    db_time_ms = profile['db_time'] * 1000
+    threshold = app.config['SQL_N_PLUS_ONE_THRESHOLD']
+    repeated = {fingerprint: count for fingerprint, count in profile['fingerprints'].items() if count >= threshold}
+    endpoint = request.endpoint or request.path
+
+    response.headers['X-SQL-Queries'] = str(statements)
+    response.headers['Server-Timing'] = f'db;dur={db_time_ms:.2f};desc="{statements} queries"'
+
+    if repeated:
+        app.logger.warning("Possible N+1 in %s: %s", endpoint, repeated)
+
+    with sql_profile_lock:
+        stats = sql_profile_stats.setdefault(endpoint, {'requests': 0, 'statements': 0, 'max_statements': 0, 'db_time_ms': 0.0, 'repeated': Counter()})
+        stats['requests'] += 1
+        stats['statements'] += statements
+        stats['max_statements'] = max(stats['max_statements'], statements)
+        stats['db_time_ms'] += db_time_ms
+        stats['repeated'].update(repeated)
+
+    # Budgets describe page renders; form submissions legitimately do more work.
+    view = app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', app.config['SQL_QUERY_BUDGET'])
+    if request.method == 'GET' and budget is not None and statements > budget:
+        message = f"{endpoint} issued {statements} SQL statements (budget {budget})"
+        if app.config['SQL_QUERY_BUDGET_RAISE']:
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+
+    return response
+
+def enable_sql_profiling():
+    # Nothing is hooked up unless SQL_PROFILING is on, so the disabled path costs nothing.
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+    app.before_request(start_sql_profile)
+    app.after_request(finish_sql_profile)
+
 def calculate_average_rating(song_id):
     song = Song.query.get(song_id)
     return song.average_rating
 
+user_cache = {}
+user_cache_lock = threading.Lock()
+
+def load_user(user_id):
+    # With USER_CACHE_TTL set, users are kept as detached snapshots and merged back without a SELECT.
+    ttl = app.config['USER_CACHE_TTL']
+    if ttl:
+        with user_cache_lock:
+            entry = user_cache.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            return db.session.merge(entry[1], load=False)
+
+    user = db.session.get(User, user_id)
+
+    if user and ttl:
+        snapshot = User(id=user.id, username=user.username, password_hash=user.password_hash,
+                        isadmin=user.isadmin, iscreate=user.iscreate, isban=user.isban)
+        make_transient_to_detached(snapshot)
+        with user_cache_lock:
+            user_cache[user_id] = (time.monotonic() + ttl, snapshot)
+    return user
+
+def invalidate_user_cache(user_id):
+    with user_cache_lock:
+        user_cache.pop(user_id, None)
+
+def current_user():
+    # Resolved once per request and kept on flask.g.
+    if 'current_user' not in g:
+        user = None
+        user_id = session.get('user_id')
+
+        if user_id is not None:
+            user = load_user(user_id)
+        elif session.get('username'):
+            # Sessions created before user_id was stored only carry the username.
+            user = User.query.filter_by(username=session['username']).first()
+            if user:
+                session['user_id'] = user.id
+
+        g.current_user = user
+    return g.current_user
+
+def is_admin():
+    user = current_user()
+    return bool(user and user.isadmin == 1)
+
+def require_admin():
+    if not is_admin():
+        abort(403)
+
 def user_has_rated(song_id):
-    user = User.query.filter_by(username=session.get('username')).first()
+    user = current_user()
     if user:
         return Rating.query.filter_by(user_id=user.id, song_id=song_id).first() is not None
     return False
 
+class CredentialServiceBusy(Exception):
+    pass
+
+hash_executor = None
+hash_slots = None
+hash_executor_lock = threading.Lock()
+
+def run_hash(func, *args):
+    # Hashing runs in a small process pool, so a login burst can use at most HASH_WORKERS cores per web worker
+    # while the request threads keep serving pages. A few hashes may queue per process; past that the caller
+    # gets CredentialServiceBusy. HASH_WORKERS = 0 hashes inline.
+    global hash_executor, hash_slots
+    workers = app.config['HASH_WORKERS']
+    if workers == 0:
+        return func(*args)
+
+    with hash_executor_lock:
+        if hash_executor is None:
+            hash_executor = ProcessPoolExecutor(max_workers=workers)
+            hash_slots = threading.BoundedSemaphore(workers * 4)
+
+    if not hash_slots.acquire(timeout=app.config['HASH_QUEUE_TIMEOUT']):
+        raise CredentialServiceBusy()
+    try:
+        return hash_executor.submit(func, *args).result()
+    finally:
+        hash_slots.release()
+
+def hash_password(password):
+    return run_hash(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+@lru_cache(maxsize=None)
+def password_hash_prefix(method):
+    # werkzeug stores the expanded method ('scrypt' becomes 'scrypt:32768:8:1'), so hash once to learn it.
+    return generate_password_hash('', method).split('$', 1)[0]
+
+def verify_credentials(user, password):
+    # Hashes made with an older method or work factor are upgraded on the first successful login.
+    if not run_hash(check_password_hash, user.password_hash, password):
+        return False
+
+    if user.password_hash.split('$', 1)[0] != password_hash_prefix(app.config['PASSWORD_HASH_METHOD']):
+        user.password_hash = hash_password(password)
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error: {e}")
+        invalidate_user_cache(user.id)
+    return True
+
+login_buckets = {}
+login_buckets_lock = threading.Lock()
+
+def take_login_tokens(*buckets):
+    # Token buckets keyed by username and client address, each given as (key, burst, per_minute).
+    # An attempt spends one token from every bucket, and is refused before any hashing if one is empty.
+    now = time.monotonic()
+    with login_buckets_lock:
+        levels = []
+        for key, burst, per_minute in buckets:
+            tokens, stamp = login_buckets.get(key, (burst, now))
+            levels.append(min(burst, tokens + (now - stamp) * per_minute / 60))
+
+        allowed = all(level >= 1 for level in levels)
+        for (key, burst, per_minute), level in zip(buckets, levels):
+            login_buckets[key] = (level - 1 if allowed else level, now)
+
+        if len(login_buckets) > app.config['LOGIN_BUCKETS_MAX']:
+            # Drop the oldest half; a bucket left alone that long has refilled anyway.
+            oldest = sorted(login_buckets.items(), key=lambda item: item[1][1])
+            for key, _ in oldest[:len(oldest) // 2]:
+                del login_buckets[key]
+    return allowed
+
+def login_allowed(username):
+    return take_login_tokens(
+        (('user', username), app.config['LOGIN_USER_BURST'], app.config['LOGIN_USER_PER_MINUTE']),
+        (('ip', request.remote_addr), app.config['LOGIN_IP_BURST'], app.config['LOGIN_IP_PER_MINUTE']),
+    )
+
+THROTTLED_MESSAGE = "Too many login attempts. Please wait a minute and try again."
+BUSY_MESSAGE = "The server is busy. Please try again in a moment."
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -129,6 +1422,7 @@ def index():
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     error = None
+    status = 200
 
     if request.method == 'POST':
         username = request.form['username']
@@ -136,48 +1430,60 @@ def register():
 
         existing_user = User.query.filter_by(username=username).first()
 
-        if existing_user is None:
-            new_user = User(username=username, password=password, isadmin=0)
-            db.session.add(new_user)
-
+        if existing_user is not None:
+            error = "Username already exists. Please choose a different one."
+        elif not take_login_tokens((('ip', request.remote_addr), app.config['LOGIN_IP_BURST'], app.config['LOGIN_IP_PER_MINUTE'])):
+            error, status = THROTTLED_MESSAGE, 429
+        else:
             try:
+                new_user = User(username=username, password_hash=hash_password(password), isadmin=0)
+                db.session.add(new_user)
                 db.session.commit()
                 flash(f"Registration successful! Welcome, {username}!")
+            except CredentialServiceBusy:
+                error, status = BUSY_MESSAGE, 503
             except Exception as e:
                 db.session.rollback()
                 flash("An error occurred. Please try again.")
                 print(f"Error: {e}")
-        else:
-            error = "Username already exists. Please choose a different one."
 
-    return render_template('register.html', error=error)
+    return render_template('register.html', error=error), status
 
 @app.route('/login/user', methods=['GET', 'POST'])
 def login_user():
     error = None
+    status = 200
 
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
 
+        # username is unique, so this lookup is served by its index.
         user = User.query.filter_by(username=username, isadmin=0).first()
 
-        if user:
-            if user.isban == 1:
-                error = "Account has been banned. Please contact support for further assistance."
-            elif user.verify_password(password):
-                session['username'] = username
-                return redirect(url_for('user_dashboard'))
-            else:
-                error = "Invalid username or password. Please try again."
+        if not login_allowed(username):
+            error, status = THROTTLED_MESSAGE, 429
+        elif user:
+            try:
+                if user.isban == 1:
+                    error = "Account has been banned. Please contact support for further assistance."
+                elif verify_credentials(user, password):
+                    session['username'] = username
+                    session['user_id'] = user.id
+                    return redirect(url_for('user_dashboard'))
+                else:
+                    error = "Invalid username or password. Please try again."
+            except CredentialServiceBusy:
+                error, status = BUSY_MESSAGE, 503
         else:
             error = "Invalid username or password. Please try again."
 
-    return render_template('login.html', error=error, is_user_login=True)
+    return render_template('login.html', error=error, is_user_login=True), status
 
 @app.route('/login/admin', methods=['GET', 'POST'])
 def login_admin():
     error = None
+    status = 200
 
     if request.method == 'POST':
         username = request.form['username']
@@ -185,27 +1491,35 @@ def login_admin():
 
         admin = User.query.filter_by(username=username, isadmin=1).first()
 
-        if admin and admin.verify_password(password):
-            return redirect(url_for('admin_dashboard'))
+        if not login_allowed(username):
+            error, status = THROTTLED_MESSAGE, 429
         else:
-            error = "Invalid username or password. Please try again."
+            try:
+                if admin and verify_credentials(admin, password):
+                    session['username'] = username
+                    session['user_id'] = admin.id
+                    return redirect(url_for('admin_dashboard'))
+                else:
+                    error = "Invalid username or password. Please try again."
+            except CredentialServiceBusy:
+                error, status = BUSY_MESSAGE, 503
 
-    return render_template('login.html', error=error, is_admin_login=True)
+    return render_template('login.html', error=error, is_admin_login=True), status
 
 @app.route('/dashboard/user', methods=['GET', 'POST'])
 def user_dashboard():
-    username = session.get('username')
-
-    if username:
-        user = User.query.filter_by(username=username).first()
+    user = current_user()
 
+    if user:
+        username = user.username
         form = JoinAsCreatorForm()
 
-        if request.method == 'POST' and user and user.iscreate == 0 and form.validate_on_submit():
+        if request.method == 'POST' and user.iscreate == 0 and form.validate_on_submit():
             user.iscreate = 1
 
             try:
                 db.session.commit()
+                invalidate_user_cache(user.id)
                 flash("Congratulations! You've joined the platform as a creator.")
             except Exception as e:
                 db.session.rollback()
@@ -214,66 +1528,73 @@ def user_dashboard():
 
             return redirect(url_for('user_dashboard'))
 
-        songs = Song.query.all()
-        albums = Album.query.all()
-
-        return render_template('user_dashboard.html', username=username, is_creator=user.iscreate, form=form, songs=songs, albums=albums)
+        songs_after = request.args.get('songs_after')
+        if songs_after:
+            songs, songs_next = keyset_page(db.session.query(Song.id, Song.title, Song.artist, Song.rating_avg),
+                                            [Song.rating_avg, Song.id], songs_after, descending=True)
+        else:
+            # The first page is the cached top-rated ranking; later pages continue from its cursor.
+            page_size = app.config['PAGE_SIZE']
+            songs, songs_next = page_from_rows(top_songs(page_size + 1), [Song.rating_avg, Song.id], page_size)
+        albums, albums_next = keyset_page(db.session.query(Album.id, Album.name, Album.artist), [Album.id], request.args.get('albums_after'))
+        recommended = recommended_songs(user.id)
+
+        if wants_json():
+            return jsonify(songs=rows_to_dicts(songs), songs_next=songs_next, albums=rows_to_dicts(albums), albums_next=albums_next,
+                           recommended=rows_to_dicts(recommended))
+
+        return render_template('user_dashboard.html', username=username, is_creator=user.iscreate, form=form, songs=songs, albums=albums,
+                               songs_next=songs_next, albums_next=albums_next, recommended=recommended)
     else:
         return redirect(url_for('login_user'))
 
 @app.route('/dashboard/creator', methods=['GET', 'POST'])
+@query_budget(5)
 def creator_dashboard():
-    creator = User.query.filter_by(username=session.get('username')).first()
+    creator = current_user()
 
     if creator and creator.iscreate == 1:
         songs = Song.query.filter_by(artist=creator.username).all()
         form = CreatorDashboardForm()
-        albums = Album.query.filter_by(artist=creator.username).all()
+        albums = Album.query.filter_by(artist=creator.username).options(selectinload(Album.songs).load_only(Song.id, Song.title)).all()
           
         if form.validate_on_submit():
-            print("Form submitted successfully!")
-            print(f"Title: {form.title.data}")
-            print(f"Artist: {form.artist.data}")
-            print(f"Lyrics: {form.lyrics.data}")
-            print(f"MP3 File: {form.mp3.data.filename}")
-
-            max_song_id = db.session.query(db.func.max(Song.id)).scalar()
-            new_song_id = 1 if max_song_id is None else max_song_id + 1
-
-            mp3_file = form.mp3.data.read()
+            app.logger.debug("Upload form submitted by %s: %r", creator.username, form.title.data)
 
-            new_song = Song(
-                id=new_song_id,
-                title=form.title.data,
-                artist=creator.username,
-                lyrics=form.lyrics.data,
-                mp3_binary=mp3_file
-            )
-
-            db.session.add(new_song)
+            if not form.mp3.data:
+                flash("Please choose an MP3 file.")
+                return redirect(url_for('creator_dashboard'))
 
             try:
-                db.session.commit()
-                flash("Song uploaded successfully!")
-            except Exception as e:
-                db.session.rollback()
-                flash("An error occurred. Please try again.")
-                print(f"Error: {e}")
+                tmp_path = spool_upload(form.mp3.data.stream)
+            except UploadRejected as e:
+                flash(str(e))
+                if wants_json():
+                    return jsonify(error=str(e)), 400
+                return redirect(url_for('creator_dashboard'))
+
+            job_id = submit_job('upload', process_upload, tmp_path, form.title.data, creator.username, form.lyrics.data,
+                                owner_id=creator.id, description=form.title.data)
+            flash("Song upload received, it will appear once processing finishes.")
 
+            if wants_json():
+                return jsonify(job_id=job_id, status_url=url_for('job_status', job_id=job_id)), 202
             return redirect(url_for('creator_dashboard'))
 
-        else:
-            print("Form validation errors:")
-            print(form.errors)
+        elif form.errors:
+            app.logger.info("Upload form from %s rejected: %s", creator.username, form.errors)
+
+        upload_jobs = BackgroundJob.query.filter(BackgroundJob.owner_id == creator.id, BackgroundJob.kind == 'upload',
+                                                 BackgroundJob.status != 'done').order_by(BackgroundJob.created_at.desc()).limit(10).all()
 
-        return render_template('creator_dashboard.html', form=form, songs=songs, albums=albums)
+        return render_template('creator_dashboard.html', form=form, songs=songs, albums=albums, upload_jobs=upload_jobs)
 
     else:
         return redirect(url_for('login_user'))
 
 @app.route('/dashboard/creator/modify/<int:song_id>', methods=['GET', 'POST'])
 def modify_song(song_id):
-    creator = User.query.filter_by(username=session.get('username')).first()
+    creator = current_user()
 
     if creator and creator.iscreate == 1:
         song_to_modify = Song.query.get(song_id)
@@ -282,23 +1603,22 @@ def modify_song(song_id):
             form = CreatorDashboardForm(obj=song_to_modify)
 
             if form.validate_on_submit():
-                print("Form submitted successfully!")
-                print(f"Title: {form.title.data}")
-                print(f"Artist: {form.artist.data}")
-                print(f"Lyrics: {form.lyrics.data}")
-                
+                app.logger.debug("Edit of song %s submitted by %s: %r", song_id, creator.username, form.title.data)
+
                 song_to_modify.title = form.title.data
                 song_to_modify.lyrics = form.lyrics.data
+                index_songs([song_id])
+                index_albums(album_ids_for_songs([song_id]))
 
-                
                 db.session.commit()
+                invalidate_rankings()
+                invalidate_pages('songs', f'song:{song_id}')
                 flash("Song updated successfully!")
 
                 return redirect(url_for('creator_dashboard'))
 
-            else:
-                print("Form validation errors:")
-                print(form.errors)
+            elif form.errors:
+                app.logger.info("Edit of song %s by %s rejected: %s", song_id, creator.username, form.errors)
 
             return render_template('modify_song.html', form=form, song_id=song_id)
 
@@ -311,15 +1631,17 @@ def modify_song(song_id):
     
 @app.route('/dashboard/creator/delete/<int:song_id>', methods=['GET'])
 def delete_song(song_id):
-    creator = User.query.filter_by(username=session.get('username')).first()
+    creator = current_user()
 
     if creator and creator.iscreate == 1:
         song_to_delete = Song.query.get(song_id)
 
         if song_to_delete and song_to_delete.artist == creator.username:
             try:
-                db.session.delete(song_to_delete)
+                stale_pages = delete_songs_cascade([song_id])
                 db.session.commit()
+                invalidate_rankings()
+                invalidate_pages(*stale_pages)
                 flash("Song deleted successfully!")
             except Exception as e:
                 db.session.rollback()
@@ -330,10 +1652,10 @@ def delete_song(song_id):
 
 @app.route('/dashboard/creator/create_album', methods=['GET', 'POST'])
 def create_album():
-    creator = User.query.filter_by(username=session.get('username')).first()
+    creator = current_user()
 
     if creator and creator.iscreate == 1:
-        user_songs = Song.query.filter_by(artist=creator.username).all()
+        user_songs = db.session.query(Song.id, Song.title).filter_by(artist=creator.username).all()
 
         form = CreateAlbumForm()
         form.songs.choices = [(song.id, song.title) for song in user_songs]
@@ -345,12 +1667,15 @@ def create_album():
             db.session.commit()
 
             selected_song_ids = form.songs.data
-            selected_songs = Song.query.filter(Song.id.in_(selected_song_ids)).all()
+            selected_songs = Song.query.options(load_only(Song.id)).filter(Song.id.in_(selected_song_ids)).all()
 
             new_album.songs.extend(selected_songs)
+            index_albums([new_album.id])
 
             try:
                 db.session.commit()
+                invalidate_rankings()
+                invalidate_pages('albums', f'album:{new_album.id}')
                 flash("Album created successfully!")
             except Exception as e:
                 db.session.rollback()
@@ -366,25 +1691,28 @@ def create_album():
 
 @app.route('/dashboard/creator/modify_album/<int:album_id>', methods=['GET', 'POST'])
 def modify_album(album_id):
-    creator = User.query.filter_by(username=session.get('username')).first()
+    creator = current_user()
 
     if creator and creator.iscreate == 1:
         album_to_modify = Album.query.get(album_id)
 
         if album_to_modify and album_to_modify.artist == creator.username:
             form = CreateAlbumForm()
-            user_songs = Song.query.filter_by(artist=creator.username).all()
+            user_songs = db.session.query(Song.id, Song.title).filter_by(artist=creator.username).all()
             form.songs.choices = [(song.id, song.title) for song in user_songs]
 
             if request.method == 'POST' and form.validate_on_submit():
                 album_to_modify.name = form.name.data
                 album_to_modify.songs.clear()
                 selected_song_ids = form.songs.data
-                selected_songs = Song.query.filter(Song.id.in_(selected_song_ids)).all()
+                selected_songs = Song.query.options(load_only(Song.id)).filter(Song.id.in_(selected_song_ids)).all()
                 album_to_modify.songs.extend(selected_songs)
+                index_albums([album_id])
 
                 try:
                     db.session.commit()
+                    invalidate_rankings()
+                    invalidate_pages('albums', f'album:{album_id}')
                     flash("Album updated successfully!")
                 except Exception as e:
                     db.session.rollback()
@@ -394,7 +1722,7 @@ def modify_album(album_id):
                 return redirect(url_for('creator_dashboard'))
 
             form.name.data = album_to_modify.name
-            form.songs.data = [song.id for song in album_to_modify.songs]
+            form.songs.data = [row.song_id for row in db.session.query(album_song_association.c.song_id).filter_by(album_id=album_id)]
 
             return render_template('modify_album.html', form=form, album_id=album_id)
 
@@ -402,15 +1730,17 @@ def modify_album(album_id):
 
 @app.route('/dashboard/creator/delete_album/<int:album_id>', methods=['GET'])
 def delete_album(album_id):
-    creator = User.query.filter_by(username=session.get('username')).first()
+    creator = current_user()
 
     if creator and creator.iscreate == 1:
         album_to_delete = Album.query.get(album_id)
 
         if album_to_delete and album_to_delete.artist == creator.username:
             try:
-                db.session.delete(album_to_delete)
+                stale_pages = delete_albums_cascade([album_id])
                 db.session.commit()
+                invalidate_rankings()
+                invalidate_pages(*stale_pages)
                 flash("Album deleted successfully!")
             except Exception as e:
                 db.session.rollback()
@@ -423,27 +1753,90 @@ def delete_album(album_id):
 
 @app.route('/dashboard/admin', methods=['GET', 'POST'])
 def admin_dashboard():
-    total_users = User.query.filter_by(isadmin=0 ,isban =0).count()
-    total_creators = User.query.filter_by(iscreate=1 ,isban =0).count()
-    total_songs = Song.query.count()
-    total_albums = Album.query.count()
-
-    return render_template('admin_dashboard.html', total_users=total_users, total_creators=total_creators, total_songs=total_songs, total_albums=total_albums)
+    # One round trip for all four tiles.
+    count = db.func.count()
+    total_users, total_creators, total_songs, total_albums = db.session.query(
+        select(count).select_from(User).where(User.isadmin == 0, User.isban == 0).scalar_subquery(),
+        select(count).select_from(User).where(User.iscreate == 1, User.isban == 0).scalar_subquery(),
+        select(count).select_from(Song).scalar_subquery(),
+        select(count).select_from(Album).scalar_subquery(),
+    ).one()
+    recover_stale_jobs()
+    moderation_jobs = BackgroundJob.query.filter(BackgroundJob.kind.in_(MODERATION_JOBS)).order_by(BackgroundJob.created_at.desc()).limit(10).all()
+    # Only jobs whose worker is still alive keep the page refreshing.
+    live_since = datetime.utcnow() - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+    moderation_active = any(job.status in ('pending', 'running') and job.heartbeat_at >= live_since for job in moderation_jobs)
+
+    if wants_json():
+        return jsonify(total_users=total_users, total_creators=total_creators, total_songs=total_songs, total_albums=total_albums,
+                       moderation_jobs=[job.to_dict() for job in moderation_jobs])
+
+    return render_template('admin_dashboard.html', total_users=total_users, total_creators=total_creators, total_songs=total_songs, total_albums=total_albums,
+                           moderation_jobs=moderation_jobs, moderation_active=moderation_active)
+
+@app.route('/dashboard/admin/analytics', methods=['GET'])
+def admin_analytics():
+    last_day = datetime.utcnow().date()
+    first_day = last_day - timedelta(days=app.config['ANALYTICS_DAYS'] - 1)
+    stored = {row.day: row for row in DailyStat.query.filter(DailyStat.day >= first_day).all()}
+
+    days = [first_day + timedelta(days=offset) for offset in range((last_day - first_day).days + 1)]
+    series = {name: [getattr(stored[day], name) if day in stored else 0 for day in days] for name in ('plays', 'uploads', 'ratings', 'active_users')}
+    top_creators = db.session.query(CreatorStat.artist, CreatorStat.plays, CreatorStat.uploads, CreatorStat.ratings) \
+        .order_by(CreatorStat.plays.desc()).limit(10).all()
+
+    if wants_json():
+        return jsonify(days=[day.isoformat() for day in days], series=series, top_creators=rows_to_dicts(top_creators), dropped_events=analytics_dropped)
+
+    return render_template('admin_analytics.html', days=[day.isoformat() for day in days], series=series, top_creators=top_creators)
+
+@app.route('/dashboard/admin/cache_stats', methods=['GET'])
+def cache_stats():
+    stats = get_page_cache().stats()
+    lookups = stats.get('hits', 0) + stats.get('misses', 0)
+    stats['hit_rate'] = stats.get('hits', 0) / lookups if lookups else None
+    return jsonify(enabled=app.config['PAGE_CACHE_ENABLED'], **stats)
+
+@app.route('/dashboard/admin/sql_profile', methods=['GET'])
+def sql_profile():
+    with sql_profile_lock:
+        stats = sorted(((endpoint, dict(values, repeated=values['repeated'].most_common(5))) for endpoint, values in sql_profile_stats.items()),
+                       key=lambda item: item[1]['statements'] / item[1]['requests'], reverse=True)
+
+    if wants_json():
+        return jsonify(enabled=app.config['SQL_PROFILING'], endpoints=dict(stats))
+
+    return render_template('sql_profile.html', stats=stats, enabled=app.config['SQL_PROFILING'])
 
 @app.route('/user_list', methods=['GET', 'POST'])
 def user_list():
-    users = User.query.all()
-    return render_template('user_list.html', users=users)
+    query = db.session.query(User.id, User.username, User.isadmin, User.iscreate, User.isban).filter_by(isadmin=0, isban=0)
+    users, next_cursor = keyset_page(query, [User.id], request.args.get('after'))
+
+    if wants_json():
+        return jsonify(users=rows_to_dicts(users), next_cursor=next_cursor)
+
+    return render_template('user_list.html', users=users, next_cursor=next_cursor)
 
 @app.route('/song_list', methods=['GET', 'POST'])
+@cached_page('songs')
 def song_list():
-    songs = Song.query.all()
-    return render_template('song_list.html', songs=songs)
+    songs, next_cursor = keyset_page(db.session.query(Song.id, Song.title, Song.artist), [Song.id], request.args.get('after'))
+
+    if wants_json():
+        return jsonify(songs=rows_to_dicts(songs), next_cursor=next_cursor)
+
+    return render_template('song_list.html', songs=songs, next_cursor=next_cursor, is_admin=is_admin())
 
 @app.route('/album_list', methods=['GET', 'POST'])
+@cached_page('albums')
 def album_list():
-    albums = Album.query.all()
-    return render_template('album_list.html', albums=albums)
+    albums, next_cursor = keyset_page(db.session.query(Album.id, Album.name, Album.artist), [Album.id], request.args.get('after'))
+
+    if wants_json():
+        return jsonify(albums=rows_to_dicts(albums), next_cursor=next_cursor)
+
+    return render_template('album_list.html', albums=albums, next_cursor=next_cursor, is_admin=is_admin())
 
 @app.route('/ban_user/<int:user_id>', methods=['POST'])
 def ban_user(user_id):
@@ -452,91 +1845,552 @@ def ban_user(user_id):
     if user_to_ban:
         user_to_ban.isban = 1
 
-        if user_to_ban.iscreate == 1:
-            Song.query.filter_by(artist=user_to_ban.username).delete()
-            Album.query.filter_by(artist=user_to_ban.username).delete()
-
     try:
         db.session.commit()
+        invalidate_user_cache(user_id)
         flash("User banned successfully!")
     except Exception as e:
         db.session.rollback()
         flash("An error occurred. Please try again.")
         print(f"Error: {e}")
+        return redirect(url_for('user_list'))
+
+    # The ban applies at once; a creator's songs and albums are removed in the background.
+    if user_to_ban and user_to_ban.iscreate == 1:
+        submit_moderation_job('ban', remove_creator_content, user_to_ban.username, f"Remove content of {user_to_ban.username}")
+        return redirect(url_for('admin_dashboard'))
 
     return redirect(url_for('user_list'))
 
 @app.route('/dashboard/admin/delete/<int:song_id>', methods=['GET'])
 def delete_song2(song_id):
-    song_to_delete = Song.query.get(song_id)
-    try:
-        db.session.delete(song_to_delete)
-        db.session.commit()
-        flash("Song deleted successfully!")
-    except Exception as e:
-        db.session.rollback()
-        flash("An error occurred. Please try again.")
-        print(f"Error: {e}")
-
-    return redirect(url_for('song_list'))
+    submit_moderation_job('delete_songs', delete_songs_task, [song_id], f"Delete song {song_id}")
+    flash("Song deletion started.")
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/dashboard/admin/delete_songs', methods=['POST'])
+def delete_songs2():
+    require_admin()
+    song_ids = request.form.getlist('song_ids', type=int)
+    if song_ids:
+        submit_moderation_job('delete_songs', delete_songs_task, song_ids, f"Delete {len(song_ids)} songs")
+        flash("Song deletion started.")
+    return redirect(url_for('admin_dashboard'))
 
 @app.route('/dashboard/admin/delete_album/<int:album_id>', methods=['GET'])
 def delete_album2(album_id):
-    album_to_delete = Album.query.get(album_id)
+    submit_moderation_job('delete_albums', delete_albums_task, [album_id], f"Delete album {album_id}")
+    flash("Album deletion started.")
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/dashboard/admin/delete_albums', methods=['POST'])
+def delete_albums2():
+    require_admin()
+    album_ids = request.form.getlist('album_ids', type=int)
+    if album_ids:
+        submit_moderation_job('delete_albums', delete_albums_task, album_ids, f"Delete {len(album_ids)} albums")
+        flash("Album deletion started.")
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/song/<int:song_id>', methods=['GET'])
+def song_details(song_id):
+    # The song card is the same for everyone; only the rating form depends on the user.
+    song_card = cached_fragment(f'song_card:{song_id}', [f'song:{song_id}'], lambda: render_song_card(song_id))
+    has_rated = user_has_rated(song_id) 
+
+    return render_template('song_details.html', song_id=song_id, song_card=song_card, has_rated=has_rated,is_admin=is_admin())
+
+def render_song_card(song_id):
+    song = Song.query.get(song_id)
+    if not song:
+        abort(404)
+
+    average_rating = calculate_average_rating(song_id) 
+    has_mp3 = song.mp3_hash is not None or bool(db.session.query(db.func.length(Song.mp3_binary)).filter(Song.id == song_id).scalar())
+
+    return render_template('song_card.html', song=song, average_rating=average_rating, has_mp3=has_mp3, similar=similar_songs(song_id))
+
+def open_mp3_blob(dbapi_connection, song_id):
+    # Incremental BLOB I/O reads only the bytes asked for; SUBSTR on a BLOB loads the whole value for every chunk.
+    try:
+        return dbapi_connection.blobopen('song', 'mp3_binary', song_id, readonly=True)
+    except sqlite3.OperationalError:
+        # No such song, or its audio is not stored in the database.
+        return None
+
+def read_blob_chunks(blob, start, end):
+    # Stream from one BLOB handle a chunk at a time, so a stream never holds more than one chunk. Seeking is only cheap
+    # within an open handle (SQLite walks the overflow pages to reach an offset), so don't reopen it per chunk.
+    chunk_size = app.config['MP3_CHUNK_SIZE']
+    with blob:
+        blob.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = blob.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def read_mp3_chunks(song_id, start, end):
+    blob = open_mp3_blob(db.session.connection().connection.dbapi_connection, song_id)
+    if blob is not None:
+        yield from read_blob_chunks(blob, start, end)
+
+rendition_executor = None
+renditions_in_flight = {}
+renditions_lock = threading.Lock()
+encoder_missing = False
+
+def requested_quality(args, headers):
+    # An explicit ?quality= wins; otherwise the Save-Data and ECT client hints ask for a smaller rendition.
+    if 'quality' in args:
+        return args['quality']
+    if headers.get('Save-Data', '').lower() == 'on' or headers.get('ECT') in ('slow-2g', '2g'):
+        return 'low'
+    if headers.get('ECT') == '3g':
+        return 'medium'
+    return None
+
+def rendition_path(digest, kbps):
+    return os.path.join(app.config['RENDITION_CACHE_PATH'], digest[:2], f'{digest}-{kbps}k.mp3')
+
+def encoder_command(source, target, kbps):
+    encoder = app.config['RENDITION_ENCODER']
+    if os.path.basename(encoder).startswith('lame'):
+        return [encoder, '--quiet', '--mp3input', '-b', str(kbps), source, target]
+    return [encoder, '-nostdin', '-loglevel', 'error', '-y', '-i', source, '-map', '0:a:0',
+            '-codec:a', 'libmp3lame', '-b:a', f'{kbps}k', '-f', 'mp3', target]
+
+def evict_renditions():
+    # LRU by mtime, which serving a rendition bumps. Trims to 90% of the quota so eviction doesn't run on every encode.
+    files = []
+    for dirpath, dirnames, filenames in os.walk(app.config['RENDITION_CACHE_PATH']):
+        for filename in filenames:
+            if filename.endswith('.mp3'):
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for mtime, size, path in files)
+    if total <= app.config['RENDITION_CACHE_MAX_BYTES']:
+        return
+
+    for mtime, size, path in sorted(files):
+        if total <= app.config['RENDITION_CACHE_MAX_BYTES'] * 0.9:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def transcode(source, target, kbps):
+    # Runs on the rendition pool. An O_EXCL lock file next to the target stops other gunicorn workers from
+    # encoding the same rendition; they wait for it instead. The encoder writes to a temp file that is
+    # renamed into place, so a rendition is never served half-written.
+    global encoder_missing
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    lock = f'{target}.lock'
+    deadline = time.monotonic() + app.config['RENDITION_TIMEOUT']
+
+    while True:
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            if os.path.exists(target):
+                return True
+            try:
+                stale = time.time() - os.stat(lock).st_mtime > app.config['RENDITION_TIMEOUT']
+            except FileNotFoundError:
+                continue
+            if stale:
+                # Left behind by a worker that died mid-encode.
+                try:
+                    os.remove(lock)
+                except FileNotFoundError:
+                    pass
+            elif time.monotonic() > deadline:
+                return False
+            else:
+                time.sleep(0.1)
+
+    temporary = f'{target}.{uuid.uuid4().hex}.tmp'
+    try:
+        if os.path.exists(target):
+            return True
+        subprocess.run(encoder_command(source, temporary, kbps), check=True, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=app.config['RENDITION_TIMEOUT'])
+        os.replace(temporary, target)
+    except FileNotFoundError:
+        encoder_missing = True
+        print(f"Error: {app.config['RENDITION_ENCODER']} not found; serving original files only.")
+        return False
+    except (subprocess.SubprocessError, OSError) as e:
+        print(f"Error: transcoding {source} to {kbps} kbps failed: {getattr(e, 'stderr', None) or e}")
+        return False
+    finally:
+        for path in (temporary, lock):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    evict_renditions()
+    return True
+
+def run_transcode(source, target, kbps):
+    try:
+        return transcode(source, target, kbps)
+    finally:
+        with renditions_lock:
+            renditions_in_flight.pop(target, None)
+
+def rendition_for(digest, source_bitrate, quality):
+    # Path of the cached rendition, or None to serve the original: no such quality, a source already at or
+    # below that bitrate, no encoder, or an encode that is still running after RENDITION_WAIT_SECONDS.
+    # Concurrent requests for the same uncached rendition share one encode.
+    kbps = app.config['RENDITION_BITRATES'].get(quality)
+    if not kbps or (source_bitrate and source_bitrate <= kbps) or encoder_missing:
+        return None
+
+    path = rendition_path(digest, kbps)
+    try:
+        if time.time() - os.stat(path).st_mtime > 60:
+            os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+
+    global rendition_executor
+    with renditions_lock:
+        if rendition_executor is None:
+            rendition_executor = ThreadPoolExecutor(max_workers=app.config['RENDITION_WORKERS'], thread_name_prefix='rendition')
+        future = renditions_in_flight.get(path)
+        if future is None:
+            future = rendition_executor.submit(run_transcode, mp3_store_path(digest), path, kbps)
+            renditions_in_flight[path] = future
+
+    try:
+        return path if future.result(timeout=app.config['RENDITION_WAIT_SECONDS']) else None
+    except FutureTimeoutError:
+        return None
+
+def stored_audio(song_id):
+    # The database half of audio_source: the song row, without choosing a file. Blob store songs carry their
+    # digest and bitrate for audio_file(); rows whose audio is still in the database are complete already.
+    stored = db.session.query(Song.title, Song.mp3_hash, Song.uploaded_at, Song.bitrate).filter(Song.id == song_id).first()
+    last_modified = stored.uploaded_at.replace(microsecond=0, tzinfo=timezone.utc) if stored and stored.uploaded_at else None
+
+    if stored and stored.mp3_hash:
+        return {'title': stored.title, 'digest': stored.mp3_hash, 'bitrate': stored.bitrate, 'last_modified': last_modified}
+
+    size = db.session.query(db.func.length(Song.mp3_binary)).filter(Song.id == song_id).scalar()
+    if not size:
+        return None
+
+    etag = f'mp3-{song_id}-{size}'
+    if last_modified:
+        etag = f'{etag}-{int(last_modified.timestamp())}'
+    return {'title': stored.title, 'digest': None, 'path': None, 'size': size, 'etag': etag, 'last_modified': last_modified}
+
+def audio_file(source, quality=None):
+    # The file half of audio_source: the original or a rendition of a blob store song. No queries, but it may
+    # wait up to RENDITION_WAIT_SECONDS for an encode.
+    if not source['digest']:
+        return source
+    path = rendition_for(source['digest'], source['bitrate'], quality) or mp3_store_path(source['digest'])
+    return dict(source, path=path, size=os.path.getsize(path), etag=os.path.basename(path)[:-4])
+
+def audio_source(song_id, quality=None):
+    # Where a song's audio is read from: path is a blob store file or rendition, or None for rows whose
+    # audio is still in the database. Returns None when the song has no audio.
+    source = stored_audio(song_id)
+    return audio_file(source, quality) if source else None
+
+def audio_range(req, source):
+    # Evaluates a werkzeug request's conditional and Range headers against an audio source.
+    # Returns (status, start, end): 304 and 416 carry no body, 206 and 200 serve bytes start..end.
+    etag, last_modified, size = source['etag'], source['last_modified'], source['size']
+
+    if req.if_none_match.contains(etag) or (not req.if_none_match and last_modified and req.if_modified_since and last_modified <= req.if_modified_since):
+        return 304, 0, 0
+
+    byte_range = req.range
+    if_range = req.if_range
+    if byte_range and (if_range.etag or if_range.date):
+        if not (if_range.etag == etag or (if_range.date and last_modified and if_range.date == last_modified)):
+            byte_range = None
+
+    if not byte_range:
+        return 200, 0, size
+    span = byte_range.range_for_length(size)
+    if span is None:
+        return 416, 0, 0
+    return 206, span[0], span[1]
+
+def send_song_audio(song_id, user_id):
+    # Shared by get_mp3 and the signed /stream URLs: conditional and range requests, plays counted for user_id.
+    source = audio_source(song_id, requested_quality(request.args, request.headers))
+    if source is None:
+        abort(404)
+
+    if source['path']:
+        response = send_file(source['path'], mimetype='audio/mp3', download_name=f"{source['title']}.mp3", conditional=True,
+                             etag=source['etag'], last_modified=source['last_modified'])
+        start = request.range.ranges[0][0] if request.range else 0
+    else:
+        # Rows that have not been moved to the blob store yet are streamed out of the database.
+        status, start, end = audio_range(request, source)
+        if status == 416:
+            response = Response(status=416)
+            response.headers['Content-Range'] = f"bytes */{source['size']}"
+            return response
+
+        if status == 304:
+            response = Response(status=304)
+        else:
+            response = Response(stream_with_context(read_mp3_chunks(song_id, start, end)), status=status, mimetype='audio/mp3', direct_passthrough=True)
+            response.headers['Content-Disposition'] = f"inline; filename={source['title']}.mp3"
+            response.headers['Accept-Ranges'] = 'bytes'
+            response.content_length = end - start
+            if status == 206:
+                response.headers['Content-Range'] = f"bytes {start}-{end - 1}/{source['size']}"
+            if source['last_modified']:
+                response.last_modified = source['last_modified']
+        response.set_etag(source['etag'])
+
+    if 'quality' not in request.args:
+        response.vary.update(('Save-Data', 'ECT'))
+        response.headers['Accept-CH'] = 'Save-Data, ECT'
+    if is_new_play(response.status_code, start, request.headers):
+        record_event('play', song_id, user_id)
+    return response
+
+@app.route('/get_mp3/<int:song_id>', methods=['GET'])
+def get_mp3(song_id):
+    return send_song_audio(song_id, session.get('user_id'))
+
+def stream_signer():
+    return Signer(app.secret_key, salt='stream-url')
+
+def signed_stream_url(song_id, user_id, mp3_hash=None, quality=None):
+    # The expiry is rounded up to a STREAM_URL_TTL boundary, so every queue fetch within that window hands
+    # out the same URL and the browser can reuse a prefetched response. v changes when the audio is replaced.
+    ttl = app.config['STREAM_URL_TTL']
+    expires = (int(time.time()) // ttl + 2) * ttl
+    signature = stream_signer().get_signature(f'{song_id}:{user_id}:{expires}').decode()
+    return url_for('stream_song', song_id=song_id, u=user_id, expires=expires, v=mp3_hash[:12] if mp3_hash else None,
+                   quality=quality, sig=signature)
+
+@app.route('/stream/<int:song_id>', methods=['GET'])
+def stream_song(song_id):
+    # The signature stands in for the session, so the response does not vary on the cookie and players
+    # that do not send one (or a second audio element prefetching) can use the URL directly.
+    user_id = request.args.get('u', type=int)
+    expires = request.args.get('expires', type=int)
+    if not expires or expires < time.time() or not stream_signer().verify_signature(f'{song_id}:{user_id}:{expires}', request.args.get('sig', '')):
+        abort(403)
+
+    response = send_song_audio(song_id, user_id)
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = max(expires - int(time.time()), 0)
+    return response
+
+QUEUE_TRACK_COLUMNS = (Song.id, Song.title, Song.artist, Song.duration, Song.bitrate, Song.mp3_hash)
+
+def queue_source_query(queue):
+    # Album and playlist queues read the association table in play order; the key columns double as the cursor.
+    if queue.source == 'playlist':
+        table, owner = playlist_song_association, playlist_song_association.c.playlist_id
+        keys = [table.c.position, table.c.song_id]
+    else:
+        table, owner = album_song_association, album_song_association.c.album_id
+        keys = [table.c.song_id]
+    query = db.session.query(*keys, *QUEUE_TRACK_COLUMNS).join(Song, Song.id == table.c.song_id).filter(owner == queue.source_id)
+    return query, keys
+
+def queue_window(queue, limit, backwards=False):
+    # Up to limit (key, track) pairs starting at the current track, or the ones before it when backwards.
+    # One indexed range query, so peeking and stepping cost the same at any point of a 50k-song playlist.
+    cursor = json.loads(queue.cursor)
+
+    if queue.source == 'songs':
+        song_ids = array('I')
+        song_ids.frombytes(queue.song_ids)
+        index = cursor[0]
+        indexes = range(index - 1, max(index - 1 - limit, -1), -1) if backwards else range(index, min(index + limit, len(song_ids)))
+        tracks = {track.id: track for track in db.session.query(*QUEUE_TRACK_COLUMNS).filter(Song.id.in_([song_ids[i] for i in indexes]))}
+        return [([i], tracks[song_ids[i]]) for i in indexes if song_ids[i] in tracks]
+
+    query, keys = queue_source_query(queue)
+    key = tuple_(*keys) if len(keys) > 1 else keys[0]
+    bound = tuple(cursor) if len(keys) > 1 else cursor[0]
+    query = query.filter(key < bound if backwards else key >= bound)
+    query = query.order_by(*[column.desc() if backwards else column for column in keys]).limit(limit)
+    return [([getattr(row, column.key) for column in keys], row) for row in query]
+
+def start_queue(user_id, source, source_id=None, song_ids=None, start_song_id=None):
+    # Replaces the user's queue; source is 'album', 'playlist' or 'songs'. Returns False if start_song_id is not in it.
+    queue = db.session.get(PlayQueue, user_id) or PlayQueue(user_id=user_id)
+    queue.source, queue.source_id, queue.song_ids = source, source_id, None
+    cursor = [0, 0] if source == 'playlist' else [0]
+
+    if source == 'songs':
+        song_ids = list(dict.fromkeys(song_ids))[:app.config['QUEUE_MAX_SONGS']]
+        queue.song_ids = array('I', song_ids).tobytes()
+        if start_song_id is not None:
+            if start_song_id not in song_ids:
+                return False
+            cursor = [song_ids.index(start_song_id)]
+    elif start_song_id is not None:
+        if source == 'playlist':
+            position = playlist_position(source_id, start_song_id)
+            if position is None:
+                return False
+            cursor = [position, start_song_id]
+        else:
+            in_album = db.session.query(album_song_association.c.song_id).filter(
+                album_song_association.c.album_id == source_id, album_song_association.c.song_id == start_song_id).first()
+            if not in_album:
+                return False
+            cursor = [start_song_id]
+
+    queue.cursor = json.dumps(cursor)
+    db.session.add(queue)
+    return True
+
+def step_queue(queue, steps):
+    # Moves the cursor steps tracks forward (or back when negative). Stepping past the last track leaves the
+    # cursor just after it, so the queue reads as finished until songs are appended to the source.
+    if steps > 0:
+        window = queue_window(queue, steps + 1)
+        if not window:
+            return
+        if len(window) > steps:
+            key = window[steps][0]
+        else:
+            key = window[-1][0][:-1] + [window[-1][0][-1] + 1]
+    elif steps < 0:
+        window = queue_window(queue, -steps, backwards=True)
+        if not window:
+            return
+        key = window[-1][0]
+    else:
+        return
+    queue.cursor = json.dumps(key)
+
+def queue_tracks(queue, limit):
+    # The current track first, then the next ones, each with a signed stream URL and how many bytes
+    # cover the first QUEUE_PREFETCH_SECONDS, which is what a gapless player should fetch ahead of time.
+    # ?quality= is passed on to the stream URLs.
+    quality = request.args.get('quality')
+    kbps = app.config['RENDITION_BITRATES'].get(quality)
+    tracks = []
+    for key, track in queue_window(queue, limit):
+        bytes_per_second = min(track.bitrate or 128, kbps or 320) * 1000 // 8
+        tracks.append({
+            'id': track.id,
+            'title': track.title,
+            'artist': track.artist,
+            'duration': track.duration,
+            'stream_url': signed_stream_url(track.id, queue.user_id, track.mp3_hash, quality if kbps else None),
+            'prefetch_bytes': bytes_per_second * app.config['QUEUE_PREFETCH_SECONDS'],
+        })
+    return tracks
+
+def search_song_ids(search_query):
+    search_page = search_fts if app.config['SEARCH_FTS'] else search_like
+    songs, albums = search_page(search_query, app.config['QUEUE_MAX_SONGS'], 0)
+    return [song.id for song in songs]
+
+@app.route('/queue', methods=['GET'])
+def play_queue():
+    user = current_user()
+    if not user:
+        flash("User not found. Please log in.")
+        return redirect(url_for('login_user'))
+    return render_template('play_queue.html')
+
+@app.route('/queue/start', methods=['POST'])
+def start_play_queue():
+    # "Play all" on the album, playlist and search result pages.
+    user = current_user()
+    if not user:
+        flash("User not found. Please log in.")
+        return redirect(url_for('login_user'))
+
+    source = request.form.get('source')
+    source_id = request.form.get('source_id', type=int)
+    if source == 'playlist':
+        playlist = db.session.get(Playlist, source_id)
+        if not playlist or playlist.creator_id != user.id:
+            flash("You don't have permission to play this playlist.")
+            return redirect(url_for('playlist_list'))
+        start_queue(user.id, 'playlist', source_id)
+    elif source == 'album':
+        start_queue(user.id, 'album', source_id)
+    elif source == 'search':
+        start_queue(user.id, 'songs', song_ids=search_song_ids(request.form.get('search_query', '').strip()))
+    else:
+        abort(400)
 
     try:
-        db.session.delete(album_to_delete)
         db.session.commit()
-        flash("Album deleted successfully!")
     except Exception as e:
         db.session.rollback()
         flash("An error occurred. Please try again.")
         print(f"Error: {e}")
-        return redirect(url_for('admin_dashboard'))
 
-    return redirect(url_for('album_list'))
+    return redirect(url_for('play_queue'))
 
-@app.route('/song/<int:song_id>', methods=['GET'])
-def song_details(song_id):
-    song = Song.query.get(song_id)
-    average_rating = calculate_average_rating(song_id) 
-    has_rated = user_has_rated(song_id) 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    recover_stale_jobs()
+    job = db.session.get(BackgroundJob, job_id)
+    user = current_user()
 
-    is_admin = False
-    username = session.get('username')
-    if username:
-        user = User.query.filter_by(username=username).first()
-        if user and user.isadmin == 1:
-            is_admin = True
+    if not job or (job.owner_id is not None and (not user or user.id != job.owner_id)):
+        abort(404)
 
-    return render_template('song_details.html', song=song, average_rating=average_rating, has_rated=has_rated,is_admin=is_admin)
+    return jsonify(job.to_dict())
 
-@app.route('/get_mp3/<int:song_id>', methods=['GET'])
-def get_mp3(song_id):
-    song = Song.query.get(song_id)
+@app.route('/api/top', methods=['GET'])
+def api_top():
+    limit = min(max(request.args.get('limit', 10, type=int), 1), app.config['RANKING_MAX_LIMIT'])
+    return jsonify(songs=rows_to_dicts(top_songs(limit)), albums=rows_to_dicts(top_albums(limit)))
 
-    if song and song.mp3_binary:
-        response = make_response(song.mp3_binary)
-        response.headers['Content-Type'] = 'audio/mp3'
-        response.headers['Content-Disposition'] = f'inline; filename={song.title}.mp3'
-        return response
-    else:
-        abort(404) 
+@app.route('/song/<int:song_id>/waveform', methods=['GET'])
+def song_waveform(song_id):
+    song = db.session.query(Song.mp3_hash, Song.duration, Song.bitrate, Song.waveform).filter(Song.id == song_id).first()
+
+    if not song or song.waveform is None:
+        abort(404)
+
+    response = make_response(jsonify(duration=song.duration, bitrate=song.bitrate, peaks=list(song.waveform)))
+    response.set_etag(f'waveform-{song.mp3_hash}')
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
 
 @app.route('/rate_song/<int:song_id>', methods=['POST'])
 def rate_song(song_id):
-    user = User.query.filter_by(username=session.get('username')).first()
-    if user:
-        existing_rating = Rating.query.filter_by(user_id=user.id, song_id=song_id).first()
-
-        if existing_rating:
-            existing_rating.rating = int(request.form['rating'])
-        else:
-            new_rating = Rating(user_id=user.id, song_id=song_id, rating=int(request.form['rating']))
-            db.session.add(new_rating)
+    user = current_user()
+    if user and app.config['RATING_WRITE_BEHIND_MS']:
+        queue_rating(user.id, song_id, int(request.form['rating']))
+        flash("Rating submitted successfully!")
+    elif user:
+        record_rating(user.id, song_id, int(request.form['rating']))
 
         try:
             db.session.commit()
+            invalidate_rankings()
+            invalidate_pages(f'song:{song_id}')
             flash("Rating submitted successfully!")
         except Exception as e:
             db.session.rollback()
@@ -547,14 +2401,81 @@ def rate_song(song_id):
 
     return redirect(url_for('song_details', song_id=song_id))
 
+def playlist_position(playlist_id, song_id):
+    return db.session.query(playlist_song_association.c.position).filter(
+        playlist_song_association.c.playlist_id == playlist_id, playlist_song_association.c.song_id == song_id).scalar()
+
+def last_playlist_position(playlist_id, below=None, exclude=None):
+    # Served from the (playlist_id, position) index, so it costs the same for 10 or 50,000 songs.
+    position = playlist_song_association.c.position
+    query = db.session.query(db.func.max(position)).filter(playlist_song_association.c.playlist_id == playlist_id)
+    if below is not None:
+        query = query.filter(position < below)
+    if exclude is not None:
+        query = query.filter(playlist_song_association.c.song_id != exclude)
+    return query.scalar() or 0
+
+def respace_playlist(playlist_id=None):
+    # Spreads positions PLAYLIST_POSITION_GAP apart again in one UPDATE. Only needed once repeated moves
+    # into the same spot have used up the gap there; rowid keeps rows with equal positions in insertion order.
+    where = '' if playlist_id is None else 'WHERE playlist_id = :playlist_id'
+    db.session.execute(text(
+        'UPDATE playlist_song_association SET position = ranked.n * :gap FROM ('
+        ' SELECT rowid AS row, ROW_NUMBER() OVER (PARTITION BY playlist_id ORDER BY position, rowid) AS n'
+        f' FROM playlist_song_association {where}) AS ranked '
+        'WHERE playlist_song_association.rowid = ranked.row'
+    ), {'gap': PLAYLIST_POSITION_GAP, 'playlist_id': playlist_id})
+
+def append_to_playlist(playlist_id, song_ids):
+    # Adds songs after the current last one, in the given order. Songs already in the playlist are skipped.
+    song_ids = list(dict.fromkeys(song_ids))
+    if not song_ids:
+        return 0
+
+    start = last_playlist_position(playlist_id)
+    rows = [{'playlist_id': playlist_id, 'song_id': song_id, 'position': start + (index + 1) * PLAYLIST_POSITION_GAP}
+            for index, song_id in enumerate(song_ids)]
+    added = 0
+    for batch in chunked(rows, 500):
+        added += db.session.execute(sqlite_insert(playlist_song_association).values(batch).on_conflict_do_nothing()).rowcount
+    return added
+
+def move_in_playlist(playlist_id, song_id, before_id=None):
+    # Puts song_id in front of before_id, or at the end, by giving it a position between its new neighbours.
+    if playlist_position(playlist_id, song_id) is None:
+        return False
+    if before_id == song_id:
+        return True
+
+    if before_id is None:
+        position = last_playlist_position(playlist_id) + PLAYLIST_POSITION_GAP
+    else:
+        for attempt in range(2):
+            upper = playlist_position(playlist_id, before_id)
+            if upper is None:
+                return False
+            lower = last_playlist_position(playlist_id, below=upper, exclude=song_id)
+            if upper - lower > 1:
+                break
+            respace_playlist(playlist_id)
+        position = (lower + upper) // 2
+
+    db.session.execute(playlist_song_association.update().where(
+        playlist_song_association.c.playlist_id == playlist_id, playlist_song_association.c.song_id == song_id
+    ).values(position=position))
+    return True
+
+def remove_from_playlist(playlist_id, song_id):
+    return db.session.execute(playlist_song_association.delete().where(
+        playlist_song_association.c.playlist_id == playlist_id, playlist_song_association.c.song_id == song_id
+    )).rowcount > 0
+
 @app.route('/dashboard/user/create_playlist', methods=['GET', 'POST'])
 def create_playlist():
-    db.create_all()
-    username = session.get('username')
-    user = User.query.filter_by(username=username).first()
+    user = current_user()
 
     if user:
-        user_songs = Song.query.all()
+        user_songs = db.session.query(Song.id, Song.title).order_by(Song.id).all()
         form = CreatePlaylistForm()
         form.songs.choices = [(song.id, song.title) for song in user_songs]
 
@@ -563,10 +2484,8 @@ def create_playlist():
             db.session.add(new_playlist)
             db.session.commit()
 
-            selected_song_ids = form.songs.data
-            selected_songs = Song.query.filter(Song.id.in_(selected_song_ids)).all()
-
-            new_playlist.songs.extend(selected_songs)
+            append_to_playlist(new_playlist.id, form.songs.data)
+            queue_recommendations([user.id])
 
             try:
                 db.session.commit()
@@ -586,35 +2505,39 @@ def create_playlist():
     
 @app.route('/playlist_list', methods=['GET', 'POST'])
 def playlist_list():
-    username = session.get('username')
-    if username:
-        user = User.query.filter_by(username=username).first()
-        if user:
-            playlists = Playlist.query.filter_by(creator=user).all()
-            return render_template('playlist_list.html', playlists=playlists)
+    user = current_user()
+    if user:
+        query = db.session.query(Playlist.id, Playlist.name).filter_by(creator_id=user.id)
+        playlists, next_cursor = keyset_page(query, [Playlist.id], request.args.get('after'))
+
+        if wants_json():
+            return jsonify(playlists=rows_to_dicts(playlists), next_cursor=next_cursor)
+
+        return render_template('playlist_list.html', playlists=playlists, next_cursor=next_cursor)
     flash("User not found. Please log in.")
     return redirect(url_for('login_user'))
 
 @app.route('/delete_playlist/<int:playlist_id>', methods=['GET'])
 def delete_playlist(playlist_id):
-    username = session.get('username')
-    if not username:
+    user = current_user()
+    if not user:
         flash("User not found. Please log in.")
         return redirect(url_for('login_user'))
 
-    user = User.query.filter_by(username=username).first()
     playlist = Playlist.query.get(playlist_id)
 
-    if not playlist or not user:
+    if not playlist:
         flash("Playlist or user not found.")
         return redirect(url_for('playlist_list'))
 
-    if playlist.creator != user:
+    if playlist.creator_id != user.id:
         flash("You don't have permission to delete this playlist.")
         return redirect(url_for('playlist_list'))
 
     try:
+        db.session.execute(playlist_song_association.delete().where(playlist_song_association.c.playlist_id == playlist_id))
         db.session.delete(playlist)
+        queue_recommendations([user.id])
         db.session.commit()
         flash("Playlist deleted successfully!")
     except Exception as e:
@@ -625,29 +2548,92 @@ def delete_playlist(playlist_id):
     return redirect(url_for('playlist_list'))
 
 @app.route('/playlist/<int:playlist_id>/songs', methods=['GET'])
+@query_budget(3)
 def playlist_songs(playlist_id):
-    username = session.get('username')
-    if not username:
+    user = current_user()
+    if not user:
         flash("User not found. Please log in.")
         return redirect(url_for('login_user'))
 
-    user = User.query.filter_by(username=username).first()
-    playlist = Playlist.query.get(playlist_id)
+    playlist = db.session.get(Playlist, playlist_id)
 
-    if not playlist or not user:
+    if not playlist:
         flash("Playlist or user not found.")
         return redirect(url_for('playlist_list'))
 
-    if playlist.creator != user:
+    if playlist.creator_id != user.id:
         flash("You don't have permission to view songs in this playlist.")
         return redirect(url_for('playlist_list'))
 
-    songs = playlist.songs
-    return render_template('playlist_songs.html', playlist=playlist, songs=songs)
+    # One page at a time in playlist order, read along the (playlist_id, position) index.
+    query = db.session.query(playlist_song_association.c.position, playlist_song_association.c.song_id, Song.title, Song.artist).join(
+        Song, Song.id == playlist_song_association.c.song_id).filter(playlist_song_association.c.playlist_id == playlist_id)
+    columns = [playlist_song_association.c.position, playlist_song_association.c.song_id]
+    songs, next_cursor = keyset_page(query, columns, request.args.get('after'))
+
+    if wants_json():
+        return jsonify(songs=rows_to_dicts(songs), next_cursor=next_cursor)
+
+    # The cursor is the (position, song_id) of the song just before this page.
+    cursor = decode_cursor(request.args.get('after'), [int, int])
+    return render_template('playlist_songs.html', playlist=playlist, songs=songs, next_cursor=next_cursor,
+                           previous_song_id=cursor[1] if cursor else None)
+
+def owned_playlist(playlist_id):
+    # The playlist if the current user created it, else None after flashing why.
+    user = current_user()
+    if not user:
+        flash("User not found. Please log in.")
+        return None
+
+    playlist = db.session.get(Playlist, playlist_id)
+    if not playlist or playlist.creator_id != user.id:
+        flash("You don't have permission to change this playlist.")
+        return None
+    return playlist
+
+@app.route('/playlist/<int:playlist_id>/remove/<int:song_id>', methods=['POST'])
+def remove_song_from_playlist(playlist_id, song_id):
+    playlist = owned_playlist(playlist_id)
+    if not playlist:
+        return redirect(url_for('playlist_list'))
+
+    try:
+        if remove_from_playlist(playlist_id, song_id):
+            queue_recommendations([playlist.creator_id])
+        db.session.commit()
+        flash("Song removed from the playlist.")
+    except Exception as e:
+        db.session.rollback()
+        flash("An error occurred. Please try again.")
+        print(f"Error: {e}")
+
+    return redirect(url_for('playlist_songs', playlist_id=playlist_id, after=request.form.get('after') or None))
+
+@app.route('/playlist/<int:playlist_id>/move/<int:song_id>', methods=['POST'])
+def move_song_in_playlist(playlist_id, song_id):
+    # before is the song to move in front of; without it the song goes to the end.
+    playlist = owned_playlist(playlist_id)
+    if not playlist:
+        return redirect(url_for('playlist_list'))
+
+    try:
+        if move_in_playlist(playlist_id, song_id, request.form.get('before', type=int)):
+            db.session.commit()
+        else:
+            flash("Song not found in this playlist.")
+    except Exception as e:
+        db.session.rollback()
+        flash("An error occurred. Please try again.")
+        print(f"Error: {e}")
+
+    return redirect(url_for('playlist_songs', playlist_id=playlist_id, after=request.form.get('after') or None))
 
 @app.route('/album/<int:album_id>/songs', methods=['GET'])
+@cached_page('album:{album_id}', 'songs')
+@query_budget(2)
 def album_songs(album_id):
-    album = Album.query.get(album_id)
+    album = Album.query.options(selectinload(Album.songs).load_only(Song.id, Song.title, Song.artist)).filter_by(id=album_id).first()
 
     if album:
         songs = album.songs
@@ -657,21 +2643,24 @@ def album_songs(album_id):
         return redirect(url_for('user_dashboard'))
     
 @app.route('/playlist/<int:playlist_id>/add_songs', methods=['GET', 'POST'])
+@query_budget(2)
 def add_songs_to_playlist(playlist_id):
-    playlist = Playlist.query.get(playlist_id)
+    playlist = db.session.get(Playlist, playlist_id)
 
     if playlist:
-        all_songs = Song.query.all()
-        songs_not_in_playlist = [song for song in all_songs if song not in playlist.songs]
+        # Anti-join: songs with no association row for this playlist.
+        in_playlist = select(playlist_song_association.c.song_id).where(
+            playlist_song_association.c.playlist_id == playlist_id,
+            playlist_song_association.c.song_id == Song.id
+        ).exists()
+        songs_not_in_playlist = db.session.query(Song.id, Song.title).filter(~in_playlist).order_by(Song.id).all()
 
         form = AddSongsToPlaylistForm()
         form.songs.choices = [(song.id, song.title) for song in songs_not_in_playlist]
 
         if form.validate_on_submit():
-            selected_song_ids = form.songs.data
-            selected_songs = Song.query.filter(Song.id.in_(selected_song_ids)).all()
-
-            playlist.songs.extend(selected_songs)
+            append_to_playlist(playlist_id, form.songs.data)
+            queue_recommendations([playlist.creator_id])
 
             try:
                 db.session.commit()
@@ -689,40 +2678,1096 @@ def add_songs_to_playlist(playlist_id):
     return redirect(url_for('user_dashboard'))
 
 
-@app.route('/search', methods=['POST'])
-def search():
-    search_form = SearchForm()
-    search_query = search_form.search_query.data
-
-    songs = Song.query.filter(
+def search_like(search_query, limit, offset):
+    songs = db.session.query(Song.id, Song.title, Song.artist).filter(
         (Song.title.ilike(f"%{search_query}%")) |
         (Song.artist.ilike(f"%{search_query}%")) |
         (Song.lyrics.ilike(f"%{search_query}%"))
-    ).all()
+    ).order_by(Song.id).limit(limit).offset(offset).all()
 
-    albums = Album.query.filter(
+    albums = db.session.query(Album.id, Album.name, Album.artist).filter(
         (Album.name.ilike(f"%{search_query}%")) |
         (Album.artist.ilike(f"%{search_query}%")) |
         Album.songs.any(Song.title.ilike(f"%{search_query}%"))
-    ).all()
-
-    return render_template('search_results.html', songs=songs, albums=albums, form=search_form)
+    ).order_by(Album.id).limit(limit).offset(offset).all()
+
+    return songs, albums
+
+def search_fts(search_query, limit, offset):
+    match = fts_match_query(search_query)
+    if not match:
+        return [], []
+
+    # Ranking every match costs hundreds of milliseconds for a word in most songs, so only the newest SEARCH_CANDIDATES
+    # matches are ranked: reading them in rowid order stops early, and bm25 runs for those rows alone.
+    params = {'match': match, 'candidates': app.config['SEARCH_CANDIDATES'], 'limit': limit, 'offset': offset}
+    songs = db.session.execute(text('''SELECT song.id, song.title, song.artist FROM (
+            SELECT rowid, rank FROM song_search WHERE song_search MATCH :match ORDER BY rowid DESC LIMIT :candidates
+        ) AS candidates JOIN song ON song.id = candidates.rowid
+        ORDER BY candidates.rank LIMIT :limit OFFSET :offset'''), params).all()
+    albums = db.session.execute(text('''SELECT album.id, album.name, album.artist FROM (
+            SELECT rowid, rank FROM album_search WHERE album_search MATCH :match ORDER BY rowid DESC LIMIT :candidates
+        ) AS candidates JOIN album ON album.id = candidates.rowid
+        ORDER BY candidates.rank LIMIT :limit OFFSET :offset'''), params).all()
+
+    return songs, albums
+
+@app.route('/search', methods=['GET', 'POST'])
+def search():
+    search_form = SearchForm()
+    search_query = request.values.get('search_query', '').strip()
+    page = max(request.values.get('page', 1, type=int), 1)
+    page_size = app.config['SEARCH_PAGE_SIZE']
+
+    # Fetch one extra row of each kind to know whether there is a next page.
+    search_page = search_fts if app.config['SEARCH_FTS'] else search_like
+    songs, albums = search_page(search_query, page_size + 1, (page - 1) * page_size)
+    has_next = len(songs) > page_size or len(albums) > page_size
+
+    return render_template('search_results.html', songs=songs[:page_size], albums=albums[:page_size], form=search_form,
+                           search_query=search_query, page=page, has_next=has_next)
+
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# ?fields= picks from these; only the chosen columns are selected.
+API_SONG_FIELDS = {
+    'id': Song.id,
+    'title': Song.title,
+    'artist': Song.artist,
+    'lyrics': Song.lyrics,
+    'duration': Song.duration,
+    'bitrate': Song.bitrate,
+    'rating_avg': Song.rating_avg,
+    'rating_count': Song.rating_count,
+    'uploaded_at': Song.uploaded_at,
+    'stream_url': Song.id,
+}
+API_SONG_DEFAULT = ['id', 'title', 'artist', 'duration', 'rating_avg']
+API_ALBUM_FIELDS = {'id': Album.id, 'name': Album.name, 'artist': Album.artist}
+API_PLAYLIST_FIELDS = {'id': Playlist.id, 'name': Playlist.name}
+
+def dump_json(payload):
+    if orjson:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':'), default=lambda value: value.isoformat()).encode()
+
+def api_json(payload, status=200):
+    return Response(dump_json(payload), status=status, mimetype='application/json')
+
+def api_fields(available, default):
+    requested = request.args.get('fields')
+    names = [name.strip() for name in requested.split(',') if name.strip()] if requested else default
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        abort(400, description=f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(available)}.")
+    return names
+
+def api_rows(rows, names):
+    items = [{name: getattr(row, name) for name in names} for row in rows]
+    if 'stream_url' in names:
+        for item in items:
+            item['stream_url'] = url_for('get_mp3', song_id=item['stream_url'])
+    return items
+
+def clamp_limit(limit):
+    return min(max(limit or app.config['PAGE_SIZE'], 1), app.config['API_MAX_LIMIT'])
+
+def api_limit():
+    return clamp_limit(request.args.get('limit', type=int))
+
+def api_page(available, default, key, *criteria):
+    # Key columns are selected under their own labels so pagination works whatever fields were asked for.
+    # key may be a tuple of columns, e.g. (position, song_id) for playlists.
+    names = api_fields(available, default)
+    cursor_keys = [column.label(f'cursor_key{index}') for index, column in enumerate(key if isinstance(key, tuple) else (key,))]
+    query = db.session.query(*cursor_keys, *(available[name].label(name) for name in names))
+    for criterion in criteria:
+        query = query.filter(criterion)
+
+    rows, next_cursor = keyset_page(query, cursor_keys, request.args.get('after'), limit=api_limit())
+    return api_json({'items': api_rows(rows, names), 'next_cursor': next_cursor})
+
+def api_object(available, default, key, value):
+    names = api_fields(available, default)
+    row = db.session.query(*(available[name].label(name) for name in names)).filter(key == value).first()
+    if row is None:
+        abort(404)
+    return api_json(api_rows([row], names)[0])
+
+def api_user():
+    user = current_user()
+    if not user:
+        abort(401)
+    return user
+
+def api_playlist(playlist_id):
+    playlist = db.session.query(Playlist.id, Playlist.creator_id).filter(Playlist.id == playlist_id).first()
+    if not playlist:
+        abort(404)
+    if playlist.creator_id != api_user().id:
+        abort(403)
+    return playlist
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    return api_json({'error': error.name, 'message': error.description}, error.code)
+
+@api.after_request
+def compress_api_response(response):
+    # Weak ETags, because the same representation is sent gzip-, brotli- or un-encoded.
+    if response.status_code != 200 or response.direct_passthrough:
+        return response
 
+    body = response.get_data()
+    response.set_etag(hashlib.md5(body).hexdigest(), weak=True)
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    response = response.make_conditional(request)
 
-if __name__ == '__main__':
-    app.run(debug=True)
+    if response.status_code != 200 or len(body) < app.config['API_COMPRESS_MIN_BYTES']:
+        return response
 
+    if brotli and request.accept_encodings['br']:
+        response.set_data(brotli.compress(body, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@api.route('/songs', methods=['GET'])
+def api_songs():
+    return api_page(API_SONG_FIELDS, API_SONG_DEFAULT, Song.id)
+
+@api.route('/songs/<int:song_id>', methods=['GET'])
+def api_song(song_id):
+    return api_object(API_SONG_FIELDS, list(API_SONG_FIELDS), Song.id, song_id)
+
+# The rating and search endpoints are plain functions of their inputs so asgi.py can serve them too.
+
+def song_rating_payload(user_id, song_id):
+    song = db.session.query(Song.rating_avg, Song.rating_count).filter(Song.id == song_id).first()
+    if not song:
+        abort(404)
+
+    rating = db.session.query(Rating.rating).filter_by(user_id=user_id, song_id=song_id).scalar()
+    return {'song_id': song_id, 'rating': rating, 'rating_avg': song.rating_avg, 'rating_count': song.rating_count}
+
+def rate_song_payload(user_id, song_id, body):
+    value = (body if isinstance(body, dict) else {}).get('rating')
+    if not isinstance(value, int) or not 1 <= value <= 5:
+        abort(400, description="rating must be an integer from 1 to 5.")
+    if not db.session.query(Song.id).filter(Song.id == song_id).first():
+        abort(404)
+
+    record_rating(user_id, song_id, value)
+    db.session.commit()
+    invalidate_rankings()
+    invalidate_pages(f'song:{song_id}')
+
+    return song_rating_payload(user_id, song_id)
+
+def rate_songs_payload(user_id, items):
+    # Accepts [{"song_id": 1, "rating": 5}, ...] (or {"ratings": [...]}). Re-sending a batch leaves the same state.
+    if isinstance(items, dict):
+        items = items.get('ratings')
+    if not isinstance(items, list):
+        abort(400, description="Expected a JSON array of {song_id, rating} objects.")
+    if len(items) > app.config['RATING_BATCH_MAX']:
+        abort(413, description=f"At most {app.config['RATING_BATCH_MAX']} ratings per request.")
+
+    valid, rejected = [], []
+    for index, item in enumerate(items):
+        song_id = item.get('song_id') if isinstance(item, dict) else None
+        value = item.get('rating') if isinstance(item, dict) else None
+        if type(song_id) is int and type(value) is int and 1 <= value <= 5:
+            valid.append((index, song_id, value))
+        else:
+            rejected.append({'index': index, 'error': "song_id and a rating from 1 to 5 are required."})
+
+    known = existing_song_ids(song_id for index, song_id, value in valid)
+    rejected.extend({'index': index, 'error': "Unknown song."} for index, song_id, value in valid if song_id not in known)
+    accepted = [(user_id, song_id, value) for index, song_id, value in valid if song_id in known]
+
+    song_ids = upsert_ratings(accepted)
+    db.session.commit()
+    if song_ids:
+        invalidate_rankings()
+        invalidate_pages(*(f'song:{song_id}' for song_id in song_ids))
+
+    return {'accepted': len(accepted), 'rejected': sorted(rejected, key=lambda item: item['index'])}
+
+def search_payload(search_query, after, limit):
+    # Results are ordered by relevance, so the cursor carries an offset rather than a key.
+    values = decode_cursor(after, [int]) or [0]
+    if values[0] < 0:
+        abort(400)
+    offset = values[0]
+    limit = min(limit, app.config['SEARCH_PAGE_SIZE'])
+
+    search_page = search_fts if app.config['SEARCH_FTS'] else search_like
+    songs, albums = search_page(search_query, limit + 1, offset)
+    has_next = len(songs) > limit or len(albums) > limit
+
+    return {
+        'songs': rows_to_dicts(songs[:limit]),
+        'albums': rows_to_dicts(albums[:limit]),
+        'next_cursor': encode_cursor([offset + limit]) if has_next else None,
+    }
+
+@api.route('/songs/<int:song_id>/rating', methods=['GET'])
+def api_song_rating(song_id):
+    return api_json(song_rating_payload(api_user().id, song_id))
+
+@api.route('/songs/<int:song_id>/rating', methods=['PUT', 'POST'])
+def api_rate_song(song_id):
+    return api_json(rate_song_payload(api_user().id, song_id, request.get_json(silent=True)))
+
+@api.route('/ratings', methods=['POST'])
+def api_rate_songs():
+    return api_json(rate_songs_payload(api_user().id, request.get_json(silent=True)))
+
+@api.route('/songs/<int:song_id>/similar', methods=['GET'])
+def api_similar_songs(song_id):
+    return api_json({'items': rows_to_dicts(similar_songs(song_id, api_limit()))})
+
+@api.route('/recommendations', methods=['GET'])
+def api_recommendations():
+    return api_json({'items': rows_to_dicts(recommended_songs(api_user().id, api_limit()))})
+
+@api.route('/albums', methods=['GET'])
+def api_albums():
+    return api_page(API_ALBUM_FIELDS, list(API_ALBUM_FIELDS), Album.id)
+
+@api.route('/albums/<int:album_id>', methods=['GET'])
+def api_album(album_id):
+    return api_object(API_ALBUM_FIELDS, list(API_ALBUM_FIELDS), Album.id, album_id)
+
+@api.route('/albums/<int:album_id>/songs', methods=['GET'])
+def api_album_songs(album_id):
+    in_album = select(album_song_association.c.song_id).where(
+        album_song_association.c.album_id == album_id, album_song_association.c.song_id == Song.id).exists()
+    return api_page(API_SONG_FIELDS, API_SONG_DEFAULT, Song.id, in_album)
+
+@api.route('/playlists', methods=['GET'])
+def api_playlists():
+    return api_page(API_PLAYLIST_FIELDS, list(API_PLAYLIST_FIELDS), Playlist.id, Playlist.creator_id == api_user().id)
+
+@api.route('/playlists/<int:playlist_id>/songs', methods=['GET'])
+def api_playlist_songs(playlist_id):
+    # In playlist order; each page is an index range scan on (playlist_id, position).
+    api_playlist(playlist_id)
+    return api_page(API_SONG_FIELDS, API_SONG_DEFAULT, (playlist_song_association.c.position, playlist_song_association.c.song_id),
+                    playlist_song_association.c.playlist_id == playlist_id, playlist_song_association.c.song_id == Song.id)
+
+@api.route('/playlists/<int:playlist_id>/songs', methods=['POST'])
+def api_append_playlist_songs(playlist_id):
+    # Accepts [song_id, ...] (or {"song_ids": [...]}) and appends them in order. Songs already in the playlist are skipped.
+    playlist = api_playlist(playlist_id)
+    song_ids = request.get_json(silent=True)
+    if isinstance(song_ids, dict):
+        song_ids = song_ids.get('song_ids')
+    if not isinstance(song_ids, list) or not all(type(song_id) is int for song_id in song_ids):
+        abort(400, description="Expected a JSON array of song ids.")
+    if len(song_ids) > app.config['PLAYLIST_BATCH_MAX']:
+        abort(413, description=f"At most {app.config['PLAYLIST_BATCH_MAX']} songs per request.")
+
+    known = existing_song_ids(song_ids)
+    added = append_to_playlist(playlist_id, [song_id for song_id in song_ids if song_id in known])
+    if added:
+        queue_recommendations([playlist.creator_id])
+    db.session.commit()
+
+    return api_json({'added': added, 'unknown': sorted(set(song_ids) - known)})
+
+@api.route('/playlists/<int:playlist_id>/songs/<int:song_id>', methods=['PATCH'])
+def api_move_playlist_song(playlist_id, song_id):
+    # {"before": other_song_id} moves the song in front of that one; {"before": null} moves it to the end.
+    api_playlist(playlist_id)
+    before_id = (request.get_json(silent=True) or {}).get('before')
+    if before_id is not None and type(before_id) is not int:
+        abort(400, description="before must be a song id or null.")
+    if not move_in_playlist(playlist_id, song_id, before_id):
+        abort(404)
+    db.session.commit()
+    return api_json({'song_id': song_id, 'position': playlist_position(playlist_id, song_id)})
+
+@api.route('/playlists/<int:playlist_id>/songs/<int:song_id>', methods=['DELETE'])
+def api_remove_playlist_song(playlist_id, song_id):
+    playlist = api_playlist(playlist_id)
+    if not remove_from_playlist(playlist_id, song_id):
+        abort(404)
+    queue_recommendations([playlist.creator_id])
+    db.session.commit()
+    return '', 204
+
+def api_queue_response(queue):
+    return api_json({'source': queue.source, 'source_id': queue.source_id, 'items': queue_tracks(queue, api_limit())})
+
+def api_user_queue():
+    queue = db.session.get(PlayQueue, api_user().id)
+    if not queue:
+        abort(404, description="The play queue is empty.")
+    return queue
+
+@api.route('/queue', methods=['GET'])
+def api_queue():
+    # ?limit=N returns the current track and the N - 1 after it.
+    return api_queue_response(api_user_queue())
+
+@api.route('/queue', methods=['PUT'])
+def api_start_queue():
+    # {"album_id": 1}, {"playlist_id": 1}, {"search": "query"} or {"song_ids": [...]}, plus an optional "start_song_id".
+    user = api_user()
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400, description="Expected a JSON object.")
+    start_song_id = body.get('start_song_id')
+    if start_song_id is not None and type(start_song_id) is not int:
+        abort(400, description="start_song_id must be a song id.")
+
+    if type(body.get('playlist_id')) is int:
+        api_playlist(body['playlist_id'])
+        started = start_queue(user.id, 'playlist', body['playlist_id'], start_song_id=start_song_id)
+    elif type(body.get('album_id')) is int:
+        if not db.session.get(Album, body['album_id']):
+            abort(404)
+        started = start_queue(user.id, 'album', body['album_id'], start_song_id=start_song_id)
+    elif isinstance(body.get('search'), str):
+        started = start_queue(user.id, 'songs', song_ids=search_song_ids(body['search'].strip()), start_song_id=start_song_id)
+    elif isinstance(body.get('song_ids'), list) and all(type(song_id) is int for song_id in body['song_ids']):
+        started = start_queue(user.id, 'songs', song_ids=body['song_ids'], start_song_id=start_song_id)
+    else:
+        abort(400, description="Expected album_id, playlist_id, search or song_ids.")
+
+    if not started:
+        abort(404, description="start_song_id is not in that source.")
+    db.session.commit()
+    return api_queue_response(db.session.get(PlayQueue, user.id))
+
+@api.route('/queue/next', methods=['POST'])
+def api_queue_next():
+    # {"steps": n} skips more than one track; negative steps go back.
+    queue = api_user_queue()
+    steps = (request.get_json(silent=True) or {}).get('steps', 1)
+    if type(steps) is not int or abs(steps) > app.config['API_MAX_LIMIT']:
+        abort(400, description=f"steps must be an integer of at most {app.config['API_MAX_LIMIT']}.")
+    step_queue(queue, steps)
+    db.session.commit()
+    return api_queue_response(queue)
+
+@api.route('/queue/previous', methods=['POST'])
+def api_queue_previous():
+    queue = api_user_queue()
+    step_queue(queue, -1)
+    db.session.commit()
+    return api_queue_response(queue)
+
+@api.route('/queue', methods=['DELETE'])
+def api_clear_queue():
+    db.session.delete(api_user_queue())
+    db.session.commit()
+    return '', 204
+
+@api.route('/search', methods=['GET'])
+def api_search():
+    return api_json(search_payload(request.args.get('q', '').strip(), request.args.get('after'), api_limit()))
+
+app.register_blueprint(api)
+
+
+MIGRATIONS = []
+
+def migration(description):
+    # Migrations run in the order they are declared; PRAGMA user_version stores how many have been applied.
+    def decorator(func):
+        MIGRATIONS.append((description, func))
+        return func
+    return decorator
+
+def migrate_database():
+    # One IMMEDIATE transaction, so concurrently starting workers wait for each other instead of racing.
+    connection = db.session.connection()
+    connection.exec_driver_sql('BEGIN IMMEDIATE')
+    fresh = not inspect(connection).has_table('user')
+    db.metadata.create_all(bind=connection)
+
+    version = connection.exec_driver_sql('PRAGMA user_version').scalar()
+    if fresh:
+        version = len(MIGRATIONS)
+    for number, (description, func) in enumerate(MIGRATIONS[version:], start=version + 1):
+        func()
+        print(f"Applied migration {number}: {description}")
+
+    connection.exec_driver_sql(f'PRAGMA user_version = {max(version, len(MIGRATIONS))}')
+    db.session.commit()
+
+def rebuild_table(table, columns, select):
+    # SQLite cannot add a primary key or constraint to an existing table, so recreate it from the model and copy the rows.
+    connection = db.session.connection()
+    for index in table.indexes:
+        connection.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+    connection.exec_driver_sql(f'ALTER TABLE {table.name} RENAME TO {table.name}_old')
+    table.create(bind=connection)
+    connection.exec_driver_sql(f'INSERT INTO {table.name} ({columns}) {select.format(old=table.name + "_old")}')
+    connection.exec_driver_sql(f'DROP TABLE {table.name}_old')
+
+def add_column(table, column):
+    ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=db.engine.dialect)}'
+    if column.server_default is not None:
+        if not column.nullable:
+            ddl += ' NOT NULL'
+        ddl += f" DEFAULT '{column.server_default.arg}'"
+    db.session.execute(text(ddl))
+
+@migration("Add columns and tables created before versioned migrations")
+def add_missing_columns():
+    # create_all() only creates missing tables, so bring older music_app.db files up to the current models.
+    inspector = inspect(db.session.connection())
+    added = set()
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                add_column(table, column)
+                added.add(column)
+
+        for index in table.indexes:
+            index.create(bind=db.session.connection(), checkfirst=True)
+
+    # The rating aggregates start at their default of 0; fill them in from the ratings already stored.
+    if added & {Song.__table__.c.rating_count, Song.__table__.c.rating_sum, Song.__table__.c.rating_avg}:
+        refresh_rating_aggregates()
+
+@migration("Index hot lookup columns")
+def add_lookup_indexes():
+    for table in (User.__table__, Song.__table__, Album.__table__):
+        for index in table.indexes:
+            index.create(bind=db.session.connection(), checkfirst=True)
+
+@migration("Make ratings unique per user and song")
+def unique_ratings():
+    # Keep each user's most recent rating of a song and recompute the aggregates the duplicates inflated.
+    duplicated = [row.song_id for row in db.session.execute(text(
+        'SELECT DISTINCT song_id FROM ratings GROUP BY user_id, song_id HAVING COUNT(*) > 1'))]
+    rebuild_table(Rating.__table__, 'id, user_id, song_id, rating',
+                  'SELECT id, user_id, song_id, rating FROM {old} WHERE id IN (SELECT MAX(id) FROM {old} GROUP BY user_id, song_id)')
+    if duplicated:
+        refresh_rating_aggregates(duplicated)
+
+@migration("Add primary keys to the album and playlist association tables")
+def association_primary_keys():
+    rebuild_table(album_song_association, 'album_id, song_id',
+                  'SELECT DISTINCT album_id, song_id FROM {old} WHERE album_id IS NOT NULL AND song_id IS NOT NULL')
+    rebuild_table(playlist_song_association, 'playlist_id, song_id',
+                  'SELECT DISTINCT playlist_id, song_id FROM {old} WHERE playlist_id IS NOT NULL AND song_id IS NOT NULL')
+
+@migration("Remove rows left behind by deleted songs and albums")
+def remove_orphans():
+    for table in (SongNeighbor.__table__, UserRecommendation.__table__):
+        for index in table.indexes:
+            index.create(bind=db.session.connection(), checkfirst=True)
+
+    orphans = [
+        'DELETE FROM ratings WHERE song_id NOT IN (SELECT id FROM song)',
+        'DELETE FROM album_song_association WHERE song_id NOT IN (SELECT id FROM song) OR album_id NOT IN (SELECT id FROM album)',
+        'DELETE FROM playlist_song_association WHERE song_id NOT IN (SELECT id FROM song) OR playlist_id NOT IN (SELECT id FROM playlist)',
+        'DELETE FROM song_neighbor WHERE song_id NOT IN (SELECT id FROM song) OR neighbor_id NOT IN (SELECT id FROM song)',
+        'DELETE FROM user_recommendation WHERE song_id NOT IN (SELECT id FROM song)',
+    ]
+    for statement in orphans:
+        db.session.execute(text(statement))
+
+@migration("Order playlist songs by position")
+def playlist_positions():
+    # Existing rows keep the order they were added in.
+    existing_columns = {column['name'] for column in inspect(db.session.connection()).get_columns(playlist_song_association.name)}
+    if 'position' not in existing_columns:
+        add_column(playlist_song_association, playlist_song_association.c.position)
+    respace_playlist()
+    for index in playlist_song_association.indexes:
+        index.create(bind=db.session.connection(), checkfirst=True)
+
+@migration("Index four-letter search prefixes")
+def search_prefix_four():
+    # FTS5 options are fixed when the table is created. create_search_index() recreates and fills both tables after
+    # the migrations have run.
+    db.session.execute(text('DROP TABLE IF EXISTS song_search'))
+    db.session.execute(text('DROP TABLE IF EXISTS album_search'))
+
+def read_manifest(path):
+    # CSV columns / JSONL keys: file, title, artist, lyrics, album, ratings.
+    # CSV ratings look like "alice=5;bob=3"; JSONL ratings are an object {"alice": 5}.
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith(('.jsonl', '.json')):
+            for line in f:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield None
+        else:
+            for row in csv.DictReader(f):
+                ratings = {}
+                for pair in filter(None, (row.get('ratings') or '').split(';')):
+                    username, _, value = pair.partition('=')
+                    ratings[username.strip()] = value
+                row['ratings'] = ratings
+                yield row
+
+def manifest_row_error(row):
+    if not isinstance(row, dict):
+        return "not a JSON object"
+    missing = [key for key in ('file', 'artist') if not row.get(key)]
+    if missing:
+        return f"missing {' and '.join(missing)}"
+    return None
+
+def manifest_row_label(position, row):
+    return (row.get('file') if isinstance(row, dict) else None) or f"row {position + 1}"
+
+def prepare_import_file(job):
+    # Runs in a worker process: parse the frames and copy the file into the blob store. Settings come in the job,
+    # because under the spawn and forkserver start methods the worker imports an unconfigured app.
+    position, path, waveform_points, store, chunk_size = job
+    try:
+        info = mp3info.analyze(path, waveform_points)
+        if info is None:
+            return position, None, "no MPEG audio frames"
+        with open(path, 'rb') as f:
+            info['mp3_hash'], info['mp3_size'] = store_mp3(read_file_chunks(f, chunk_size), store)
+        return position, info, None
+    except (OSError, ValueError) as e:
+        return position, None, str(e)
+
+def import_batch(batch, results, checkpoint, users):
+    # One transaction per batch, checkpoint included. Ids come from the database, so a concurrent
+    # upload cannot collide with them.
+    checkpoint.rows_done = batch[-1][0] + 1
+
+    songs, song_ratings, song_albums, failures = [], [], [], []
+    for (position, row), (_, info, error) in zip(batch, results):
+        if info is None:
+            failures.append((manifest_row_label(position, row), error))
+            continue
+
+        rated = {}
+        for username, value in (row.get('ratings') or {}).items():
+            if username in users and str(value).isdigit() and 1 <= int(value) <= 5:
+                rated[users[username]] = int(value)
+
+        songs.append({
+            'title': row.get('title') or os.path.splitext(os.path.basename(row['file']))[0],
+            'artist': row['artist'],
+            'lyrics': row.get('lyrics') or '',
+            'mp3_hash': info['mp3_hash'],
+            'mp3_size': info['mp3_size'],
+            'duration': info['duration'],
+            'bitrate': info['bitrate'],
+            'waveform': info['waveform'],
+            'uploaded_at': datetime.utcnow(),
+            'rating_count': len(rated),
+            'rating_sum': sum(rated.values()),
+            'rating_avg': sum(rated.values()) / len(rated) if rated else 0,
+        })
+        song_ratings.append(rated)
+        song_albums.append((row['album'], row['artist']) if row.get('album') else None)
+
+    song_ids = []
+    if songs:
+        song_ids = db.session.execute(Song.__table__.insert().returning(Song.__table__.c.id, sort_by_parameter_order=True), songs).scalars().all()
+
+    ratings = [{'user_id': user_id, 'song_id': song_id, 'rating': value}
+               for song_id, rated in zip(song_ids, song_ratings) for user_id, value in rated.items()]
+    if ratings:
+        db.session.execute(Rating.__table__.insert(), ratings)
+        queue_recommendations(rating['user_id'] for rating in ratings)
+
+    albums = {}
+    for song_id, key in zip(song_ids, song_albums):
+        if key:
+            albums.setdefault(key, []).append(song_id)
+
+    album_ids = {}
+    if albums:
+        names = {name for name, artist in albums}
+        for album in db.session.query(Album.id, Album.name, Album.artist).filter(Album.name.in_(names)):
+            album_ids[(album.name, album.artist)] = album.id
+
+        new_albums = [key for key in albums if key not in album_ids]
+        if new_albums:
+            inserted = db.session.execute(Album.__table__.insert().returning(Album.__table__.c.id, sort_by_parameter_order=True),
+                                          [{'name': name, 'artist': artist} for name, artist in new_albums]).scalars().all()
+            album_ids.update(zip(new_albums, inserted))
+
+        db.session.execute(album_song_association.insert(),
+                           [{'album_id': album_ids[key], 'song_id': song_id} for key, ids in albums.items() for song_id in ids])
+
+    index_songs(song_ids)
+    index_albums([album_ids[key] for key in albums])
+    db.session.commit()
+    for song_id in song_ids:
+        record_event('upload', song_id)
+
+    return len(songs), failures
+
+@app.cli.command('import-catalog')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.argument('manifest', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', type=int, default=None, help='Worker processes (defaults to the CPU count).')
+@click.option('--batch-size', type=int, default=500)
+def import_catalog_command(directory, manifest, workers, batch_size):
+    """Bulk import MP3s described by a CSV or JSONL manifest. Safe to re-run after an interruption."""
+    manifest_key = os.path.abspath(manifest)
+    checkpoint = db.session.get(ImportCheckpoint, manifest_key)
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(manifest=manifest_key, rows_done=0)
+        db.session.add(checkpoint)
+        db.session.commit()
+    elif checkpoint.rows_done:
+        click.echo(f"Resuming after row {checkpoint.rows_done}.")
+
+    users = {row.username: row.id for row in db.session.query(User.id, User.username)}
+    rows = itertools.islice(enumerate(read_manifest(manifest)), checkpoint.rows_done, None)
+    settings = (app.config['WAVEFORM_POINTS'], app.config['MP3_STORE_PATH'], app.config['MP3_CHUNK_SIZE'])
+    imported = failed = 0
+    started = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+
+            # Rows without a file or artist are reported as failures instead of stopping the import.
+            errors = {position: manifest_row_error(row) for position, row in batch}
+            jobs = [(position, os.path.join(directory, row['file']), *settings) for position, row in batch if not errors[position]]
+            prepared = {result[0]: result for result in pool.map(prepare_import_file, jobs, chunksize=max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1))))}
+            results = [prepared.get(position, (position, None, errors[position])) for position, row in batch]
+            count, failures = import_batch(batch, results, checkpoint, users)
+
+            imported += count
+            failed += len(failures)
+            invalidate_rankings()
+            invalidate_pages('songs', 'albums')
+            for file, error in failures:
+                click.echo(f"Skipped {file}: {error}", err=True)
+
+            elapsed = time.monotonic() - started
+            click.echo(f"Row {checkpoint.rows_done}: {imported} songs imported, {failed} skipped, {imported / elapsed:.0f} songs/s")
+
+    click.echo(f"Done: {imported} songs imported, {failed} skipped in {time.monotonic() - started:.1f}s.")
+
+def fetch_int_rows(np, sql):
+    # Streams integer rows into a flat array, so millions of ratings never exist as Python tuples at once.
+    result = db.session.connection().exec_driver_sql(sql)
+    width = len(result.keys())
+    values = array('q')
+    while True:
+        rows = result.fetchmany(100000)
+        if not rows:
+            break
+        values.extend(itertools.chain.from_iterable(rows))
+    return np.frombuffer(values, dtype=np.int64).reshape(-1, width)
+
+def top_k(np, indices, scores, k, exclude=()):
+    keep = ~np.isin(indices, exclude) if len(exclude) else slice(None)
+    indices, scores = indices[keep], scores[keep]
+    if len(scores) > k:
+        best = np.argpartition(-scores, k)[:k]
+        indices, scores = indices[best], scores[best]
+    order = np.argsort(-scores, kind='stable')
+    return indices[order], scores[order]
+
+def replace_rows(model, owner_column, owner_ids, rows):
+    for start in range(0, len(owner_ids), 500):
+        db.session.query(model).filter(owner_column.in_(owner_ids[start:start + 500])).delete(synchronize_session=False)
+    if rows:
+        db.session.execute(model.__table__.insert(), rows)
+
+@app.cli.command('build-recommendations')
+@click.option('--full', is_flag=True, help='Rebuild every song and user instead of only users queued since the last run.')
+@click.option('--neighbors', type=int, default=20, help='Similar songs kept per song.')
+@click.option('--recommendations', type=int, default=20, help='Recommendations kept per user.')
+@click.option('--block-size', type=int, default=1024, help='Songs or users scored per sparse product.')
+@click.option('--playlist-weight', type=float, default=1.0, help='Weight of playlist co-occurrence relative to ratings.')
+def build_recommendations_command(full, neighbors, recommendations, block_size, playlist_weight):
+    """Compute similar songs and per-user recommendations from ratings and playlists."""
+    import numpy as np
+    from scipy import sparse
+
+    started_at = datetime.utcnow()
+    started = time.monotonic()
+
+    queued = None
+    if not full:
+        queued = np.array([row.user_id for row in db.session.query(RecommendationQueue.user_id)], dtype=np.int64)
+        if not len(queued):
+            click.echo("No users queued; nothing to do.")
+            return
+
+    ratings = fetch_int_rows(np, 'SELECT user_id, song_id, rating FROM ratings')
+    memberships = fetch_int_rows(np, 'SELECT playlist.id, playlist.creator_id, playlist_song_association.song_id '
+                                     'FROM playlist_song_association JOIN playlist ON playlist.id = playlist_song_association.playlist_id')
+
+    song_ids, song_index = np.unique(np.concatenate([ratings[:, 1], memberships[:, 2]]), return_inverse=True)
+    user_ids, user_index = np.unique(np.concatenate([ratings[:, 0], memberships[:, 1]]), return_inverse=True)
+    playlist_ids, playlist_index = np.unique(memberships[:, 0], return_inverse=True)
+    rated_songs, member_songs = song_index[:len(ratings)], song_index[len(ratings):]
+    rating_users, member_users = user_index[:len(ratings)], user_index[len(ratings):]
+    click.echo(f"Loaded {len(ratings)} ratings and {len(memberships)} playlist entries over {len(user_ids)} users and {len(song_ids)} songs.")
+
+    # Taste vectors: a rating counts rating/5, a song in one of the user's playlists counts 1.
+    rating_matrix = sparse.csr_matrix((ratings[:, 2] / 5, (rating_users, rated_songs)), shape=(len(user_ids), len(song_ids)), dtype=np.float32)
+    owned = sparse.csr_matrix((np.ones(len(memberships), dtype=np.float32), (member_users, member_songs)), shape=rating_matrix.shape)
+    owned.data = np.minimum(owned.data, 1)
+    tastes = (rating_matrix + owned).tocsr()
+
+    # Item-item cosine similarity over users' ratings plus playlists, each playlist being its own row.
+    playlists = sparse.csr_matrix((np.full(len(memberships), playlist_weight, dtype=np.float32), (playlist_index, member_songs)),
+                                  shape=(len(playlist_ids), len(song_ids)))
+    items = sparse.vstack([rating_matrix, playlists]).tocsc()
+    norms = np.sqrt(np.asarray(items.multiply(items).sum(axis=0)).ravel())
+    items = (items @ sparse.diags(1 / np.maximum(norms, 1e-9))).tocsc()
+    items_by_song = items.T.tocsr()
+
+    if full:
+        refresh_users = np.arange(len(user_ids))
+        refresh_songs = np.arange(len(song_ids))
+    else:
+        refresh_users = np.flatnonzero(np.isin(user_ids, queued))
+        # Only songs these users touched have co-occurrence counts that moved. Their neighbours' normalisation drifts
+        # slightly as well; a periodic --full run picks that up.
+        refresh_songs = np.unique(tastes[refresh_users].indices)
+
+    neighbor_rows, neighbor_cols, neighbor_scores = [], [], []
+    for start in range(0, len(refresh_songs), block_size):
+        block = refresh_songs[start:start + block_size]
+        similarities = (items_by_song[block] @ items).tocsr()
+        rows = []
+        for i, song in enumerate(block):
+            row = slice(similarities.indptr[i], similarities.indptr[i + 1])
+            cols, scores = top_k(np, similarities.indices[row], similarities.data[row], neighbors, exclude=[song])
+            neighbor_rows.append(np.full(len(cols), song))
+            neighbor_cols.append(cols)
+            neighbor_scores.append(scores)
+            rows.extend({'song_id': int(song_ids[song]), 'rank': rank, 'neighbor_id': int(song_ids[col]), 'score': float(score)}
+                        for rank, (col, score) in enumerate(zip(cols, scores)))
+
+        replace_rows(SongNeighbor, SongNeighbor.song_id, [int(song_ids[song]) for song in block], rows)
+        db.session.commit()
+        invalidate_pages(*(f'song:{song_ids[song]}' for song in block))
+        click.echo(f"{min(start + block_size, len(refresh_songs))}/{len(refresh_songs)} songs ({time.monotonic() - started:.1f}s)")
+
+    # Only the rows for refreshed songs are held in memory, which covers every song a refreshed user has touched.
+    neighbor_matrix = sparse.csr_matrix((np.concatenate(neighbor_scores or [[]]),
+                                         (np.concatenate(neighbor_rows or [[]]).astype(np.int64), np.concatenate(neighbor_cols or [[]]).astype(np.int64))),
+                                        shape=(len(song_ids), len(song_ids)), dtype=np.float32)
+
+    for start in range(0, len(refresh_users), block_size):
+        block = refresh_users[start:start + block_size]
+        taste_block = tastes[block]
+        scores_block = (taste_block @ neighbor_matrix).tocsr()
+        rows = []
+        for i, user in enumerate(block):
+            row = slice(scores_block.indptr[i], scores_block.indptr[i + 1])
+            known = taste_block.indices[taste_block.indptr[i]:taste_block.indptr[i + 1]]
+            cols, scores = top_k(np, scores_block.indices[row], scores_block.data[row], recommendations, exclude=known)
+            rows.extend({'user_id': int(user_ids[user]), 'rank': rank, 'song_id': int(song_ids[col]), 'score': float(score)}
+                        for rank, (col, score) in enumerate(zip(cols, scores)))
+
+        replace_rows(UserRecommendation, UserRecommendation.user_id, [int(user_ids[user]) for user in block], rows)
+        db.session.commit()
+        click.echo(f"{min(start + block_size, len(refresh_users))}/{len(refresh_users)} users ({time.monotonic() - started:.1f}s)")
+
+    # Users and songs with no interactions left keep nothing.
+    if full:
+        db.session.execute(text('DELETE FROM song_neighbor WHERE song_id NOT IN (SELECT song_id FROM ratings UNION SELECT song_id FROM playlist_song_association)'))
+        db.session.execute(text('DELETE FROM user_recommendation WHERE user_id NOT IN (SELECT user_id FROM ratings UNION SELECT creator_id FROM playlist '
+                                'JOIN playlist_song_association ON playlist_song_association.playlist_id = playlist.id)'))
+        RecommendationQueue.query.filter(RecommendationQueue.queued_at <= started_at).delete()
+    else:
+        idle = [int(user_id) for user_id in np.setdiff1d(queued, user_ids)]
+        replace_rows(UserRecommendation, UserRecommendation.user_id, idle, [])
+        queued = [int(user_id) for user_id in queued]
+        for start in range(0, len(queued), 500):
+            RecommendationQueue.query.filter(RecommendationQueue.user_id.in_(queued[start:start + 500]),
+                                             RecommendationQueue.queued_at <= started_at).delete(synchronize_session=False)
+    db.session.commit()
+
+    click.echo(f"Refreshed {len(refresh_songs)} songs and {len(refresh_users)} users in {time.monotonic() - started:.1f}s.")
+
+@app.cli.command('analyze-songs')
+@click.option('--all', 'reanalyze', is_flag=True, help='Re-analyse songs that already have metadata.')
+@click.option('--workers', type=int, default=None, help='Worker processes (defaults to the CPU count).')
+@click.option('--batch-size', type=int, default=200)
+def analyze_songs_command(reanalyze, workers, batch_size):
+    """Compute duration, bitrate and waveform previews for stored songs."""
+    query = db.session.query(Song.id, Song.mp3_hash).filter(Song.mp3_hash.isnot(None))
+    if not reanalyze:
+        query = query.filter((Song.duration.is_(None)) | (Song.waveform.is_(None)))
+    points = app.config['WAVEFORM_POINTS']
+    jobs = [(row.id, mp3_store_path(row.mp3_hash), points) for row in query.order_by(Song.id)]
+
+    analyzed = failed = 0
+    batch = []
+    started = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for song_id, info in pool.map(mp3info.analyze_file, jobs, chunksize=16):
+            if info is None:
+                failed += 1
+                continue
+
+            batch.append({'id': song_id, 'duration': info['duration'], 'bitrate': info['bitrate'], 'waveform': info['waveform']})
+            if len(batch) >= batch_size:
+                db.session.bulk_update_mappings(Song, batch)
+                db.session.commit()
+                analyzed += len(batch)
+                batch = []
+                click.echo(f"{analyzed}/{len(jobs)} songs analysed ({analyzed / (time.monotonic() - started):.1f}/s)")
 
-with app.app_context():
-    db.create_all()
-    inspector = inspect(db.engine)
-    existing_database = inspector.has_table("playlist")
+    if batch:
+        db.session.bulk_update_mappings(Song, batch)
+        db.session.commit()
+        analyzed += len(batch)
+
+    click.echo(f"Analysed {analyzed} songs, {failed} could not be read.")
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Repopulate the full-text search tables from the song and album tables."""
+    if not app.config['SEARCH_FTS']:
+        click.echo("This SQLite build has no FTS5 support.")
+        return
+
+    rebuild_search_index()
+    db.session.commit()
+    click.echo("Search index rebuilt.")
+
+def synthetic_songs(rng, count):
+    # Pseudo-words with a skewed frequency, so some terms match thousands of songs and others a handful.
+    syllables = ['ka', 'lo', 'mi', 'ra', 'te', 'su', 'ne', 'vo', 'di', 'an', 'el', 'or', 'zu', 'pa', 'qui', 'ber']
+    words = sorted({''.join(rng.choices(syllables, k=rng.randint(2, 4))) for _ in range(5000)})
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    artists = [f'{word.title()} {rng.choice(words).title()}' for word in rng.sample(words, 500)]
+
+    for _ in range(count):
+        yield {
+            'title': ' '.join(rng.choices(words, weights, k=rng.randint(2, 4))).title(),
+            'artist': rng.choice(artists),
+            'lyrics': ' '.join(rng.choices(words, weights, k=60)),
+        }
+
+@app.cli.command('benchmark-search')
+@click.option('--songs', type=int, default=10000, help='Add synthetic songs until the database holds this many.')
+@click.option('--repeat', type=int, default=20, help='Timed runs per query and backend.')
+def benchmark_search_command(songs, repeat):
+    """Time FTS5 search against the LIKE fallback. Adds synthetic songs, so run it against a scratch database."""
+    if not app.config['SEARCH_FTS']:
+        raise click.ClickException("This SQLite build has no FTS5 support.")
+
+    existing = db.session.query(db.func.count(Song.id)).scalar()
+    if existing < songs:
+        for batch in chunked(list(synthetic_songs(random.Random(existing), songs - existing)), 5000):
+            db.session.execute(Song.__table__.insert(), batch)
+        # One album per ten new songs, each song in one of them.
+        albums = (songs - existing) // 10
+        if albums:
+            db.session.execute(Album.__table__.insert(), [{'name': f'Album {number}', 'artist': 'Various'} for number in range(albums)])
+            db.session.execute(text(
+                'INSERT OR IGNORE INTO album_song_association (album_id, song_id) '
+                'SELECT album.id, song.id FROM album JOIN song ON song.id % :albums = album.id % :albums '
+                'WHERE album.id > (SELECT MAX(id) FROM album) - :albums AND song.id > :existing'), {'albums': albums, 'existing': existing})
+        rebuild_search_index()
+        db.session.commit()
+        click.echo(f"Added {songs - existing} synthetic songs.")
+
+    # Terms of different selectivity, taken from the corpus itself.
+    sample = db.session.query(Song.lyrics).filter(Song.lyrics != '').order_by(Song.id).limit(200).all()
+    ranked = [word for word, count in Counter(word for row in sample for word in row.lyrics.split()).most_common()]
+    queries = {
+        'common word': ranked[0],
+        'rare word': ranked[-1],
+        'prefix': ranked[1][:3],
+        'two words': f'{ranked[2]} {ranked[-2]}',
+        'no match': 'xyzzy',
+    }
+
+    limit = app.config['SEARCH_PAGE_SIZE'] + 1
+    total = db.session.query(db.func.count(Song.id)).scalar()
+    click.echo(f"{total} songs, median of {repeat} runs for the first page of results")
+    click.echo(f"{'query':<12} {'LIKE ms':>9} {'FTS5 ms':>9} {'speedup':>8}")
+    for label, search_query in queries.items():
+        medians = []
+        for search_page in (search_like, search_fts):
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                search_page(search_query, limit, 0)
+                timings.append((time.perf_counter() - start) * 1000)
+            medians.append(statistics.median(timings))
+        click.echo(f"{label:<12} {medians[0]:>9.2f} {medians[1]:>9.2f} {medians[0] / medians[1]:>7.2f}x")
+
+def hot_queries():
+    # The lookups behind login, the creator pages, ban_user, ratings and the album/playlist pages.
+    in_playlist = select(playlist_song_association.c.song_id).where(
+        playlist_song_association.c.playlist_id == 1, playlist_song_association.c.song_id == Song.id).exists()
+    return {
+        'login': (User.query.filter_by(username='name', isadmin=0), None),
+        'user_list': (db.session.query(User.id).filter_by(isadmin=0, isban=0).order_by(User.id), 'ix_user_isadmin_isban'),
+        'creator_songs': (db.session.query(Song.id, Song.title).filter_by(artist='name'), 'ix_song_artist'),
+        'creator_albums': (db.session.query(Album.id).filter_by(artist='name'), 'ix_album_artist'),
+        'user_has_rated': (Rating.query.filter_by(user_id=1, song_id=1), None),
+        'song_ratings': (db.session.query(Rating.rating).filter_by(song_id=1), 'ix_ratings_song_id'),
+        'album_songs': (db.session.query(album_song_association.c.song_id).filter_by(album_id=1), None),
+        'song_albums': (db.session.query(album_song_association.c.album_id).filter(album_song_association.c.song_id.in_([1, 2])),
+                        'ix_album_song_association_song_id'),
+        'playlist_songs': (db.session.query(playlist_song_association.c.song_id, Song.title).join(Song, Song.id == playlist_song_association.c.song_id)
+                           .filter(playlist_song_association.c.playlist_id == 1, playlist_song_association.c.position > 0)
+                           .order_by(playlist_song_association.c.position, playlist_song_association.c.song_id).limit(50),
+                           'ix_playlist_song_association_position'),
+        'playlist_tail': (db.session.query(db.func.max(playlist_song_association.c.position)).filter_by(playlist_id=1),
+                          'ix_playlist_song_association_position'),
+        'playlist_picker': (db.session.query(Song.id).filter(~in_playlist), None),
+        'queue_window': (queue_source_query(PlayQueue(source='playlist', source_id=1))[0].filter(
+                             tuple_(playlist_song_association.c.position, playlist_song_association.c.song_id) >= (0, 0))
+                         .order_by(playlist_song_association.c.position, playlist_song_association.c.song_id).limit(5),
+                         'ix_playlist_song_association_position'),
+        'user_playlists': (db.session.query(Playlist.id).filter_by(creator_id=1), 'ix_playlist_creator_id'),
+    }
+
+def query_plan(query):
+    statement = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    return [row[-1] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {statement}'))]
+
+# Scans a hot query does on purpose, as (query name, table): the playlist picker lists every song not yet in the playlist.
+ALLOWED_SCANS = {('playlist_picker', 'song')}
+
+def check_query_plans():
+    # (name, plan, ok) per hot query. Only SEARCH steps and allow-listed scans pass, and the expected index must be used.
+    results = []
+    for name, (query, expected_index) in hot_queries().items():
+        plan = query_plan(query)
+        scans = [step for step in plan if step.startswith('SCAN') and (name, step.split()[1]) not in ALLOWED_SCANS]
+        missing = expected_index and not any(expected_index in step for step in plan)
+        results.append((name, plan, not scans and not missing))
+    return results
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a hot query scans a table instead of using an index."""
+    failures = 0
+
+    for name, plan, ok in check_query_plans():
+        failures += not ok
+        click.echo(f"{'ok  ' if ok else 'FAIL'} {name}: {' | '.join(plan)}")
+
+    if failures:
+        raise click.ClickException(f"{failures} queries do not use an index.")
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the upload statistics from the song table. Plays and daily ratings are only known from events."""
+    flush_events()
+    uploads = db.session.query(db.func.date(Song.uploaded_at).label('day'), db.func.count().label('uploads')) \
+        .filter(Song.uploaded_at.isnot(None)).group_by('day').all()
+    DailyStat.query.update({DailyStat.uploads: 0})
+    upsert_counters(DailyStat, 'day', {date.fromisoformat(row.day): Counter(uploads=row.uploads) for row in uploads})
+
+    creators = db.session.query(Song.artist, db.func.count().label('uploads'), db.func.sum(Song.rating_count).label('ratings')).group_by(Song.artist).all()
+    CreatorStat.query.update({CreatorStat.uploads: 0, CreatorStat.ratings: 0})
+    upsert_counters(CreatorStat, 'artist', {row.artist: Counter(uploads=row.uploads, ratings=row.ratings or 0) for row in creators})
+    db.session.commit()
+    click.echo(f"Rebuilt upload statistics for {len(uploads)} days and {len(creators)} creators.")
+
+@app.cli.command('reconcile-ratings')
+def reconcile_ratings_command():
+    """Recompute every song's rating aggregates from the ratings table."""
+    updated = refresh_rating_aggregates()
+    db.session.commit()
+    click.echo(f"Reconciled rating aggregates for {updated} songs.")
+
+@app.cli.command('migrate-mp3')
+def migrate_mp3_command():
+    """Move MP3 bytes stored in the song table into the blob store."""
+    legacy_songs = db.session.query(Song.id, db.func.length(Song.mp3_binary).label('size')).filter(Song.mp3_hash.is_(None), Song.mp3_binary.isnot(None)).all()
+
+    for song in legacy_songs:
+        mp3_hash, mp3_size = store_mp3(read_mp3_chunks(song.id, 0, song.size))
+        Song.query.filter_by(id=song.id).update({'mp3_hash': mp3_hash, 'mp3_size': mp3_size, 'mp3_binary': None})
+        db.session.commit()
+        click.echo(f"Song {song.id}: {mp3_size} bytes -> {mp3_hash}")
+
+    click.echo(f"Migrated {len(legacy_songs)} songs.")
+
+@app.cli.command('prune-mp3')
+def prune_mp3_command():
+    """Delete blob store files and renditions that no song refers to any more."""
+    referenced = {row.mp3_hash for row in db.session.query(Song.mp3_hash).filter(Song.mp3_hash.isnot(None)).distinct()}
+    removed = 0
+
+    for dirpath, dirnames, filenames in os.walk(app.config['MP3_STORE_PATH']):
+        for filename in filenames:
+            if filename.endswith('.mp3') and filename[:-4] not in referenced:
+                os.remove(os.path.join(dirpath, filename))
+                removed += 1
+
+    # Renditions are named <hash>-<kbps>k.mp3.
+    for dirpath, dirnames, filenames in os.walk(app.config['RENDITION_CACHE_PATH']):
+        for filename in filenames:
+            if filename.endswith('.mp3') and filename.rsplit('-', 1)[0] not in referenced:
+                os.remove(os.path.join(dirpath, filename))
+                removed += 1
+
+    click.echo(f"Removed {removed} unreferenced files.")
+
+def create_app(config=None):
+    """Configure the app, create its database engine and bring the schema up to date.
+
+    Models and routes live on the module-level app, so there is one app per process: the first call
+    configures it and later calls return it unchanged. Passing config after that is an error rather
+    than being silently ignored. wsgi.py calls it, and `flask <command>` run from this directory loads
+    wsgi.py, so the CLI commands get the same configured app.
+    """
+    if 'sqlalchemy' in app.extensions:
+        if config:
+            raise RuntimeError("create_app() has already configured the app in this process.")
+        return app
+
+    if config:
+        app.config.update(config)
+    app.secret_key = os.environ.get('SECRET_KEY', app.secret_key)
+    app.debug = False
+    app.config.setdefault('MAX_CONTENT_LENGTH', app.config['MAX_MP3_SIZE'] + 1024 * 1024)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+        'poolclass': QueuePool,
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        'connect_args': {'timeout': app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000, 'check_same_thread': False},
+    })
+    db.init_app(app)
+
+    with app.app_context():
+        existing_database = inspect(db.engine).has_table("playlist")
+
+        migrate_database()
+        create_search_index()
+        recover_stale_jobs()
+        if app.config['SQL_PROFILING']:
+            enable_sql_profiling()
+
+        if existing_database:
+            print(f"Connected to an existing database: {db.engine.url.database}")
+        else:
+            print(f"Created a new database: {db.engine.url.database}")
+    return app
 
-    if existing_database:
-        print("Connected to an existing database: music_app.db")
 
-    else:
-        print("Created a new database: music_app.db")
-        db.create_all(bind='album_song_association')
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
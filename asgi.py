@@ -0,0 +1,236 @@
+# uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 4
+# Audio streaming and the search and rating APIs are async Starlette routes; every other URL is passed to the
+# Flask app through a2wsgi. Queries, file reads and encodes run in worker threads via anyio.to_thread, so the
+# event loop only moves bytes and a slow listener holds a coroutine and one chunk of buffer instead of one of
+# the WSGI threads the dashboard and rating pages need.
+import json
+import os
+import sqlite3
+import time
+from functools import partial
+from urllib.parse import quote
+
+import anyio
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import Forbidden, HTTPException, NotFound, RequestEntityTooLarge, Unauthorized
+from werkzeug.http import http_date
+from werkzeug.wrappers import Request as WerkzeugRequest
+
+import app as music
+from app import create_app, db
+
+flask_app = create_app()
+
+# Never more threads in the database than the SQLAlchemy pool has connections.
+db_limiter = anyio.CapacityLimiter(flask_app.config['DB_POOL_SIZE'] + flask_app.config['DB_MAX_OVERFLOW'])
+# Requests waiting for a rendition encode get their own threads, so they never hold a database slot.
+rendition_limiter = anyio.CapacityLimiter(int(os.environ.get('RENDITION_WAIT_THREADS', 32)))
+
+
+def in_app_context(func, *args):
+    with flask_app.app_context():
+        return func(*args)
+
+
+async def run_db(func, *args):
+    return await anyio.to_thread.run_sync(partial(in_app_context, func, *args), limiter=db_limiter)
+
+
+def int_arg(request, name):
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def session_data(request):
+    # Flask's signed session cookie, read the same way Flask reads it.
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        return serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+def lookup_user_id(username):
+    return db.session.query(music.User.id).filter_by(username=username).scalar()
+
+
+async def session_user_id(request):
+    # Sessions created before user_id was stored only carry the username.
+    data = session_data(request)
+    if data.get('user_id') is None and data.get('username'):
+        return await run_db(lookup_user_id, data['username'])
+    return data.get('user_id')
+
+
+async def api_user_id(request):
+    user_id = await session_user_id(request)
+    if user_id is None:
+        raise Unauthorized()
+    return user_id
+
+
+async def json_body(request):
+    # Like Flask's get_json(silent=True): None unless the body is JSON.
+    if 'json' not in request.headers.get('Content-Type', ''):
+        return None
+    max_length = flask_app.config['MAX_CONTENT_LENGTH']
+    if max_length is not None and int(request.headers.get('Content-Length') or 0) > max_length:
+        raise RequestEntityTooLarge()
+    try:
+        return json.loads(await request.body())
+    except ValueError:
+        return None
+
+
+def json_response(payload, status=200):
+    return Response(music.dump_json(payload), status, {'Cache-Control': 'no-cache'}, media_type='application/json')
+
+
+def conditional_request(request):
+    # werkzeug parses the conditional and Range headers, so both servers answer them the same way.
+    environ = {'REQUEST_METHOD': request.method}
+    for header in ('If-None-Match', 'If-Modified-Since', 'Range', 'If-Range'):
+        if header in request.headers:
+            environ['HTTP_' + header.upper().replace('-', '_')] = request.headers[header]
+    return WerkzeugRequest(environ)
+
+
+async def file_chunks(path, start, end):
+    chunk_size = flask_app.config['MP3_CHUNK_SIZE']
+    async with await anyio.open_file(path, 'rb') as f:
+        await f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = await f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def open_database_audio(song_id):
+    # The BLOB handle needs its connection until the last chunk, so each stream opens one of its own instead of
+    # keeping one of the pool's checked out for as long as a slow listener takes.
+    connection = sqlite3.connect(db.engine.url.database, check_same_thread=False)
+    blob = music.open_mp3_blob(connection, song_id)
+    if blob is None:
+        connection.close()
+        return None
+    return connection, blob
+
+
+async def database_chunks(song_id, start, end):
+    # Songs not yet moved to the blob store, read through one incremental BLOB handle.
+    opened = await run_db(open_database_audio, song_id)
+    if opened is None:
+        return
+    connection, blob = opened
+    chunk_size = flask_app.config['MP3_CHUNK_SIZE']
+    try:
+        blob.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = await anyio.to_thread.run_sync(blob.read, min(chunk_size, remaining), limiter=db_limiter)
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        blob.close()
+        connection.close()
+
+
+async def send_audio(request, song_id, user_id, cache_control=None):
+    # The async counterpart of send_song_audio. Only the song lookup goes through run_db; picking the file
+    # may wait for an encode, which happens under rendition_limiter instead.
+    quality = music.requested_quality(request.query_params, request.headers)
+    source = await run_db(music.stored_audio, song_id)
+    if source is None:
+        raise NotFound()
+    source = await anyio.to_thread.run_sync(music.audio_file, source, quality, limiter=rendition_limiter)
+
+    status, start, end = music.audio_range(conditional_request(request), source)
+    if status == 416:
+        return Response(status_code=416, headers={'Content-Range': f"bytes */{source['size']}"})
+
+    headers = {'ETag': f"\"{source['etag']}\"", 'Accept-Ranges': 'bytes'}
+    if source['last_modified']:
+        headers['Last-Modified'] = http_date(source['last_modified'])
+    if 'quality' not in request.query_params:
+        headers['Vary'] = 'Save-Data, ECT'
+        headers['Accept-CH'] = 'Save-Data, ECT'
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    if status == 304:
+        return Response(status_code=304, headers=headers)
+
+    headers['Content-Length'] = str(end - start)
+    headers['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(source['title'])}.mp3"
+    if status == 206:
+        headers['Content-Range'] = f"bytes {start}-{end - 1}/{source['size']}"
+    if music.is_new_play(status, start, request.headers):
+        music.record_event('play', song_id, user_id)
+
+    chunks = file_chunks(source['path'], start, end) if source['path'] else database_chunks(song_id, start, end)
+    return StreamingResponse(chunks, status_code=status, headers=headers, media_type='audio/mp3')
+
+
+async def get_mp3(request):
+    return await send_audio(request, request.path_params['song_id'], await session_user_id(request))
+
+
+async def stream_song(request):
+    song_id = request.path_params['song_id']
+    user_id = int_arg(request, 'u')
+    expires = int_arg(request, 'expires')
+    signature = request.query_params.get('sig', '')
+    if not expires or expires < time.time() or not music.stream_signer().verify_signature(f'{song_id}:{user_id}:{expires}', signature):
+        raise Forbidden()
+    return await send_audio(request, song_id, user_id, f'private, max-age={max(expires - int(time.time()), 0)}')
+
+
+async def api_search(request):
+    search_query = request.query_params.get('q', '').strip()
+    limit = music.clamp_limit(int_arg(request, 'limit'))
+    return json_response(await run_db(music.search_payload, search_query, request.query_params.get('after'), limit))
+
+
+async def api_song_rating(request):
+    user_id = await api_user_id(request)
+    song_id = request.path_params['song_id']
+    if request.method == 'GET':
+        return json_response(await run_db(music.song_rating_payload, user_id, song_id))
+    return json_response(await run_db(music.rate_song_payload, user_id, song_id, await json_body(request)))
+
+
+async def api_rate_songs(request):
+    user_id = await api_user_id(request)
+    return json_response(await run_db(music.rate_songs_payload, user_id, await json_body(request)))
+
+
+async def http_error(request, error):
+    if request.url.path.startswith('/api/'):
+        return json_response({'error': error.name, 'message': error.description}, error.code)
+    return PlainTextResponse(f'{error.code} {error.name}', error.code)
+
+
+app = Starlette(
+    routes=[
+        Route('/get_mp3/{song_id:int}', get_mp3),
+        Route('/stream/{song_id:int}', stream_song),
+        Route('/api/v1/search', api_search),
+        Route('/api/v1/songs/{song_id:int}/rating', api_song_rating, methods=['GET', 'PUT', 'POST']),
+        Route('/api/v1/ratings', api_rate_songs, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=int(os.environ.get('WSGI_THREADS', 8)))),
+    ],
+    exception_handlers={HTTPException: http_error},
+)
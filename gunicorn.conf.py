@@ -0,0 +1,16 @@
+# gunicorn -c gunicorn.conf.py wsgi:app
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = 60
+keepalive = 5
+max_requests = 2000
+max_requests_jitter = 200
+accesslog = '-'
+
+# Each worker imports the app itself, so no SQLite connection is shared across a fork.
+preload_app = False
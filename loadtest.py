@@ -0,0 +1,152 @@
+# Simple load generator for comparing deployments, e.g.
+#   python app.py                                  (dev server on :5000)
+#   gunicorn -c gunicorn.conf.py wsgi:app          (production on :8000)
+#   python loadtest.py --base-url http://127.0.0.1:8000 --scenario dashboard
+# Paired scenarios compare an HTML page with its /api/v1 equivalent, e.g. song_list_html vs song_list_api.
+# Bytes are counted as received, so compressed API responses are measured at their wire size.
+# The login scenario is throttled per client address; raise MUSIC_APP_LOGIN_IP_BURST and
+# MUSIC_APP_LOGIN_USER_BURST on the server to measure raw hashing throughput.
+# The stream scenario plays --song-id like a slow listener, pausing --read-delay seconds between 16 KB reads;
+# run it against gunicorn and against uvicorn asgi:app alongside a dashboard run to see what slow clients cost.
+import argparse
+import http.cookiejar
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+def make_opener():
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    opener.addheaders = [('Accept-Encoding', 'br, gzip')]
+    return opener
+
+
+def post(opener, url, data):
+    return opener.open(url, urllib.parse.urlencode(data).encode())
+
+
+def login(opener, base_url, username, password):
+    post(opener, f'{base_url}/register', {'username': username, 'password': password})
+    post(opener, f'{base_url}/login/user', {'username': username, 'password': password})
+
+
+def get(opener, url):
+    return len(opener.open(url).read())
+
+
+def dashboard(opener, args, worker, i):
+    return get(opener, f'{args.base_url}/dashboard/user')
+
+
+def rate(opener, args, worker, i):
+    return len(post(opener, f'{args.base_url}/rate_song/{args.song_id}', {'rating': i % 5 + 1}).read())
+
+
+def rate_batch(opener, args, worker, i):
+    # --batch-size ratings over song ids 1..--song-count in one POST to /api/v1/ratings.
+    song_ids = random.sample(range(1, args.song_count + 1), min(args.batch_size, args.song_count))
+    body = json.dumps([{'song_id': song_id, 'rating': random.randint(1, 5)} for song_id in song_ids]).encode()
+    request = urllib.request.Request(f'{args.base_url}/api/v1/ratings', body, {'Content-Type': 'application/json'})
+    return len(opener.open(request).read())
+
+
+def login_scenario(opener, args, worker, i):
+    # Each successful login redirects to the dashboard, which is counted as part of the request.
+    return len(post(opener, f'{args.base_url}/login/user', {'username': f'{args.username}{worker}', 'password': args.password}).read())
+
+
+def song_list_html(opener, args, worker, i):
+    return get(opener, f'{args.base_url}/song_list')
+
+
+def song_list_api(opener, args, worker, i):
+    return get(opener, f'{args.base_url}/api/v1/songs?fields=id,title,artist')
+
+
+def song_html(opener, args, worker, i):
+    return get(opener, f'{args.base_url}/song/{args.song_id}')
+
+
+def song_api(opener, args, worker, i):
+    return get(opener, f'{args.base_url}/api/v1/songs/{args.song_id}')
+
+
+def stream(opener, args, worker, i):
+    received = 0
+    with opener.open(f'{args.base_url}/get_mp3/{args.song_id}') as response:
+        while chunk := response.read(16384):
+            received += len(chunk)
+            time.sleep(args.read_delay)
+    return received
+
+
+SCENARIOS = {
+    'dashboard': dashboard,
+    'rate': rate,
+    'rate_batch': rate_batch,
+    'login': login_scenario,
+    'song_list_html': song_list_html,
+    'song_list_api': song_list_api,
+    'song_html': song_html,
+    'song_api': song_api,
+    'stream': stream,
+}
+
+
+def run_worker(args, worker, deadline, latencies, sizes, errors):
+    opener = make_opener()
+    login(opener, args.base_url, f'{args.username}{worker}', args.password)
+    scenario = SCENARIOS[args.scenario]
+    i = 0
+
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            sizes.append(scenario(opener, args, worker, i))
+            latencies.append(time.perf_counter() - start)
+        except (urllib.error.URLError, OSError):
+            errors.append(1)
+        i += 1
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='dashboard')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--username', default='loadtest')
+    parser.add_argument('--password', default='loadtest')
+    parser.add_argument('--song-id', type=int, default=1)
+    parser.add_argument('--song-count', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--read-delay', type=float, default=0.05)
+    args = parser.parse_args()
+
+    latencies, sizes, errors = [], [], []
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=run_worker, args=(args, worker, deadline, latencies, sizes, errors)) for worker in range(args.concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    print(f'{args.scenario}: {len(latencies)} requests in {elapsed:.1f}s, {len(latencies) / elapsed:.1f} req/s, {len(errors)} errors')
+    if args.scenario == 'rate_batch':
+        print(f'{len(latencies) * min(args.batch_size, args.song_count) / elapsed:.0f} ratings/s')
+    if len(latencies) >= 2:
+        cuts = statistics.quantiles(latencies, n=100)
+        print(f'latency p50={cuts[49] * 1000:.1f}ms p95={cuts[94] * 1000:.1f}ms max={max(latencies) * 1000:.1f}ms')
+    if sizes:
+        print(f'payload {statistics.mean(sizes):.0f} bytes/response')
+
+
+if __name__ == '__main__':
+    main()
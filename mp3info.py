@@ -0,0 +1,189 @@
+import mmap
+import os
+from array import array
+
+# Bitrates in kbps, indexed by [mpeg1][layer][bitrate_index].
+BITRATES = {
+    True: {
+        1: (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        2: (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    },
+    False: {
+        1: (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        3: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    },
+}
+
+SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG 1
+    2: (22050, 24000, 16000),  # MPEG 2
+    0: (11025, 12000, 8000),   # MPEG 2.5
+}
+
+
+def parse_header(data, offset):
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+
+    b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+    version = (b1 >> 3) & 3
+    layer = 4 - ((b1 >> 1) & 3)
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 3
+
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = BITRATES[mpeg1][layer][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 1
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 3 and not mpeg1:
+        samples = 576
+        length = 72 * bitrate // sample_rate + padding
+    else:
+        samples = 1152
+        length = 144 * bitrate // sample_rate + padding
+
+    return {
+        'mpeg1': mpeg1,
+        'layer': layer,
+        'bitrate': bitrate,
+        'sample_rate': sample_rate,
+        'samples': samples,
+        'length': length,
+        'crc': not b1 & 1,
+        'mono': b3 >> 6 == 3,
+    }
+
+
+def id3v2_size(data):
+    if len(data) < 10 or data[:3] != b'ID3':
+        return 0
+    size = (data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def find_frame(data, offset):
+    # A sync word only counts if the frame after it also starts with a valid header (or the data ends there).
+    while True:
+        offset = data.find(b'\xff', offset)
+        if offset < 0:
+            return None, None
+
+        header = parse_header(data, offset)
+        if header:
+            following = offset + header['length']
+            if following + 4 > len(data) or parse_header(data, following):
+                return offset, header
+        offset += 1
+
+
+def looks_like_mp3(head):
+    if head[:3] == b'ID3':
+        return True
+    offset, header = find_frame(head, 0)
+    return offset is not None and offset < 4096
+
+
+def iter_frames(data):
+    offset, header = find_frame(data, id3v2_size(data))
+
+    while header:
+        yield offset, header
+        offset += header['length']
+        header = parse_header(data, offset)
+        if header is None and offset < len(data) - 128:
+            offset, header = find_frame(data, offset)
+
+
+def frame_gain(data, offset, header):
+    # Largest global_gain in a layer III frame's side info. It tracks the frame's loudness closely enough
+    # for a preview waveform without decoding any audio.
+    if header['layer'] != 3:
+        return None
+
+    channels = 1 if header['mono'] else 2
+    start = offset + 4 + (2 if header['crc'] else 0)
+    if header['mpeg1']:
+        size = 17 if channels == 1 else 32
+        position = 9 + (5 if channels == 1 else 3) + 4 * channels
+        entries, entry_bits = 2 * channels, 59
+    else:
+        size = 9 if channels == 1 else 17
+        position = 8 + channels
+        entries, entry_bits = channels, 63
+
+    side_info = data[start:start + size]
+    if len(side_info) < size:
+        return None
+
+    bits = int.from_bytes(side_info, 'big')
+    total_bits = size * 8
+    gains = []
+    for entry in range(entries):
+        # global_gain follows part2_3_length (12 bits) and big_values (9 bits).
+        gain_position = position + entry * entry_bits + 21
+        gains.append((bits >> (total_bits - gain_position - 8)) & 0xFF)
+    return max(gains)
+
+
+def downsample_peaks(gains, points):
+    if not gains:
+        return b''
+
+    points = min(points, len(gains))
+    peaks = array('B', (max(gains[i * len(gains) // points:(i + 1) * len(gains) // points]) for i in range(points)))
+    low, high = min(peaks), max(peaks)
+    if high == low:
+        return bytes(array('B', [255] * points))
+    return bytes(array('B', ((peak - low) * 255 // (high - low) for peak in peaks)))
+
+
+def analyze(path, waveform_points=256):
+    # Walks every frame header through an mmap, so memory use does not depend on the file size.
+    if os.path.getsize(path) == 0:
+        return None
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        frames = samples = audio_bytes = 0
+        sample_rate = None
+        gains = array('B')
+
+        for offset, header in iter_frames(data):
+            frames += 1
+            samples += header['samples']
+            audio_bytes += header['length']
+            sample_rate = sample_rate or header['sample_rate']
+
+            gain = frame_gain(data, offset, header)
+            if gain is not None:
+                gains.append(gain)
+
+    if not frames:
+        return None
+
+    duration = samples / sample_rate
+    return {
+        'frames': frames,
+        'sample_rate': sample_rate,
+        'duration': duration,
+        'bitrate': round(audio_bytes * 8 / duration / 1000),
+        'waveform': downsample_peaks(gains, waveform_points),
+    }
+
+
+def analyze_file(job):
+    # Process pool entry point: (song_id, path, waveform_points) -> (song_id, analysis or None).
+    song_id, path, waveform_points = job
+    try:
+        return song_id, analyze(path, waveform_points)
+    except (OSError, ValueError):
+        return song_id, None
@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as music
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    # One app per process (see create_app), backed by a throwaway database and blob store.
+    root = tmp_path_factory.mktemp('music')
+    return music.create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{root / 'music_app.db'}",
+        'MP3_STORE_PATH': str(root / 'mp3_store'),
+        'RENDITION_CACHE_PATH': str(root / 'rendition_cache'),
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'JOBS_EAGER': True,
+        'HASH_WORKERS': 0,
+        'PAGE_CACHE_ENABLED': False,
+        'LOGIN_USER_BURST': 1000,
+        'LOGIN_IP_BURST': 1000,
+        'DB_POOL_SIZE': 3,
+        'SQL_PROFILING': True,
+        'SQL_QUERY_BUDGET_RAISE': True,
+        'ANALYTICS_FLUSH_MS': 3600 * 1000,
+    })
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def sign_in(client, username, password='secret'):
+    client.post('/register', data={'username': username, 'password': password})
+    return client.post('/login/user', data={'username': username, 'password': password})
@@ -0,0 +1,26 @@
+from datetime import datetime
+
+import app as music
+
+
+def ratings_today():
+    music.flush_events()
+    stat = music.db.session.get(music.DailyStat, datetime.utcnow().date())
+    music.db.session.expire_all()
+    return stat.ratings if stat else 0
+
+
+def test_rate_events_count_only_committed_ratings(app):
+    with app.app_context():
+        song = music.Song(title='counted', artist='analytics', lyrics='')
+        music.db.session.add(song)
+        music.db.session.commit()
+        before = ratings_today()
+
+        music.record_rating(951, song.id, 4)
+        music.db.session.rollback()
+        assert ratings_today() == before
+
+        music.record_rating(951, song.id, 5)
+        music.db.session.commit()
+        assert ratings_today() == before + 1
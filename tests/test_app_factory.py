@@ -0,0 +1,15 @@
+import pytest
+
+import app as music
+
+
+def test_create_app_builds_the_engine_from_its_config(app, tmp_path_factory):
+    with app.app_context():
+        assert music.db.engine.pool.size() == 3
+        assert music.db.engine.url.database.startswith(str(tmp_path_factory.getbasetemp()))
+
+
+def test_create_app_refuses_config_once_configured(app):
+    assert music.create_app() is app
+    with pytest.raises(RuntimeError):
+        music.create_app({'DB_POOL_SIZE': 10})
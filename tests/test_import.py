@@ -0,0 +1,49 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import app as music
+
+# Twenty silent MPEG-1 layer III frames, 128 kbps at 44.1 kHz.
+MP3 = (b'\xff\xfb\x90\x00' + bytes(413)) * 20
+
+
+def test_import_reports_bad_manifest_rows_and_keeps_going(app, tmp_path):
+    (tmp_path / 'good.mp3').write_bytes(MP3)
+    (tmp_path / 'other.mp3').write_bytes(MP3)
+    manifest = tmp_path / 'manifest.jsonl'
+    manifest.write_text('\n'.join([
+        json.dumps({'file': 'good.mp3', 'title': 'Imported one', 'artist': 'importer', 'album': 'Imports'}),
+        json.dumps({'file': 'other.mp3', 'title': 'No artist'}),
+        json.dumps({'title': 'No file', 'artist': 'importer'}),
+        'not json',
+        json.dumps({'file': 'other.mp3', 'title': 'Imported two', 'artist': 'importer', 'album': 'Imports'}),
+    ]) + '\n')
+
+    result = app.test_cli_runner().invoke(args=['import-catalog', str(tmp_path), str(manifest), '--workers', '1'])
+
+    assert result.exit_code == 0, result.output
+    assert 'Skipped other.mp3: missing artist' in result.output
+    assert 'Skipped row 3: missing file' in result.output
+    assert 'Skipped row 4: not a JSON object' in result.output
+    with app.app_context():
+        album = music.Album.query.filter_by(name='Imports', artist='importer').one()
+        assert sorted(song.title for song in album.songs) == ['Imported one', 'Imported two']
+        assert music.db.session.get(music.ImportCheckpoint, str(manifest)).rows_done == 5
+
+
+def test_import_workers_do_not_rely_on_forked_config(app, tmp_path, monkeypatch):
+    # A spawned worker imports app afresh, with the default MP3_STORE_PATH.
+    monkeypatch.setattr(music, 'ProcessPoolExecutor', partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context('spawn')))
+    (tmp_path / 'spawned.mp3').write_bytes(MP3 + b'spawned')
+    manifest = tmp_path / 'manifest.jsonl'
+    manifest.write_text(json.dumps({'file': 'spawned.mp3', 'title': 'Spawned', 'artist': 'spawn-importer'}) + '\n')
+
+    result = app.test_cli_runner().invoke(args=['import-catalog', str(tmp_path), str(manifest), '--workers', '1'])
+
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        song = music.Song.query.filter_by(artist='spawn-importer').one()
+        assert os.path.exists(music.mp3_store_path(song.mp3_hash))
@@ -0,0 +1,117 @@
+import json
+from datetime import datetime, timedelta
+
+import app as music
+from conftest import sign_in
+
+
+def add_job(kind, status, age, args=None, worker_id='stopped-worker'):
+    beat = datetime.utcnow() - timedelta(seconds=age)
+    job = music.BackgroundJob(kind=kind, status=status, description=f'{kind} job', args=json.dumps(args) if args else None,
+                              worker_id=worker_id, updated_at=beat, heartbeat_at=beat)
+    music.db.session.add(job)
+    music.db.session.commit()
+    return job.id
+
+
+def test_interrupted_jobs_are_restarted_or_failed(app):
+    with app.app_context():
+        music.db.session.add_all([music.Song(title=f'banned {i}', artist='stale-banned', lyrics='') for i in range(3)])
+        music.db.session.commit()
+        ban = add_job('ban', 'running', 3600, ['stale-banned'])
+        upload = add_job('upload', 'pending', 3600)
+        live = add_job('ban', 'running', 1, ['someone-else'], worker_id='other-worker')
+
+        music.recover_stale_jobs()
+        music.db.session.expire_all()
+
+        assert music.db.session.get(music.BackgroundJob, ban).status == 'done'
+        assert music.Song.query.filter_by(artist='stale-banned').count() == 0
+        assert music.db.session.get(music.BackgroundJob, upload).status == 'failed'
+        assert music.db.session.get(music.BackgroundJob, live).status == 'running'
+        music.BackgroundJob.query.filter_by(id=live).delete()
+        music.db.session.commit()
+
+
+def test_jobs_held_by_this_worker_are_not_recovered(app):
+    # A job queued behind long-running ones has an old heartbeat row but is still owned by a live executor.
+    with app.app_context():
+        music.db.session.add(music.Song(title='queued ban', artist='queued-banned', lyrics=''))
+        music.db.session.commit()
+        queued_ban = add_job('ban', 'pending', 3600, ['queued-banned'], worker_id=music.job_worker_id)
+        queued_upload = add_job('upload', 'pending', 3600, worker_id=music.job_worker_id)
+
+        assert music.recover_stale_jobs() == 0
+        music.db.session.expire_all()
+
+        assert music.db.session.get(music.BackgroundJob, queued_ban).status == 'pending'
+        assert music.db.session.get(music.BackgroundJob, queued_upload).status == 'pending'
+        assert music.Song.query.filter_by(artist='queued-banned').count() == 1
+        music.BackgroundJob.query.filter(music.BackgroundJob.id.in_([queued_ban, queued_upload])).delete()
+        music.db.session.commit()
+
+
+def test_taken_over_jobs_are_not_run_by_their_old_worker(app):
+    with app.app_context():
+        music.db.session.add(music.Song(title='taken over', artist='taken-over', lyrics=''))
+        music.db.session.commit()
+        job_id = add_job('ban', 'pending', 0, ['taken-over'], worker_id='other-worker')
+
+        music.run_job(job_id, music.remove_creator_content, ['taken-over'])
+        music.db.session.expire_all()
+
+        assert music.db.session.get(music.BackgroundJob, job_id).status == 'pending'
+        assert music.Song.query.filter_by(artist='taken-over').count() == 1
+        music.BackgroundJob.query.filter_by(id=job_id).delete()
+        music.db.session.commit()
+
+
+def test_failed_and_abandoned_uploads_remove_their_spooled_file(app, tmp_path):
+    def broken_upload(job_id, tmp_path, title, artist, lyrics):
+        raise RuntimeError("storage unavailable")
+
+    failed_spool, abandoned_spool = tmp_path / 'failed.upload', tmp_path / 'abandoned.upload'
+    failed_spool.write_bytes(b'audio')
+    abandoned_spool.write_bytes(b'audio')
+    with app.app_context():
+        failed = music.submit_job('upload', broken_upload, str(failed_spool), 'title', 'artist', '')
+        abandoned = add_job('upload', 'running', 3600, [str(abandoned_spool), 'title', 'artist', ''])
+        music.recover_stale_jobs()
+        music.db.session.expire_all()
+
+        assert music.db.session.get(music.BackgroundJob, failed).status == 'failed'
+        assert music.db.session.get(music.BackgroundJob, abandoned).status == 'failed'
+    assert not failed_spool.exists()
+    assert not abandoned_spool.exists()
+
+
+def test_admin_dashboard_stops_refreshing_for_stalled_jobs(app, client):
+    with app.app_context():
+        job_id = add_job('delete_songs', 'running', 3600)
+    # delete_songs jobs created without stored arguments cannot be restarted, so the stalled one is failed.
+    page = client.get('/dashboard/admin').get_data(as_text=True)
+    assert 'http-equiv="refresh"' not in page
+    assert 'failed: The worker running this job stopped.' in page
+    with app.app_context():
+        assert music.db.session.get(music.BackgroundJob, job_id).status == 'failed'
+
+
+def test_bulk_deletes_need_an_admin(app, client):
+    with app.app_context():
+        music.db.session.add(music.User(username='moderator', password_hash=music.hash_password('secret'), isadmin=1))
+        music.db.session.add_all([music.Song(title=f'bulk {i}', artist='bulk-target', lyrics='') for i in range(2)])
+        music.db.session.commit()
+        song_ids = [song.id for song in music.Song.query.filter_by(artist='bulk-target')]
+
+    sign_in(client, 'bulk-visitor')
+    assert 'bulk-delete' not in client.get('/song_list').get_data(as_text=True)
+    assert client.post('/dashboard/admin/delete_songs', data={'song_ids': song_ids}).status_code == 403
+    assert client.post('/dashboard/admin/delete_albums', data={'album_ids': [1]}).status_code == 403
+    with app.app_context():
+        assert music.Song.query.filter_by(artist='bulk-target').count() == 2
+
+    client.post('/login/admin', data={'username': 'moderator', 'password': 'secret'})
+    assert 'bulk-delete' in client.get('/song_list').get_data(as_text=True)
+    assert client.post('/dashboard/admin/delete_songs', data={'song_ids': song_ids}).status_code == 302
+    with app.app_context():
+        assert music.Song.query.filter_by(artist='bulk-target').count() == 0
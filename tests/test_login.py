@@ -0,0 +1,31 @@
+from werkzeug.security import generate_password_hash
+
+import app as music
+from conftest import sign_in
+
+
+def stored_hash(app, username):
+    with app.app_context():
+        return music.db.session.query(music.User.password_hash).filter_by(username=username).scalar()
+
+
+def test_login_does_not_rehash_a_current_hash(app, client, monkeypatch):
+    # The short method name is stored expanded, which must still count as current.
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', 'scrypt')
+    sign_in(client, 'rehash-current')
+    first = stored_hash(app, 'rehash-current')
+
+    client.post('/login/user', data={'username': 'rehash-current', 'password': 'secret'})
+    assert stored_hash(app, 'rehash-current') == first
+
+
+def test_login_upgrades_an_outdated_hash(app, client):
+    sign_in(client, 'rehash-old')
+    with app.app_context():
+        music.User.query.filter_by(username='rehash-old').update(
+            {'password_hash': generate_password_hash('secret', 'pbkdf2:sha256:1000')})
+        music.db.session.commit()
+        music.user_cache.clear()
+
+    client.post('/login/user', data={'username': 'rehash-old', 'password': 'secret'})
+    assert stored_hash(app, 'rehash-old').startswith('scrypt:32768:8:1$')
@@ -0,0 +1,55 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+import app as music
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# music_app.db as created before versioned migrations existed.
+BASELINE_SCHEMA = '''
+CREATE TABLE user (id INTEGER NOT NULL, username VARCHAR(20) NOT NULL, password_hash VARCHAR(128) NOT NULL,
+    isadmin INTEGER NOT NULL, iscreate INTEGER DEFAULT '0' NOT NULL, isban INTEGER DEFAULT '0' NOT NULL,
+    PRIMARY KEY (id), UNIQUE (username));
+CREATE TABLE album (id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, artist VARCHAR(100) NOT NULL, PRIMARY KEY (id));
+CREATE TABLE song (id INTEGER NOT NULL, title VARCHAR(100) NOT NULL, artist VARCHAR(100) NOT NULL, lyrics TEXT NOT NULL,
+    mp3_binary BLOB, album_id INTEGER, PRIMARY KEY (id), FOREIGN KEY(album_id) REFERENCES album (id));
+CREATE TABLE playlist (id INTEGER NOT NULL, name VARCHAR(100) NOT NULL, creator_id INTEGER NOT NULL,
+    PRIMARY KEY (id), FOREIGN KEY(creator_id) REFERENCES user (id));
+CREATE TABLE album_song_association (album_id INTEGER, song_id INTEGER,
+    FOREIGN KEY(album_id) REFERENCES album (id), FOREIGN KEY(song_id) REFERENCES song (id));
+CREATE TABLE ratings (id INTEGER NOT NULL, user_id INTEGER NOT NULL, song_id INTEGER NOT NULL, rating INTEGER NOT NULL,
+    PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES user (id), FOREIGN KEY(song_id) REFERENCES song (id));
+CREATE TABLE playlist_song_association (playlist_id INTEGER, song_id INTEGER,
+    FOREIGN KEY(playlist_id) REFERENCES playlist (id), FOREIGN KEY(song_id) REFERENCES song (id));
+'''
+
+
+def upgrade(path):
+    # create_app configures one app per process, so the upgrade runs in its own interpreter.
+    config = {'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'}
+    code = f'import app; app.create_app({json.dumps(config)})'
+    subprocess.run([sys.executable, '-c', code], cwd=REPO, check=True, capture_output=True)
+
+
+def test_upgrade_from_baseline_fills_in_rating_aggregates(tmp_path):
+    path = tmp_path / 'music_app.db'
+    with sqlite3.connect(path) as connection:
+        connection.executescript(BASELINE_SCHEMA)
+        connection.executemany('INSERT INTO user (id, username, password_hash, isadmin) VALUES (?, ?, ?, 0)',
+                               [(1, 'alice', 'x'), (2, 'bob', 'x')])
+        connection.executemany("INSERT INTO song (id, title, artist, lyrics) VALUES (?, ?, 'carol', '')",
+                               [(1, 'first'), (2, 'second'), (3, 'unrated')])
+        # bob rated song 2 twice; only his later rating survives the upgrade.
+        connection.executemany('INSERT INTO ratings (user_id, song_id, rating) VALUES (?, ?, ?)',
+                               [(1, 1, 4), (2, 1, 2), (1, 2, 5), (2, 2, 1), (2, 2, 5)])
+
+    upgrade(path)
+
+    with sqlite3.connect(path) as connection:
+        songs = connection.execute('SELECT id, rating_count, rating_sum, rating_avg FROM song ORDER BY id').fetchall()
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+    assert songs == [(1, 2, 6, 3.0), (2, 2, 10, 5.0), (3, 0, 0, 0.0)]
+    assert version == len(music.MIGRATIONS)
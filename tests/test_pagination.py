@@ -0,0 +1,30 @@
+import pytest
+
+import app as music
+from conftest import sign_in
+
+
+@pytest.fixture
+def songs(app):
+    with app.app_context():
+        music.db.session.add_all([music.Song(title=f'page {i}', artist='pager', lyrics='') for i in range(3)])
+        music.db.session.commit()
+
+
+def test_api_pages_follow_the_cursor(client, songs):
+    first = client.get('/api/v1/songs?limit=2').get_json()
+    second = client.get(f"/api/v1/songs?limit=2&after={first['next_cursor']}").get_json()
+    assert first['items'][-1]['id'] < second['items'][0]['id']
+
+
+@pytest.mark.parametrize('values', [[[1]], [{'id': 1}], ['1'], [True], [1, 2], {'id': 1}, None])
+def test_malformed_cursors_are_rejected(client, songs, values):
+    cursor = music.encode_cursor(values)
+    assert client.get(f'/api/v1/songs?after={cursor}').status_code == 400
+    assert client.get(f'/api/v1/search?q=page&after={cursor}').status_code == 400
+
+
+def test_float_keys_accept_whole_numbers(client, songs):
+    sign_in(client, 'pager-reader')
+    cursor = music.encode_cursor([3, 10 ** 6])
+    assert client.get(f'/dashboard/user?songs_after={cursor}').status_code == 200
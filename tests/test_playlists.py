@@ -0,0 +1,34 @@
+import re
+
+import app as music
+from conftest import sign_in
+
+
+def playlist_order(playlist_id):
+    return [row.song_id for row in music.db.session.query(music.playlist_song_association.c.song_id)
+            .filter_by(playlist_id=playlist_id).order_by(music.playlist_song_association.c.position)]
+
+
+def test_first_song_of_a_later_page_moves_up_across_the_boundary(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, 'PAGE_SIZE', 2)
+    sign_in(client, 'playlist-pager')
+    with app.app_context():
+        user = music.User.query.filter_by(username='playlist-pager').one()
+        songs = [music.Song(title=f'ordered {i}', artist='pager', lyrics='') for i in range(4)]
+        playlist = music.Playlist(name='paged', creator_id=user.id)
+        music.db.session.add_all([*songs, playlist])
+        music.db.session.flush()
+        music.append_to_playlist(playlist.id, [song.id for song in songs])
+        music.db.session.commit()
+        playlist_id, song_ids = playlist.id, [song.id for song in songs]
+
+    first_page = client.get(f'/playlist/{playlist_id}/songs').get_data(as_text=True)
+    assert f'/move/{song_ids[0]}"' not in first_page
+
+    cursor = re.search(r'after=([\w-]+)', first_page).group(1)
+    second_page = client.get(f'/playlist/{playlist_id}/songs?after={cursor}').get_data(as_text=True)
+    assert re.search(rf'/move/{song_ids[2]}".*?name="before" value="{song_ids[1]}"', second_page, re.S)
+
+    client.post(f'/playlist/{playlist_id}/move/{song_ids[2]}', data={'before': song_ids[1], 'after': cursor})
+    with app.app_context():
+        assert playlist_order(playlist_id) == [song_ids[0], song_ids[2], song_ids[1], song_ids[3]]
@@ -0,0 +1,59 @@
+import pytest
+
+import app as music
+from conftest import sign_in
+
+
+def test_hot_queries_use_indexes(app):
+    with app.app_context():
+        failures = [(name, plan) for name, plan, ok in music.check_query_plans() if not ok]
+    assert failures == []
+
+
+def test_covering_index_scans_are_not_enough(app, monkeypatch):
+    with app.app_context():
+        monkeypatch.setattr(music, 'hot_queries', lambda: {'by_rating': (music.db.session.query(music.Song.id).order_by(music.Song.rating_avg), None)})
+        [(name, plan, ok)] = music.check_query_plans()
+    assert plan[0].startswith('SCAN song USING COVERING INDEX')
+    assert not ok
+
+
+def make_library(app, client, size):
+    # A creator with `size` songs, an album holding all of them, albums of four and a playlist holding half.
+    username = f'budget-creator-{size}'
+    sign_in(client, username)
+    client.post('/dashboard/user', data={'submit': 'Join as Creator'})
+    with app.app_context():
+        user = music.User.query.filter_by(username=username).one()
+        songs = [music.Song(title=f'track {i}', artist=username, lyrics='') for i in range(size)]
+        albums = [music.Album(name=f'budget album {size}', artist=username, songs=songs)]
+        albums += [music.Album(name=f'budget album {size}-{start}', artist=username, songs=songs[start:start + 4])
+                   for start in range(0, size, 4)]
+        playlist = music.Playlist(name=f'budget playlist {size}', creator_id=user.id)
+        music.db.session.add_all(albums + [playlist])
+        music.db.session.flush()
+        music.append_to_playlist(playlist.id, [song.id for song in songs[:size // 2]])
+        music.db.session.commit()
+        return {'album': albums[0].id, 'playlist': playlist.id}
+
+
+def budgeted_pages(library):
+    yield 'creator_dashboard', '/dashboard/creator'
+    yield 'album_songs', f"/album/{library['album']}/songs"
+    yield 'playlist_songs', f"/playlist/{library['playlist']}/songs"
+    yield 'add_songs_to_playlist', f"/playlist/{library['playlist']}/add_songs"
+
+
+@pytest.mark.parametrize('sizes', [(4, 40), (1, 120)])
+def test_page_query_counts_do_not_grow_with_the_library(app, client, sizes):
+    counts = {}
+    for size in sizes:
+        library = make_library(app, client, size)
+        for endpoint, url in budgeted_pages(library):
+            response = client.get(url)
+            assert response.status_code == 200, url
+            counts.setdefault(endpoint, []).append(int(response.headers['X-SQL-Queries']))
+
+    for endpoint, per_size in counts.items():
+        assert len(set(per_size)) == 1, (endpoint, dict(zip(sizes, per_size)))
+        assert per_size[0] <= app.view_functions[endpoint].query_budget, endpoint
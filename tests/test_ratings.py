@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+from sqlalchemy import event
+
+import app as music
+from conftest import sign_in
+
+
+@pytest.fixture
+def rated_songs(app):
+    with app.app_context():
+        songs = [music.Song(title=f'rated {i}', artist='rater', lyrics='') for i in range(3)]
+        music.db.session.add_all(songs)
+        music.db.session.commit()
+        return [song.id for song in songs]
+
+
+def aggregates(song_ids):
+    return {row.id: (row.rating_count, row.rating_sum, row.rating_avg)
+            for row in music.db.session.query(music.Song.id, music.Song.rating_count, music.Song.rating_sum, music.Song.rating_avg)
+            .filter(music.Song.id.in_(song_ids))}
+
+
+def test_rating_writes_keep_aggregates_in_step(app, client, rated_songs):
+    first, second, third = rated_songs
+    with app.app_context():
+        music.upsert_ratings([(901, first, 4), (902, first, 2), (901, second, 5)])
+        music.db.session.commit()
+        # A changed rating, a repeated one, a new one and two writes to the same pair in one batch.
+        music.upsert_ratings([(901, first, 1), (901, second, 5), (903, second, 3), (901, third, 2), (901, third, 4)])
+        music.db.session.commit()
+        incremental = aggregates(rated_songs)
+
+        music.refresh_rating_aggregates(rated_songs)
+        assert incremental == aggregates(rated_songs) == {first: (2, 3, 1.5), second: (2, 8, 4.0), third: (1, 4, 4.0)}
+
+
+def test_concurrent_writes_to_one_rating_count_it_once(app, rated_songs):
+    # Each writer pauses after reading the rating it replaces, waiting for the other to read it too. Only one of them
+    # may get that far before the first commits, or both count the rating as new.
+    song_id = rated_songs[0]
+    both_read = threading.Barrier(2, timeout=1)
+
+    def pause_after_reading(connection, cursor, statement, parameters, context, executemany):
+        if statement.startswith('SELECT ratings.user_id AS ratings_user_id'):
+            try:
+                both_read.wait()
+            except threading.BrokenBarrierError:
+                pass
+
+    def rate(value):
+        with app.app_context():
+            music.upsert_ratings([(904, song_id, value)])
+            music.db.session.commit()
+
+    with app.app_context():
+        engine = music.db.engine
+    event.listen(engine, 'after_cursor_execute', pause_after_reading)
+    try:
+        writers = [threading.Thread(target=rate, args=(value,)) for value in (5, 3)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+    finally:
+        event.remove(engine, 'after_cursor_execute', pause_after_reading)
+
+    with app.app_context():
+        stored = music.db.session.query(music.Rating.rating).filter_by(user_id=904, song_id=song_id).scalar()
+        assert aggregates([song_id]) == {song_id: (1, stored, float(stored))}
+
+
+def test_api_rating_updates_the_average(client, rated_songs):
+    sign_in(client, 'aggregate-rater')
+    song_id = rated_songs[0]
+    client.put(f'/api/v1/songs/{song_id}/rating', json={'rating': 2})
+    response = client.put(f'/api/v1/songs/{song_id}/rating', json={'rating': 4})
+    assert response.get_json() == {'song_id': song_id, 'rating': 4, 'rating_avg': 4.0, 'rating_count': 1}
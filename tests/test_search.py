@@ -0,0 +1,21 @@
+import app as music
+
+
+def test_only_the_newest_matches_are_ranked(app, monkeypatch):
+    with app.app_context():
+        # The oldest song is the best match; the newer ones mention the word once among filler.
+        songs = [music.Song(title='best match', artist='ranker', lyrics='zephyrine zephyrine zephyrine')]
+        songs += [music.Song(title=f'weak match {i}', artist='ranker', lyrics='zephyrine ' + 'filler ' * 40) for i in range(4)]
+        music.db.session.add_all(songs)
+        music.db.session.flush()
+        music.index_songs([song.id for song in songs])
+        music.db.session.commit()
+        newest = {song.id for song in songs[-3:]}
+
+        found, albums = music.search_fts('zephyr', 10, 0)
+        assert [row.id for row in found][0] == songs[0].id
+        assert len(found) == 5
+
+        monkeypatch.setitem(app.config, 'SEARCH_CANDIDATES', 3)
+        found, albums = music.search_fts('zephyr', 10, 0)
+        assert {row.id for row in found} == newest
@@ -0,0 +1,8 @@
+from app import create_app
+
+app = create_app()
+
+if __name__ == '__main__':
+    # Windows-friendly alternative to gunicorn.
+    from waitress import serve
+    serve(app, host='0.0.0.0', port=8000, threads=8)